@@ -14,27 +14,45 @@ function checkDependency {
     fi;
 }
 
-function downloadPythonDependency {
-    package_name="$1"
-    package_version="$2"
-    if pip show "$package_name" >/dev/null 2>&1; then
-        if [ $IGNORE_SYSTEM_PACKAGES ]; then
-            echo "Ignoring system package for $package_name" 2>&1;
-        else
-            return 0 # The dependency was manually installed
+# The bootstrapped PYTHONPATH entries are cached, so warm runs don't need to check for anything
+PYTHONPATH_CACHE="work/python_packages/pythonpath.txt"
+
+function bootstrapPythonDependencies {
+    cache_key="$* ignore-system=${IGNORE_SYSTEM_PACKAGES:-}"
+    if [ -f "$PYTHONPATH_CACHE" ]; then
+        { read -r cached_key; read -r cached_path; } < "$PYTHONPATH_CACHE"
+        if [ "$cached_key" == "$cache_key" ]; then
+            IFS=':' read -r -a entries <<< "$cached_path"
+            missing=""
+            for entry in "${entries[@]}"; do
+                if [ ! -e "$entry" ]; then
+                    missing="$entry"
+                fi;
+            done;
+            if [ -z "$missing" ]; then
+                PYTHON_DIRS+=("${entries[@]}")
+                return 0
+            fi;
         fi;
     fi;
-    cache_location="work/python_packages/$package_name/$package_version"
-    if [ ! -d "$cache_location" ]; then
-        echo "Python package $package_name not found!" >&2
-        echo "Attempting to download from PyPI!" >&2
-        python3 scripts/downloadDependency.py "$@" || exit 1
-    fi
-    PYTHON_DIRS+=("$cache_location")
+    cached_path="$(python3 scripts/downloadDependency.py "$@")" || exit 1
+    mkdir -p "$(dirname "$PYTHONPATH_CACHE")"
+    printf '%s\n%s\n' "$cache_key" "$cached_path" > "$PYTHONPATH_CACHE"
+    IFS=':' read -r -a entries <<< "$cached_path"
+    PYTHON_DIRS+=("${entries[@]}")
 }
 
 function join_by { local IFS="$1"; shift; echo "$*"; }
 
+# Let a running daemon answer the command if it can, which skips checking dependencies and starting the build system
+if [ -S "work/daemon.sock" ] || [ -n "$FOUNTAIN_DAEMON_SOCKET" ]; then
+    python3 scripts/fountain/client.py "$@"
+    status=$?
+    if [ $status -ne 75 ]; then
+        exit $status
+    fi
+fi
+
 checkDependency sha256sum
 checkDependency curl
 checkDependency python3
@@ -44,8 +62,7 @@ checkDependency mvn Maven
 
 export PYTHON_DIRS=("scripts")
 
-downloadPythonDependency "argh" "0.26.2"
-downloadPythonDependency "diffutils" "1.0.6"
+bootstrapPythonDependencies "argh==0.26.2" "diffutils==1.0.6"
 
 export PYTHONPATH
 PYTHONPATH="$(join_by ':' "${PYTHON_DIRS[@]}")"
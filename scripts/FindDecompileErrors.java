@@ -28,7 +28,9 @@ public class FindDecompileErrors {
             System.err.println("Missing file: " + sourceRoot);
             System.exit(1);
         }
-        File targetSources = new File(args[2]);
+        // NOTE: A leading '@' means we were given a file listing the sources to check
+        boolean sourceList = args[2].startsWith("@");
+        File targetSources = new File(sourceList ? args[2].substring(1) : args[2]);
         if (!targetSources.exists()) {
             System.err.println("Missing file: " + targetSources);
             System.exit(1);
@@ -43,8 +45,16 @@ public class FindDecompileErrors {
         // We have to periodically clear the file manager and diagnostics or we'll hit an OOME
         int timesUsed = 0;
         List<File> sourceFiles = new ArrayList<>();
-        try (Stream<Path> s = Files.walk(targetSources.toPath())) {
-            s.filter(Files::isRegularFile).map(Path::toFile).forEach(sourceFiles::add);
+        if (sourceList) {
+            for (String line : Files.readAllLines(targetSources.toPath(), StandardCharsets.UTF_8)) {
+                if (!line.trim().isEmpty()) {
+                    sourceFiles.add(new File(line.trim()));
+                }
+            }
+        } else {
+            try (Stream<Path> s = Files.walk(targetSources.toPath())) {
+                s.filter(Files::isRegularFile).map(Path::toFile).forEach(sourceFiles::add);
+            }
         }
         Map<String, Set<String>> errors = new HashMap<>();
         Map<String, List<String>> currentErrors = new HashMap<>();
@@ -109,7 +119,7 @@ public class FindDecompileErrors {
     }
 
     private static void printHelp(PrintStream out) {
-        out.println("Usage: java FindDecompileErrors.class [classpath] [sourcepath] [sources] [output file]");
+        out.println("Usage: java FindDecompileErrors.class [classpath] [sourcepath] [sources|@source list] [output file]");
     }
 
     private static final String[] JSON_ESCAPE_TABLE;
@@ -1,17 +1,47 @@
 #!/usr/bin/env python3
+"""
+Bootstraps the python dependencies of the build system, printing the PYTHONPATH entries they need.
+
+Usage: downloadDependency.py <name>==<version>...
+
+Wheels are taken from work/python_packages, then the wheelhouse directory in FOUNTAIN_WHEELHOUSE (if any),
+and are only downloaded from PyPI (concurrently) as a last resort, so builders without network access
+can bootstrap from a wheelhouse. The package info from PyPI is cached next to the wheels.
+Pure python wheels are imported straight from the zip, and only wheels with native code are extracted.
+Packages which are already installed are used instead, unless IGNORE_SYSTEM_PACKAGES is set.
+"""
 import json
 import os
 import sys
 import platform
 import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from io import TextIOWrapper
 from os import path
-from shutil import copyfileobj, rmtree
+from shutil import rmtree
 from sys import exit, stderr
 from urllib.error import HTTPError, URLError
 from urllib.request import urlopen
 from zipfile import BadZipFile, ZipFile
 import operator
+import importlib.util
+
+PACKAGES_DIR = "work/python_packages"
+NATIVE_SUFFIXES = (".so", ".pyd", ".dylib", ".dll")
+
+
+class BootstrapError(Exception):
+    pass
+
+
+def load_download_module():
+    # NOTE: Load the module directly, since importing the fountain package requires the dependencies we're downloading
+    location = path.join(path.dirname(path.abspath(__file__)), "fountain", "download.py")
+    spec = importlib.util.spec_from_file_location("fountain_download", location)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
 
 def try_clean(target):
@@ -24,24 +54,6 @@ def try_clean(target):
         print("WARNING: Unable to cleanup {}: {}".format(target, e), file=stderr)
 
 
-name = sys.argv[1]
-version = sys.argv[2]
-
-try:
-    print("Fetching package info for {} {}".format(name, version))
-    with urlopen("https://pypi.python.org/pypi/{}/{}/json".format(name, version)) as response:
-        package_info = json.load(TextIOWrapper(response, 'utf-8'))  # type: ignore # io  is broken
-except URLError as e:
-    print("ERROR: Unable to fetch package info for {} {}".format(name, version), file=stderr)
-    if isinstance(e, HTTPError):
-        print("Unexpected response code: {}".format(e.code), file=stderr)
-    else:
-        print("Error contacting server: {}".format(e.reason), file=stderr)
-    exit(1)
-except json.JSONDecodeError as e:
-    print("ERROR: Invalid package info json: {}".format(e))
-    exit(1)
-
 wheel_pattern = re.compile('\w+-[\w\.]+-([\w\.]+)-(\w+)-(\w+).whl')
 
 
@@ -65,6 +77,17 @@ def parse_wheel_tags(filename):
     return result
 
 
+def normalize_name(name):
+    """Normalize the project name the way wheel file names do"""
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def wheel_identity(filename):
+    """The normalized name and version of the wheel file"""
+    name, version = filename.split('-')[:2]
+    return normalize_name(name), version
+
+
 short_version_id = ''.join(map(str, sys.version_info[:2]))
 possible_version_tags = {"py3", f"py{short_version_id}", f"cp{short_version_id}"}
 possible_abi_tags = {f"cp{short_version_id}{sys.abiflags}", "none"}
@@ -81,7 +104,7 @@ elif sys.platform == "win32":
     else:
         raise RuntimeError(f"Unknown machine: {machine}")
 elif sys.platform == "darwin":
-    mac_version = machine.mac_ver()[0]
+    mac_version = platform.mac_ver()[0]
     assert machine == 'x86_64', f"Unknown machine: {machine}"
     if mac_version:
         possible_platform_tags.add('macosx_{}_x86_64'.format(
@@ -92,15 +115,11 @@ elif sys.platform == "darwin":
         possible_platform_tags.add('macosx_10_10_x86_64')
 else:
     raise RuntimeError(f"Unknown platform: {sys.platform}")
-wheels = {}
-for package in package_info['urls']:
-    if package['packagetype'] == 'bdist_wheel':
-        wheels[package['filename']] = package['url']
-if not wheels:
-    print(f"ERROR: No wheels for {name} {version} found!", file=stderr)
-    exit(1)
-else:
-    matching_wheels = set(wheels.keys())
+
+
+def select_wheel(wheel_names):
+    """Select the single wheel compatible with this python and platform"""
+    matching_wheels = set(wheel_names)
 
     def filter_wheels(actual_tags, acceptable_tags, tag_name):
         old_matching_wheels = frozenset(matching_wheels)
@@ -113,15 +132,15 @@ else:
             if not does_match:
                 matching_wheels.remove(wheel_name)
         if not matching_wheels:
-            raise RuntimeError(''.join([
+            raise BootstrapError(''.join([
                 f"No wheels found with acceptable {tag_name}s ",
                 '{', ', '.join(acceptable_tags), '}',
                 " for matching wheels ",
                 '{', ', '.join(old_matching_wheels), '}',
                 " out of available ",
-                '{', ', '.join(wheels.keys()), '}'
+                '{', ', '.join(wheel_names), '}'
             ]))
-    wheel_tags = {wheel_name: parse_wheel_tags(wheel_name) for wheel_name in wheels.keys()}
+    wheel_tags = {wheel_name: parse_wheel_tags(wheel_name) for wheel_name in wheel_names}
     filter_wheels(
         lambda wheel_name: map(operator.itemgetter(0), wheel_tags[wheel_name]),
         possible_version_tags,
@@ -131,7 +150,7 @@ else:
         lambda wheel_name: map(operator.itemgetter(1), wheel_tags[wheel_name]),
         possible_abi_tags,
         tag_name='abi'
-    ),
+    )
     filter_wheels(
         lambda wheel_name: map(operator.itemgetter(2), wheel_tags[wheel_name]),
         possible_platform_tags,
@@ -139,46 +158,164 @@ else:
     )
     assert matching_wheels, "No wheels found!"
     if len(matching_wheels) > 1:
-        raise RuntimeError(
-            f"Multiple matching wheels: {matching_wheels}"
-        )
+        raise BootstrapError(f"Multiple matching wheels: {matching_wheels}")
     wheel_name = next(iter(matching_wheels))
-    wheel_url = wheels[wheel_name]
+    assert wheel_name.endswith('.whl'), f"Invalid wheel: {wheel_name}"
+    return wheel_name
 
-assert wheel_name.endswith('.whl'), f"Invalid wheel: {wheel_name}"
-cached_package = f"work/python_packages/{name}/{version}"
-cached_wheel = f"work/python_packages/{name}/{wheel_name}"
 
-os.makedirs(path.dirname(cached_wheel), exist_ok=True)
+def local_wheel(directory, name, version):
+    """Find the compatible wheel for the package in the directory, or None if there isn't one"""
+    if not directory or not path.isdir(directory):
+        return None
+    candidates = [
+        file_name for file_name in os.listdir(directory)
+        if file_name.endswith('.whl') and wheel_identity(file_name) == (normalize_name(name), version)
+    ]
+    if not candidates:
+        return None
+    try:
+        return path.join(directory, select_wheel(candidates))
+    except BootstrapError:
+        return None
 
-if not path.exists(cached_wheel):
+
+def system_package_installed(name):
+    if os.getenv("IGNORE_SYSTEM_PACKAGES"):
+        return False
+    try:
+        from importlib import metadata
+    except ImportError:
+        return importlib.util.find_spec(name) is not None
     try:
-        print("Downloading wheel for {} {}".format(name, version))
-        with urlopen(wheel_url) as remote:
-            with open(cached_wheel, 'bw+') as local:
-                copyfileobj(remote, local)  # type: ignore # io typing is broken
-    except (URLError, OSError) as e:
-        print("ERROR: Unable to download wheel for {}v{}".format(name, version), file=stderr)
+        metadata.distribution(name)
+        return True
+    except metadata.PackageNotFoundError:
+        return False
+
+
+def package_info(name, version):
+    """Fetch the package info from PyPI, which is cached since the files of a release never change"""
+    cached_info = f"{PACKAGES_DIR}/{name}/{version}.json"
+    if path.exists(cached_info):
+        with open(cached_info) as f:
+            return json.load(f)
+    try:
+        print("Fetching package info for {} {}".format(name, version), file=stderr)
+        with urlopen("https://pypi.python.org/pypi/{}/{}/json".format(name, version)) as response:
+            result = json.load(TextIOWrapper(response, 'utf-8'))  # type: ignore # io  is broken
+    except URLError as e:
         if isinstance(e, HTTPError):
-            print("ERROR: Unexpected response code: {}".format(e.code), file=stderr)
-        elif isinstance(e, URLError):
-            print("Error contacting server: {}".format(e.reason), file=stderr)
+            reason = "Unexpected response code: {}".format(e.code)
         else:
-            print("Error writing to file: {}".format(e), stderr)
-        try_clean(cached_wheel)
-        exit(1)
+            reason = "Error contacting server: {}".format(e.reason)
+        raise BootstrapError("Unable to fetch package info for {} {}: {}".format(name, version, reason))
+    except json.JSONDecodeError as e:
+        raise BootstrapError("Invalid package info json: {}".format(e))
+    os.makedirs(path.dirname(cached_info), exist_ok=True)
+    temp_file = f"{cached_info}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(result, f)
+    os.replace(temp_file, cached_info)
+    return result
+
 
-if not path.exists(cached_package):
+def download_wheel(name, version):
+    info = package_info(name, version)
+    wheels = {}
+    wheel_digests = {}
+    for package in info['urls']:
+        if package['packagetype'] == 'bdist_wheel':
+            wheels[package['filename']] = package['url']
+            wheel_digests[package['filename']] = package.get('digests', {}).get('sha256')
+    if not wheels:
+        raise BootstrapError(f"No wheels for {name} {version} found!")
+    wheel_name = select_wheel(list(wheels.keys()))
+    cached_wheel = f"{PACKAGES_DIR}/{name}/{wheel_name}"
+    download = load_download_module()
     try:
-        print("Extracting {}".format(path.basename(cached_wheel)))
-        os.makedirs(cached_package)
-        with ZipFile(cached_wheel) as archive:
-            archive.extractall(cached_package)
-    except OSError as e:
-        print("ERROR: Unable to extract {}: {}".format(path.basename(cached_wheel), e), file=stderr)
-        try_clean(cached_package)
-        exit(1)
+        print("Downloading wheel for {} {}".format(name, version), file=stderr)
+        download.default_manager().download(wheels[wheel_name], cached_wheel, sha256=wheel_digests[wheel_name])
+    except download.DownloadError as e:
+        raise BootstrapError("Unable to download wheel for {} {}: {}".format(name, version, e))
+    return cached_wheel
+
+
+def is_pure(wheel):
+    """If the wheel only contains python code, so it can be imported directly from the zip"""
+    with ZipFile(wheel) as archive:
+        names = archive.namelist()
+        if any(file_name.endswith(NATIVE_SUFFIXES) for file_name in names):
+            return False
+        wheel_metadata = [file_name for file_name in names if re.fullmatch(r'[^/]+\.dist-info/WHEEL', file_name)]
+        if len(wheel_metadata) != 1:
+            return False
+        metadata = archive.read(wheel_metadata[0]).decode('utf-8')
+    return re.search(r'^Root-Is-Purelib:\s*true\s*$', metadata, re.MULTILINE | re.IGNORECASE) is not None
+
+
+def bootstrap(name, version):
+    """Make the package available, returning the PYTHONPATH entry it needs (if any)"""
+    if system_package_installed(name):
+        return None  # The dependency was manually installed
+    package_dir = f"{PACKAGES_DIR}/{name}"
+    cached_wheel = local_wheel(package_dir, name, version)
+    if cached_wheel is None:
+        wheelhouse_wheel = local_wheel(os.getenv("FOUNTAIN_WHEELHOUSE"), name, version)
+        if wheelhouse_wheel is not None:
+            print("Copying {} from the wheelhouse".format(path.basename(wheelhouse_wheel)), file=stderr)
+            os.makedirs(package_dir, exist_ok=True)
+            cached_wheel = path.join(package_dir, path.basename(wheelhouse_wheel))
+            temp_file = f"{cached_wheel}.{os.getpid()}.tmp"
+            shutil.copyfile(wheelhouse_wheel, temp_file)
+            os.replace(temp_file, cached_wheel)
+        else:
+            print("Python package {} {} not found, downloading it from PyPI".format(name, version), file=stderr)
+            cached_wheel = download_wheel(name, version)
+    try:
+        if is_pure(cached_wheel):
+            return cached_wheel
+        cached_package = f"{package_dir}/{version}"
+        if not path.exists(cached_package):
+            print("Extracting {}".format(path.basename(cached_wheel)), file=stderr)
+            try:
+                os.makedirs(cached_package)
+                with ZipFile(cached_wheel) as archive:
+                    archive.extractall(cached_package)
+            except OSError as e:
+                try_clean(cached_package)
+                raise BootstrapError("Unable to extract {}: {}".format(path.basename(cached_wheel), e))
     except BadZipFile as e:
-        print("ERROR: {} isn't a valid zipfile: {}".format(path.basename(cached_wheel), e), file=stderr)
-        try_clean(cached_package)
+        try_clean(cached_wheel)
+        raise BootstrapError("{} isn't a valid zipfile: {}".format(path.basename(cached_wheel), e))
+    return cached_package
+
+
+def main(requirements):
+    packages = []
+    for requirement in requirements:
+        name, separator, version = requirement.partition("==")
+        if not separator or not name or not version:
+            print(f"ERROR: Invalid requirement {requirement}, expected <name>==<version>", file=stderr)
+            exit(1)
+        packages.append((name, version))
+    with ThreadPoolExecutor(max_workers=max(1, len(packages))) as executor:
+        futures = [executor.submit(bootstrap, name, version) for name, version in packages]
+        entries = []
+        failed = False
+        for (name, version), future in zip(packages, futures):
+            try:
+                entry = future.result()
+            except BootstrapError as e:
+                print("ERROR: Unable to bootstrap {} {}: {}".format(name, version, e), file=stderr)
+                failed = True
+                continue
+            if entry is not None:
+                entries.append(entry)
+    if failed:
         exit(1)
+    print(':'.join(entries))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,14 +1,22 @@
 from pathlib import Path
-from subprocess import run, PIPE, CalledProcessError, Popen
+from subprocess import PIPE, CalledProcessError, Popen
+import copy
 import json
-from urllib.request import urlopen
 import shutil
+import sys
 from argh import CommandError
 import hashlib
-from typing import Iterable, Mapping, List
-import glob
+import re
+import time
+from threading import Event, Lock, Thread
+from typing import Iterable, Mapping, List, Dict, Optional
 from itertools import zip_longest
 from diffutils import parse_unified_diff
+from diffutils.api import PatchFailedException
+from .download import default_manager, DownloadError
+from .fileio import read_lines, write_bytes, decode_lines, newline_style
+from . import locking, metrics
+from .metrics import run, track_command
 import os
 
 def _determine_root_dir():
@@ -34,80 +42,79 @@ def _determine_root_dir():
             location = location.parent
 
 def regenerate_unmapped_sources(regenerate_unfixed=False, respect_blacklist=True):
-    unfixed_sources = Path(WORK_DIR, "unfixed")
+    from .stages import stage_tree
+    require_detected_version("apply the decompile blacklist and fixes")
+    unfixed_sources = stage_tree("unfixed")
     if regenerate_unfixed or not unfixed_sources.exists():
         regenerate_unfixed_sources()
-    unmapped_sources = Path(WORK_DIR, "unmapped")
-    unfixed_nms_sources = Path(unfixed_sources, "net/minecraft/server")
-    unmapped_nms_sources = Path(unmapped_sources, "net/minecraft/server")
-    if unmapped_sources.exists():
-        print("---- Removing existing unmapped sources")
-        shutil.rmtree(unmapped_sources)
-    print("---- Copying unmapped files")
-    shutil.copytree(unfixed_sources, unmapped_sources)
+    unmapped_sources = stage_tree("unmapped")
     blacklist = decompile_blacklist() if respect_blacklist else ()
-    removed_files = 0
-    for path in unmapped_nms_sources.iterdir():
-        if path.stem in blacklist:
-            removed_files += 1
-            os.remove(path)
-    if removed_files:
-        print(f"Removed {removed_files} blacklisted files")
-    print("---- Applying compile fixes")
-    fixes = Path(ROOT_DIR, "buildData/fixes")
-    for fix in fixes.iterdir():
-        patch = parse_unified_diff(read_file(fix))
-        original_file = Path(unfixed_nms_sources, fix.stem)
-        fixed_file = Path(unmapped_nms_sources, fix.stem)
-        print(f"Applying fix to {fix.stem}")
-        original_lines = read_file(original_file)
-        revised_lines = patch.apply_to(original_lines)
-        write_file(fixed_file, revised_lines)
-
-def read_file(path):
-    result = []
-    with open(path) as f:
-        for line in f.readlines():
-            result.append(line.rstrip("\r\n"))
-    return result
-
-def write_file(path, lines, override=True):
-    assert override, "unsupported"
-    with open(path, 'wt') as f:
-        for line in lines:
-            f.write(line)
-            f.write('\n')
+    fixes = {
+        f"net/minecraft/server/{fix.stem}": fix
+        for fix in Path(ROOT_DIR, "buildData/fixes").iterdir()
+    }
+    with unfixed_sources.lock(shared=True):
+        copied_files = []
+        fixed_files = []
+        removed_files = 0
+        for name in unfixed_sources.iter_files():
+            # NOTE: Fixes are applied even to blacklisted files
+            if name in fixes:
+                fixed_files.append(name)
+            elif name.startswith("net/minecraft/server/") and Path(name).stem in blacklist:
+                removed_files += 1
+            else:
+                copied_files.append(name)
+        missing_targets = sorted(set(fixes) - set(fixed_files))
+        if missing_targets:
+            raise CommandError(f"Missing the targets of fixes: {', '.join(missing_targets)}")
+        with metrics.stage("unmapped"), unmapped_sources.replace() as writer:
+            print("---- Copying unmapped files")
+            writer.copy_from(unfixed_sources, copied_files)
+            if removed_files:
+                print(f"Removed {removed_files} blacklisted files")
+            print("---- Applying compile fixes")
+            for name in fixed_files:
+                fix = fixes[name]
+                patch = parse_unified_diff(read_lines(fix))
+                print(f"Applying fix to {fix.stem}")
+                original_data = unfixed_sources.read_bytes(name)
+                original_lines = decode_lines(original_data)
+                try:
+                    revised_lines = patch.apply_to(original_lines)
+                except PatchFailedException:
+                    metrics.PATCH_FAILURES.inc(kind="fix")
+                    raise
+                writer.write_lines(name, revised_lines, newline=newline_style(original_data))
+                metrics.record_files("patched")
 
 def regenerate_unfixed_sources():
-    unfixed_sources = Path(WORK_DIR, "unfixed")
-    decompiled_sources = Path(WORK_DIR, minecraft_version(), "decompiled")
-    if unmapped_sources.exists():
-        print("---- Removing existing unfixed sources")
-        shutil.rmtree(unmapped_sources)
+    from .stages import stage_tree, DirectoryTree
+    require_detected_version("copy the TacoSpigot sources")
+    unfixed_sources = stage_tree("unfixed")
+    decompiled_sources = stage_tree("decompiled")
     server_repo = Path(Path.cwd(), "TacoSpigot", "TacoSpigot-Server")
     if not server_repo.exists():
         raise CommandError("Couldn't find TacoSpigot-Server")
-    tacospigot_sources = Path(server_repo, "src", "main", "java")
+    tacospigot_sources = DirectoryTree(Path(server_repo, "src", "main", "java"))
     if not tacospigot_sources.exists():
         raise CommandError("Couldn't find TacoSpigot sources!")
     mojang_sources = Path(PAPER_WORK_DIR, minecraft_version())
     if not mojang_sources.exists():
         raise CommandError("Couldn't find mojang sources!")
-    print("---- Copying original sources from TacoSpigot")
-    shutil.copytree(tacospigot_sources, unfixed_sources)
-    # Copy the decompiled sources that aren't already in TacoSpigot
-    # This makes it so we don't have to depend on the mojang server fat jar,
-    # giving us complete control over our dependencies.
-    # Make sure to use the ones decompiled with forge fernflower, or they won't work
-    print("---- Copying remaining sources from forge fernflower decompiled mojang jar")
-    decompiled_nms_sources = Path(decompiled_sources, "net/minecraft/server")
-    unfixed_nms_sources = Path(unfixed_sources, "net/minecraft/server")
-    assert decompiled_nms_sources.exists()
-    for f in decompiled_nms_sources.iterdir():
-        assert not f.is_dir(), f"Unexpected directory: {f}"
-        unfixed_file = Path(unfixed_sources, f.name)
-        if not unfixed_file.exists():
-            shutil.copy2(f, unfixed_file)
+    assert decompiled_sources.exists(), f"Missing decompiled sources: {decompiled_sources}"
+    with decompiled_sources.lock(shared=True), metrics.stage("unfixed"), unfixed_sources.replace() as writer:
+        print("---- Copying original sources from TacoSpigot")
+        writer.copy_from(tacospigot_sources)
+        # Copy the decompiled sources that aren't already in TacoSpigot
+        # This makes it so we don't have to depend on the mojang server fat jar,
+        # giving us complete control over our dependencies.
+        # Make sure to use the ones decompiled with forge fernflower, or they won't work
+        print("---- Copying remaining sources from forge fernflower decompiled mojang jar")
+        writer.copy_from(decompiled_sources, [
+            name for name in decompiled_sources.iter_files("net/minecraft/server")
+            if not tacospigot_sources.contains(name)
+        ])
 
 ROOT_DIR = _determine_root_dir().absolute()
 WORK_DIR = Path(ROOT_DIR, "work")
@@ -118,38 +125,27 @@ MAVEN_REPOSITORIES = {
     "forge": "https://files.minecraftforge.net/maven",
     "eclipse": "https://repo.eclipse.org/content/groups/eclipse/"
 }
-SUPERSRG_VERSION = "0.1.0"
-_supersrg_jar = None
 def supersrg_jar() -> Path:
-    global _supersrg_jar
-    result = _supersrg_jar
-    if result is not None:
-        return result
-    dev_jar = Path(WORK_DIR, "jars", "SuperSrg-dev.jar")
-    if dev_jar.exists() and os.getenv("SUPERSRG_DEV") not in (None, "0"):
-        result = dev_jar
-    else:
-        raise AssertionError("TODO: Download SuperSrg jar")
-    _supersrg_jar = result
-    return result
-_supersrg_binary = None
+    from .tools import resolve
+    return resolve("superSrg")
+
+
 def supersrg_binary() -> Path:
-    global _supersrg_binary
-    result = _supersrg_binary
-    if result is not None:
-        return result
-    dev_binary = Path(WORK_DIR, "bin", "supersrg-dev")
-    if dev_binary.exists() and os.getenv("SUPERSRG_DEV") not in (None, "0"):
-        result = dev_binary
-    else:
-        raise AssertionError("TODO: Download SuperSrg binary")
-    _supersrg_binary = result
-    return result
+    from .tools import resolve
+    return resolve("superSrgBinary")
+
+
+def forgeflower_jar() -> Path:
+    from .tools import resolve
+    return resolve("forgeFlower")
+
+
+def specialsource_jar() -> Path:
+    from .tools import resolve
+    return resolve("specialSource")
+
 
 LOCAL_REPOSITORY = Path(Path.home(), ".m2", "repository")
-FORGE_FERNFLOWER_COMMIT = "32a04b9"
-FORGE_FERNFLOWER_REMOTE = "https://github.com/MinecraftForge/ForgeFlower.git"
-FORGE_FERNFLOWER_JAR = Path(WORK_DIR, "jars", f"forge-fernflower-{FORGE_FERNFLOWER_COMMIT}.jar")
 FERNFLOWER_OPTIONS = {
     "din": True,  # Decompile inner classes
     "dgs": True,  # Decompile generic signatures
@@ -158,9 +154,6 @@ FERNFLOWER_OPTIONS = {
     "rbr": True,  # Remove bridge members
     "udv": False  # Ignore variable names, since they lie
 }
-SPECIALSOURCE_BUILD = 112
-SPECIALSOURCE_URL = f"https://ci.md-5.net/job/SpecialSource/{SPECIALSOURCE_BUILD}/artifact/target/SpecialSource-1.7.5-SNAPSHOT-shaded.jar"
-SPECIALSOURCE_JAR = Path(WORK_DIR, "jars", f"SpecialSource-{SPECIALSOURCE_BUILD}.jar")
 _cached_decompile_blacklist = None
 def decompile_blacklist():
     """Classes that are broken even with the improved fernflower decompiler"""
@@ -178,32 +171,39 @@ def decompile_blacklist():
     _cached_decompile_blacklist = result
     return result
 
-def compile_forgeflower(commit=FORGE_FERNFLOWER_COMMIT):
-    result_jar = Path(WORK_DIR, "jars", f"forge-fernflower-{commit}.jar")
-    assert not result_jar.exists(), f"Jar already exists: {result_jar}"
-    fernflower_repo = Path(WORK_DIR, "ForgeFlower")
-    if not fernflower_repo.exists():
-        run(["git", "clone", "https://github.com/MinecraftForge/ForgeFlower.git", str(fernflower_repo)], check=True)
-    else:
-        try:
-            # See if we already have the commit
-            run(["git", "rev-parse", commit], cwd=fernflower_repo, check=True)
-        except CalledProcessError:
-            run(["git", "fetch", "https://github.com/MinecraftForge/ForgeFlower.git", "master"], cwd=fernflower_repo, check=True)
-    run(["git", "reset", "--hard", commit], cwd=fernflower_repo, check=True)
-    run(["git", "submodule", "update", "--recursive", "--init"], cwd=fernflower_repo)
-    run(["bash", "gradlew", "clean", "build", "--no-daemon", "-x", "test"], cwd=fernflower_repo, check=True)
-    compiled_jars = glob.glob("work/ForgeFlower/ForgeFlower/build/libs/forgeflower-*.jar")
-    assert len(compiled_jars) == 1, f"Unexpected compiled jars: {compiled_jars}"
-    shutil.copy2(compiled_jars[0], result_jar)
+class DecompileTimeout(Exception):
+    """Raised when fernflower spends longer than its budget on a single class"""
+
+    def __init__(self, class_name: str, elapsed: float, timings: Dict[str, float]):
+        super().__init__(f"Timed out decompiling {class_name} after {elapsed:.0f} seconds")
+        self.class_name = class_name
+        self.elapsed = elapsed
+        self.timings = timings
 
 
-def run_fernflower(classes: Path, output: Path, libraries=[], verbose=True, options=FERNFLOWER_OPTIONS):
-    assert classes.is_dir(), f"Classes don't exist: {classes}"
+# Fernflower logs when it starts and finishes each class
+_FERNFLOWER_CLASS_START = re.compile(r"Decompiling class (\S+)")
+_FERNFLOWER_CLASS_DONE = "... done"
+
+
+def run_fernflower(classes: Path, output: Path, libraries=[], verbose=True, options=FERNFLOWER_OPTIONS, class_timeout=None, decompiler=None) -> Dict[str, float]:
+    """
+    Decompile the classes with fernflower, returning how many seconds each class took.
+
+    :param class_timeout: kill fernflower if it spends more than this many seconds on a single class
+    :param decompiler: the fernflower jar to use, instead of our version of ForgeFlower
+    :exception DecompileTimeout: if a class took longer than the timeout
+    """
+    from .jvm import jvm_job
+    assert classes.exists(), f"Classes don't exist: {classes}"
     assert not output.exists(), f"Ouptut already exists: {output}"
-    assert FORGE_FERNFLOWER_JAR.exists(), f"Fernflower jar doesn't exist: {FORGE_FERNFLOWER_JAR}"
     output.mkdir(parents=True)
-    command = ["java", "-jar", str(FORGE_FERNFLOWER_JAR)]
+    with jvm_job("fernflower") as job:
+        return _run_fernflower(job, classes, output, libraries, options, verbose, class_timeout, decompiler or forgeflower_jar())
+
+
+def _run_fernflower(job, classes: Path, output: Path, libraries, options, verbose, class_timeout, decompiler: Path) -> Dict[str, float]:
+    command = job.java("-jar", str(decompiler))
     for key, value in options.items():
         if isinstance(value, bool):
             value = "1" if value else "0"
@@ -217,15 +217,46 @@ def run_fernflower(classes: Path, output: Path, libraries=[], verbose=True, opti
             raise TypeError(f"Unexpected library type: {type(library)}")
         command.append(f"-e={library}")
     command.extend((str(classes), str(output)))
+    timings = {}
+    current = None  # The class being decompiled, and when it started
+    timed_out = None
+    state_lock = Lock()
+    finished = Event()
     # NOTE: Use popen so we can output info while running
-    with Popen(command, encoding='utf-8', stdout=PIPE, stderr=PIPE) as proc:
-        while proc.poll() is None:
-            line = proc.stdout.readline().rstrip("\r\n")
-            print(line)
-        if proc.wait() != 0:
+    with track_command(command), Popen(command, encoding='utf-8', stdout=PIPE, stderr=PIPE) as proc:
+        def watchdog():
+            nonlocal timed_out
+            while not finished.wait(1):
+                with state_lock:
+                    if current is not None and time.monotonic() - current[1] > class_timeout:
+                        timed_out = (current[0], time.monotonic() - current[1])
+                        proc.kill()
+                        return
+        if class_timeout is not None:
+            Thread(target=watchdog, daemon=True).start()
+        try:
+            for line in proc.stdout:
+                line = line.rstrip("\r\n")
+                if verbose:
+                    print(line)
+                match = _FERNFLOWER_CLASS_START.search(line)
+                with state_lock:
+                    if match is not None:
+                        current = (match.group(1), time.monotonic())
+                    elif _FERNFLOWER_CLASS_DONE in line and current is not None:
+                        timings[current[0]] = time.monotonic() - current[1]
+                        current = None
+        finally:
+            finished.set()
+        returncode = job.wait(proc)
+        if timed_out is not None:
+            shutil.rmtree(output)  # Cleanup partial output
+            raise DecompileTimeout(timed_out[0], timed_out[1], timings)
+        if returncode != 0:
             error_message = proc.stderr.read().splitlines()
             shutil.rmtree(output)  # Cleanup partial output
             raise CommandError(["Error running fernflower:", *error_message])
+    return timings
 
 
 _current_tacospigot_commit = None
@@ -243,14 +274,16 @@ def current_tacospigot_commit() -> str:
     return result
 
 
-def download_file(target: Path, url: str):
-    with urlopen(url) as r:
-        target.parent.mkdir(exist_ok=True, parents=True)
-        with open(target, 'wb') as f:
-            shutil.copyfileobj(r, f)
+def download_file(target: Path, url: str, sha1=None, sha256=None, conditional=False) -> bool:
+    """Download the url to the target file, returning if anything new was downloaded"""
+    try:
+        return default_manager().download(url, target, sha1=sha1, sha256=sha256, conditional=conditional)
+    except DownloadError as e:
+        raise CommandError(str(e)) from None
 
 
 def resolve_maven_dependenices(dependencies, repos=MAVEN_REPOSITORIES):
+    from .jvm import jvm_job
     classpath = []
     remotes = ",".join(f"{name}::default::{url}" for name, url in repos.items())
     for dependency in dependencies:
@@ -265,7 +298,8 @@ def resolve_maven_dependenices(dependencies, repos=MAVEN_REPOSITORIES):
                            f"-DgroupId={groupId}", f"-DartifactId={artifactId}",
                            f"-Dversion={version}", f"-DremoteRepositories={remotes}"
                            ]
-                run(command, check=True)
+                with jvm_job("maven") as job:
+                    job.run(command, check=True, env=job.environment())
                 if not expected_location.exists():
                     raise CommandError(f"Unable to download {dependency} to {expected_location}")
             except CalledProcessError:
@@ -276,21 +310,67 @@ def resolve_maven_dependenices(dependencies, repos=MAVEN_REPOSITORIES):
 
 
 _minecraft_version = None
+_detected_minecraft_version = None
 
 
-def minecraft_version() -> str:
-    global _minecraft_version
-    if _minecraft_version is not None:
-        return _minecraft_version
+def detected_minecraft_version() -> Optional[str]:
+    """The minecraft version TacoSpigot is currently built for, or None if Paper hasn't been setup yet"""
+    global _detected_minecraft_version
+    if _detected_minecraft_version is not None:
+        return _detected_minecraft_version
     build_data_info = Path(PAPER_WORK_DIR, "BuildData", "info.json")
-    assert build_data_info.exists(), f"Can't find BuildData info.json: {build_data_info}"
+    if not build_data_info.exists():
+        return None
     with open(build_data_info, 'rt') as f:
         info = json.load(f)
     version = info['minecraftVersion']
-    _minecraft_version = version  # Cache
+    _detected_minecraft_version = version  # Cache
     return version
 
 
+def select_minecraft_version(version: Optional[str]):
+    """Select the minecraft version whose workspace we use, instead of the one TacoSpigot is built for"""
+    global _minecraft_version
+    if version is not None:
+        _minecraft_version = version
+
+
+def minecraft_version() -> str:
+    if _minecraft_version is not None:
+        return _minecraft_version
+    version = detected_minecraft_version()
+    assert version is not None, f"Can't find BuildData info.json in {PAPER_WORK_DIR}"
+    return version
+
+
+def require_detected_version(purpose: str):
+    """
+    Refuse to use the TacoSpigot checkout (like its sources, blacklist or fixes) for another minecraft version.
+
+    Those inputs aren't per-version yet, so using them would mix the versions.
+    """
+    if _minecraft_version is None:
+        return  # Using the version TacoSpigot is built for
+    version = minecraft_version()
+    detected = detected_minecraft_version()
+    if version != detected:
+        checkout = f"built for {detected}" if detected is not None else "not setup yet"
+        raise CommandError(f"Unable to {purpose} for {version}, since the TacoSpigot checkout is {checkout}")
+
+
+def version_work_dir(version=None) -> Path:
+    """The directory holding all the stages and caches specific to the minecraft version"""
+    return Path(WORK_DIR, version or minecraft_version())
+
+
+def patched_location(version=None) -> Path:
+    """The patched sources for the version, which are only in 'patched' for the version TacoSpigot is built for"""
+    version = version or minecraft_version()
+    if version == detected_minecraft_version():
+        return Path(ROOT_DIR, "patched")
+    return Path(ROOT_DIR, f"patched-{version}")
+
+
 def hash_file(location, algorithm='sha256'):
     try:
         h = getattr(hashlib, algorithm)()
@@ -307,6 +387,13 @@ def hash_file(location, algorithm='sha256'):
             h.update(view[:numRead])
 
 
+def files_identical(first, second, algorithm='sha256') -> bool:
+    """Check if both files have identical bytes, comparing their sizes before bothering to hash them"""
+    if os.stat(first).st_size != os.stat(second).st_size:
+        return False
+    return hash_file(first, algorithm) == hash_file(second, algorithm)
+
+
 def grouper(iterable, n, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
     # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
@@ -324,13 +411,8 @@ def secure_hash(target, algorithm='sha256'):
             h.update(target)
         elif isinstance(target, str):
             h.update(target.encode('utf-8'))
-        elif isinstance(target, Iterable):
-            target = tuple(target)
-            h.update(b'\0')
-            for element in target:
-                update_hash(target)
-                h.update(b'\0')
         elif isinstance(target, Mapping):
+            # NOTE: Check for mappings first, since they're iterable too
             target = dict(target)
             h.update(b'\0')
             for key, value in target.items():
@@ -338,6 +420,12 @@ def secure_hash(target, algorithm='sha256'):
                 h.update(b'\0')
                 update_hash(value)
                 h.update(b'\0')
+        elif isinstance(target, Iterable):
+            target = tuple(target)
+            h.update(b'\0')
+            for element in target:
+                update_hash(element)
+                h.update(b'\0')
         else:
             raise TypeError(f"Unsupported type: {type(target)}")
     update_hash(target)
@@ -358,15 +446,31 @@ def configuration():
     _configuration = result
     return result.copy()
 
+
+def reset_command_state():
+    """
+    Forget everything cached by the last command which may have gone stale since, like the current TacoSpigot commit.
+
+    This is only needed by long-lived processes (like the daemon) which run several commands.
+    """
+    global _current_tacospigot_commit, _minecraft_version, _detected_minecraft_version, \
+        _configuration, _cached_decompile_blacklist
+    _current_tacospigot_commit = None
+    _minecraft_version = None
+    _detected_minecraft_version = None
+    _configuration = None
+    _cached_decompile_blacklist = None
+
 class CacheInfo:
-    rangeMapCommit: str
+    rangeMapCommits: Dict[str, str]
     lastBuiltTacoSpigot: str
     bukkitClasspath: List[str]
     bukkitClasspathCommit: str
     tacospigotUnshadedCommit: str
 
     def __init__(self, **kwargs):
-        self.rangeMapCommit = kwargs.get('rangeMap.commit')
+        # NOTE: Each minecraft version has its own range map
+        self.rangeMapCommits = dict(kwargs.get('rangeMap.commits', {}))
         self.lastBuiltTacoSpigot = kwargs.get('tacospigot.lastBuild')
         bukkitClasspath = kwargs.get('bukkitClasspath')
         self.tacospigotUnshadedCommit = kwargs.get('tacospigot.unshadedCommit')
@@ -376,11 +480,13 @@ class CacheInfo:
         else:
             self.bukkitClasspathCommit = None
             self.bukkitClasspath = None
+        # What we were loaded from, so we only save the entries we actually changed
+        self._original = self.serialize()
 
     def serialize(self):
         result = {}
-        if self.rangeMapCommit is not None:
-            result["rangeMap.commit"] = self.rangeMapCommit
+        if self.rangeMapCommits:
+            result["rangeMap.commits"] = self.rangeMapCommits
         if self.lastBuiltTacoSpigot is not None:
             result['tacospigot.lastBuild'] = self.lastBuiltTacoSpigot
         if self.tacospigotUnshadedCommit is not None:
@@ -394,28 +500,65 @@ class CacheInfo:
         return result
 
     def save(self):
-        data = self.serialize()
-        CacheInfo._CACHED_DATA = None
-        with open(CacheInfo.LOCATION, 'wt') as f:
+        """
+        Merge our changes into the cache info file.
+
+        Other processes may have saved their own changes since we were loaded,
+        so the file is reread under a lock and only the entries we changed are overwritten.
+        """
+        changes = self.serialize()
+        with locking.hold(CacheInfo.LOCK_LOCATION):
+            data = CacheInfo._read()
+            _merge_changes(data, self._original, changes)
             # NOTE: Pretty print so the humans can see our beautiful cache info
-            json.dump(data, f, sort_keys=True, indent=4)
-            CacheInfo._CACHED_DATA = data.copy()
+            write_bytes(CacheInfo.LOCATION, json.dumps(data, sort_keys=True, indent=4).encode('utf-8'))
+        self._original = changes
+        CacheInfo._CACHED_DATA = None
 
 
     _CACHED_DATA = None
     LOCATION = Path(WORK_DIR, "cache-info.json")
+    LOCK_LOCATION = Path(WORK_DIR, ".locks", "cache-info.lock")
+
+    @staticmethod
+    def _read() -> dict:
+        try:
+            with open(CacheInfo.LOCATION, "rt") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # NOTE: Older versions rewrote the file in place, so a concurrent build could've left it truncated
+            print(f"WARNING: Ignoring corrupted {CacheInfo.LOCATION}", file=sys.stderr)
+            return {}
 
     @staticmethod
     def load() -> "CacheInfo":
-        data = CacheInfo._CACHED_DATA
-        if data is None:
-            try:
-                with open(CacheInfo.LOCATION, "rt") as f:
-                    data = json.load(f)
-            except FileNotFoundError:
-                data = {}
-            CacheInfo._CACHED_DATA = data
-        return CacheInfo(**data)
+        # NOTE: The file is always atomically replaced, so a new inode or mtime means another process saved it
+        try:
+            stat = os.stat(CacheInfo.LOCATION)
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            key = None
+        cached = CacheInfo._CACHED_DATA
+        if cached is None or cached[0] != key:
+            cached = CacheInfo._CACHED_DATA = (key, CacheInfo._read())
+        return CacheInfo(**copy.deepcopy(cached[1]))
+
+
+def _merge_changes(current: dict, original: dict, changed: dict):
+    """Apply the changes between the original and changed data to the current data, merging nested objects"""
+    for key in original.keys() | changed.keys():
+        if key not in changed:
+            current.pop(key, None)
+            continue
+        old_value, new_value = original.get(key), changed[key]
+        if new_value == old_value:
+            continue
+        if isinstance(new_value, dict) and isinstance(current.get(key), dict):
+            _merge_changes(current[key], old_value if isinstance(old_value, dict) else {}, new_value)
+        else:
+            current[key] = new_value
 
 
 
@@ -1,25 +1,40 @@
 import shutil
 from pathlib import Path
-from subprocess import CalledProcessError, Popen, run, PIPE, STDOUT, DEVNULL
+from subprocess import CalledProcessError, Popen, PIPE, STDOUT, DEVNULL
 from diffutils.api import PatchFailedException, parse_unified_diff
 from diffutils.engine import DiffEngine
 from diffutils.output import generate_unified_diff
 import os
 import sys
-from sys import stderr, stdout
 from collections import namedtuple
 import platform
 import json
 import re
-from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from argh import CommandError, wrap_errors, arg, ArghParser
 
 from . import WORK_DIR, ROOT_DIR, PAPER_WORK_DIR, minecraft_version,\
     resolve_maven_dependenices, CacheInfo,\
-    compile_forgeflower, FORGE_FERNFLOWER_JAR, download_file, run_fernflower,\
+    download_file,\
     current_tacospigot_commit, decompile_blacklist, regenerate_unmapped_sources,\
-    supersrg_jar, supersrg_binary, configuration
+    supersrg_jar, supersrg_binary, configuration, select_minecraft_version, version_work_dir, patched_location,\
+    require_detected_version
+from . import metrics
+from .metrics import run, track_command, dispatch_with_metrics
+from .artifacts import cached_artifact
+from .jvm import jvm_job
+from .decompile import decompile_sources
+from .tacospigot import TACOSPIGOT_JAR, build_tacospigot
+from . import tools
+from .fileio import read_bytes, read_lines, write_bytes, write_lines, decode_lines, encode_lines, newline_style
+from .stages import stage_tree, patched_lock, SourceTree, DirectoryTree
+from .fingerprint import fingerprint
+from .patching import check_patch, hunk_status, iter_patch_files, apply_located, DEFAULT_MAX_FUZZ
+from .diffing import LineInterner, diff_lines
+from .impact import PatchIndex, analyze_impact
+from . import upstream
+from . import distributed, jvm
 from .classpath import tacospigot_classpath, print_server_classpath, print_bukkit_classpath, unshaded_tacospigot
 
 def handle_exc(e):
@@ -33,130 +48,134 @@ def handle_exc(e):
 
 @wrap_errors([CalledProcessError], processor=handle_exc)
 @arg('--verbose', '-v', help="Give verbose remapping output")
-def remap_source(verbose=False):
+@arg('--mc-version', help="The minecraft version to use, instead of the one TacoSpigot is built for")
+def remap_source(verbose=False, mc_version=None):
     """Remap the original sources with Srg2Source"""
-    unpatched_sources = Path(WORK_DIR, "unpatched")
-    unmapped_sources = Path(WORK_DIR, "unmapped")
-    decompiled_sources = Path(WORK_DIR, minecraft_version(), "decompiled")
+    select_minecraft_version(mc_version)
+    require_detected_version("remap the sources")
+    unpatched_sources = stage_tree("unpatched")
+    unmapped_sources = stage_tree("unmapped")
+    decompiled_sources = stage_tree("decompiled")
     if not decompiled_sources.exists():
         raise CommandError(f"Couldn't find decompiled sources for {minecraft_version()}")
-    if unmapped_sources.exists():
-        print("---- Reusing cached unmapped sources")
-        num_removed = 0
-        for ignored in decompile_blacklist():
-            ignored_file = Path(unmapped_sources, "net/minecraft/server", f"{ignored}.java")
-            if ignored_file.exists():
-                num_removed += 1
-                os.remove(ignored_file)
-        if num_removed:
-            print(f"Removed {num_removed} blacklisted files")
-    else:
-        regenerate_unmapped_sources()
-    version = minecraft_version()
-    #  print("---- Downloading Srg2Source's dependencies")
-    #  srg2source_classpath = resolve_maven_dependenices(SRG2SOURCE_DEPENDENCIES)
-    if unpatched_sources.exists():
-        print("---- Deleting existing unpatched sources")
-        shutil.rmtree(unpatched_sources)
-    #  print("---- Copying unmapped sources to unpatched directory")
-    #  shutil.copytree(unmapped_sources, unpatched_sources)
-    cacheInfo = CacheInfo.load()
-    current_commit = current_tacospigot_commit()
-    range_map = Path(WORK_DIR, "rangeMap.dat")
-    # TODO: Actually download SuperSrg instead of using hardcoded paths
-    # This isn't possible right now since it's currently unreleased
-    if cacheInfo.rangeMapCommit == current_commit and range_map.exists():
-        print("Using cached SuperSrg rangeMap")
-    else:
-        print("---- Regenerating SuperSrg rangeMap")
-        if range_map.exists():
-            os.remove(range_map)
-        proc = Popen([
-            "java",
-            "-cp",
-            str(supersrg_jar()),
-            "net.techcable.supersrg.RangeExtractor",
-            "-cp",
-            ':'.join(str(p) for p in tacospigot_classpath()),
-            str(unmapped_sources),
-            str(range_map)
-        ], stdout=PIPE, stderr=PIPE, encoding='utf-8')
-        while proc.poll() is None:
-            line = proc.stdout.readline().rstrip("\r\n")
-            print(line)
-        # NOTE: Unlike we Srg2Source we actually fail fast
-        if proc.wait() != 0:
-            print("Error computing rangemaps:", file=stderr)
-            for line in proc.stderr.read().splitlines():
-                print(line, file=stderr)
-            raise CommandError("Error computing rangemaps!")
-        cacheInfo.rangeMapCommit = current_commit
-        cacheInfo.save()
-    try:
-        mcp_version = configuration()['mcpVersion']
-    except KeyError:
-        raise CommandError("MCP version not specified!")
-    mappings_file = Path(WORK_DIR, f"mappings/spigot2mcp-onlyobf-{mcp_version}.srg.dat")
-    supersrg_mappings_cache = Path(WORK_DIR, "mappings/cache")
-    if not mappings_file.exists():
-        print(f"---- Regenerating spigot2mcp mappings for {mcp_version}")
-        output_file = Path(WORK_DIR, "mappings/cache/spigot2mcp-onlyobf.srg.dat")
-        if output_file.exists():
-            os.remove(output_file)
-        try:
-            run([str(supersrg_binary()), "generate_minecraft", "--mcp", mcp_version, version, str(supersrg_mappings_cache), "spigot2mcp-onlyobf"], check=True)
-        except CalledProcessError:
-            raise CommandError("Error regenerating mappings")
-        shutil.copy2(output_file, mappings_file)
-    print("---- Applying SuperSrg mappings")
-    proc = run([
-        str(supersrg_binary()),
-        "apply_range",
-        str(range_map),
-        str(mappings_file),
-        str(unmapped_sources),
-        str(unpatched_sources)
-    ], env={"RUST_BACKTRACE": "1"}, check=True, encoding='utf-8')
-
-
-def decompile_sources(version, jar_file: Path):
-    decompiled_dir = Path(WORK_DIR, version, "decompiled")
-    class_files = Path(WORK_DIR, version, "bin")
-    if not decompiled_dir.exists():
-        if not class_files.exists():
-            print(f"---- Extracting {version} class files")
-            with ZipFile(str(jar_file), "r") as jar:
-                members = [name for name in jar.namelist() if "net/minecraft/server" in name]
-                jar.extractall(str(class_files), members)
-        print(f"---- Decompiling {version} class files")
-        run_fernflower(class_files, decompiled_dir)
-    return decompiled_dir
+    with unmapped_sources.lock(), unpatched_sources.lock():
+        if unmapped_sources.exists():
+            print("---- Reusing cached unmapped sources")
+            ignored_files = [
+                f"net/minecraft/server/{ignored}.java" for ignored in decompile_blacklist()
+                if unmapped_sources.contains(f"net/minecraft/server/{ignored}.java")
+            ]
+            unmapped_sources.remove_files(ignored_files)
+            if ignored_files:
+                print(f"Removed {len(ignored_files)} blacklisted files")
+        else:
+            regenerate_unmapped_sources()
+        version = minecraft_version()
+        #  print("---- Downloading Srg2Source's dependencies")
+        #  srg2source_classpath = resolve_maven_dependenices(SRG2SOURCE_DEPENDENCIES)
+        #  print("---- Copying unmapped sources to unpatched directory")
+        #  shutil.copytree(unmapped_sources, unpatched_sources)
+        cacheInfo = CacheInfo.load()
+        current_commit = current_tacospigot_commit()
+        range_map = Path(version_work_dir(version), "rangeMap.dat")
+        # TODO: Actually download SuperSrg instead of using hardcoded paths
+        # This isn't possible right now since it's currently unreleased
+        range_map_cached = cacheInfo.rangeMapCommits.get(version) == current_commit and range_map.exists()
+        metrics.cache_lookup("rangeMap.commits", range_map_cached)
+        if range_map_cached:
+            print("Using cached SuperSrg rangeMap")
+        else:
+            print("---- Regenerating SuperSrg rangeMap")
+            if range_map.exists():
+                os.remove(range_map)
+
+            def extract_ranges():
+                with metrics.stage("rangeMap"), unmapped_sources.materialize() as unmapped_dir, jvm_job("rangeExtractor") as job:
+                    command = job.java(
+                        "-cp",
+                        str(supersrg_jar()),
+                        "net.techcable.supersrg.RangeExtractor",
+                        "-cp",
+                        ':'.join(str(p) for p in tacospigot_classpath()),
+                        str(unmapped_dir),
+                        str(range_map)
+                    )
+                    with track_command(command), Popen(command, stdout=PIPE, stderr=PIPE, encoding='utf-8') as proc:
+                        for line in proc.stdout:
+                            print(line.rstrip("\r\n"))
+                        # NOTE: Unlike we Srg2Source we actually fail fast
+                        if job.wait(proc) != 0:
+                            print("Error computing rangemaps:", file=sys.stderr)
+                            for line in proc.stderr.read().splitlines():
+                                print(line, file=sys.stderr)
+                            raise CommandError("Error computing rangemaps!")
+            range_map_inputs = (
+                fingerprint(unmapped_sources.location).hex(),
+                [fingerprint(p).hex() for p in tacospigot_classpath()],
+                fingerprint(supersrg_jar()).hex()
+            )
+            cached_artifact("rangeMap", range_map_inputs, range_map, extract_ranges)
+            cacheInfo.rangeMapCommits[version] = current_commit
+            cacheInfo.save()
+        config = configuration()
+        # NOTE: Other versions can specify their own MCP versions, falling back to the main one
+        mcp_version = config.get("mcpVersions", {}).get(version) or config.get("mcpVersion")
+        if mcp_version is None:
+            raise CommandError(f"MCP version not specified for {version}!")
+        mappings_file = Path(WORK_DIR, f"mappings/spigot2mcp-onlyobf-{version}-{mcp_version}.srg.dat")
+        supersrg_mappings_cache = Path(WORK_DIR, "mappings/cache", version)
+        if not mappings_file.exists():
+            def generate_mappings():
+                print(f"---- Regenerating spigot2mcp mappings for {mcp_version}")
+                output_file = Path(supersrg_mappings_cache, "spigot2mcp-onlyobf.srg.dat")
+                if output_file.exists():
+                    os.remove(output_file)
+                try:
+                    with metrics.stage("mappings"):
+                        run([str(supersrg_binary()), "generate_minecraft", "--mcp", mcp_version, version, str(supersrg_mappings_cache), "spigot2mcp-onlyobf"], check=True)
+                except CalledProcessError:
+                    raise CommandError("Error regenerating mappings")
+                shutil.copy2(output_file, mappings_file)
+            mappings_inputs = (mcp_version, version, fingerprint(supersrg_binary()).hex())
+            cached_artifact("spigot2mcp", mappings_inputs, mappings_file, generate_mappings)
+        print("---- Applying SuperSrg mappings")
+        with metrics.stage("applyRange"), unmapped_sources.materialize() as unmapped_dir, unpatched_sources.replace() as writer:
+            proc = run([
+                str(supersrg_binary()),
+                "apply_range",
+                str(range_map),
+                str(mappings_file),
+                str(unmapped_dir),
+                str(writer.directory)
+            ], env={"RUST_BACKTRACE": "1"}, check=True, encoding='utf-8')
 
 
 @wrap_errors([CalledProcessError], processor=handle_exc)
 @arg('--force', help="Forcibly rebuild TacoSpigot")
-def setup(force=False):
+@arg('--mc-version', help="The minecraft version to use, instead of the one TacoSpigot is built for")
+def setup(force=False, mc_version=None):
     """Setup the development environment, re-applying all the Paper and TacoSpigot patches."""
-    unshaded_tacospigot()
+    select_minecraft_version(mc_version)
+    require_detected_version("setup the sources")
     WORK_DIR.mkdir(exist_ok=True)
     repository = Path(ROOT_DIR, "TacoSpigot")
     if not repository.exists():
         raise CommandError("TacoSpigot repository not found!")
-    tacospigot_jar = Path(repository, "build", "TacoSpigot-illegal.jar")
-    cacheInfo = CacheInfo() if force else CacheInfo.load()
-    current_commit = current_tacospigot_commit()
-    if tacospigot_jar.exists() and cacheInfo.lastBuiltTacoSpigot == current_commit:
-        print("Reusing cached TacoSpigot jar")
-    else:
-        print("---- Cleaning TacoSpigot")
-        run(["bash", "clean.sh"], cwd=repository, check=True)
-        print("---- Compiling TacoSpigot")
-        run(["bash", "build-illegal.sh"], cwd=repository, check=True)
-        cacheInfo.lastBuiltTacoSpigot = current_commit
-        cacheInfo.save()
-    if not FORGE_FERNFLOWER_JAR.exists():
-        print("---- Compiling forge fernflower")
-        compile_forgeflower()
+    # NOTE: Provision the tools in the background, while TacoSpigot is built
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        provisioned_tools = executor.submit(tools.resolve_all, tools.SETUP_TOOLS)
+        cacheInfo = CacheInfo() if force else CacheInfo.load()
+        current_commit = current_tacospigot_commit()
+        if cacheInfo.lastBuiltTacoSpigot != current_commit or not TACOSPIGOT_JAR.exists():
+            build_tacospigot(cacheInfo.lastBuiltTacoSpigot, current_commit)
+            cacheInfo.lastBuiltTacoSpigot = current_commit
+            cacheInfo.save()
+        else:
+            metrics.cache_lookup("tacospigot.lastBuild", True)
+            print("Reusing cached TacoSpigot jar")
+        provisioned_tools.result()
+    # NOTE: This needs the TacoSpigot jar, so it has to happen after it's built
+    unshaded_tacospigot()
     version = minecraft_version()
     mojang_jar = Path(PAPER_WORK_DIR, version, f"{version}-mapped.jar")
     if not mojang_jar.exists():
@@ -171,9 +190,12 @@ def clean(clean_all=False):
     """Remove various cache directories, which may get corrupted"""
     print("---- Cleaning TacoFountain")
     targets = [
-        "patched", "work/versions", "work/unmapped","work/unfixed" "work/unpatched", "TacoSpigot/build",
-        "work/spoon-cache"
+        "patched", "work/versions", "work/unmapped", "work/unfixed", "work/unpatched", "TacoSpigot/build",
+        "work/spoon-cache", "work/unmapped.zip", "work/unfixed.zip", "work/unpatched.zip"
     ]
+    # The workspaces of each version
+    for pattern in ("patched-*", "work/*/unmapped*", "work/*/unfixed*", "work/*/unpatched*"):
+        targets.extend(str(path.relative_to(ROOT_DIR)) for path in ROOT_DIR.glob(pattern))
     if clean_all:
         targets.append(str(CacheInfo.LOCATION))
     for target in targets:
@@ -185,25 +207,27 @@ def clean(clean_all=False):
     print("---- Cleaning TacoSpigot")
     run(["bash", "clean.sh"], cwd=Path(ROOT_DIR, "TacoSpigot"), check=True)
     if clean_all:
-        range_map = Path(WORK_DIR, "rangeMap.dat")
-        if range_map.exists():
-            print("---- Cleaning SuperSrg rangeMap")
-            os.remove(range_map)
+        range_maps = [Path(WORK_DIR, "rangeMap.dat"), *WORK_DIR.glob("*/rangeMap.dat")]
+        for range_map in range_maps:
+            if range_map.exists():
+                print(f"---- Cleaning SuperSrg rangeMap {range_map.relative_to(WORK_DIR)}")
+                os.remove(range_map)
 
 
 PatchSetup = namedtuple("PatchSetup", ["patches", "unpatched_sources", "patched_sources"])
 
 
 def setup_patching() -> PatchSetup:
-    unpatched_sources = Path(WORK_DIR, "unpatched")
+    unpatched_sources = stage_tree("unpatched")
     patches = Path(Path.cwd(), "patches")
     patches.mkdir(exist_ok=True)
-    patched_sources = Path(Path.cwd(), "patched")
+    patched_sources = patched_location()
     if patched_sources.exists():
         print("---- Clearing existing patched sources")
         shutil.rmtree(patched_sources)
     print("---- Copying unpatched sources into patched directory")
-    shutil.copytree(unpatched_sources, patched_sources)
+    with metrics.stage("copyPatched"):
+        unpatched_sources.extract_to(patched_sources)
     if not patches.exists() or not list(patches.iterdir()):
         print("---- No patches to apply")
         return None
@@ -214,128 +238,322 @@ def setup_patching() -> PatchSetup:
     )
 
 
+def check_patches(patches: Path, unpatched_sources: SourceTree, quiet=False, json_output=False, jobs=None, max_fuzz=DEFAULT_MAX_FUZZ):
+    """Check if all the patches apply in memory, without writing anything"""
+    with metrics.stage("checkPatches"), ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                check_patch, patch_file, unpatched_sources,
+                relative_path, max_fuzz=max_fuzz
+            )
+            for patch_file, relative_path in iter_patch_files(patches)
+        ]
+        results = sorted((future.result() for future in futures), key=lambda result: str(result.relative_path))
+    failed = [result for result in results if not result.applies]
+    metrics.PATCH_FAILURES.inc(len(failed), kind="patch")
+    if json_output:
+        json.dump({
+            "success": not failed,
+            "patches": [{
+                "patch": f"{result.relative_path}.patch",
+                "applies": result.applies,
+                "error": result.error,
+                "hunks": [{
+                    "hunk": hunk.hunk[0] + 1,
+                    "patchLine": hunk.hunk[1],
+                    "status": hunk_status(hunk),
+                    "expectedLine": hunk.expected_line,
+                    "actualLine": hunk.actual_line,
+                    "offset": hunk.offset,
+                    "fuzz": hunk.fuzz
+                } for hunk in result.hunks]
+            } for result in results]
+        }, sys.stdout, indent=4)
+        print()
+    else:
+        for result in results:
+            if result.applies and quiet:
+                continue
+            print(f"{'Applies' if result.applies else 'FAILED'}: {result.relative_path}.patch")
+            if result.error is not None:
+                print(f"  {result.error}")
+            for hunk in result.hunks:
+                status = hunk_status(hunk)
+                if status == "clean" and result.applies:
+                    continue
+                index, patch_line = hunk.hunk
+                if status == "failed":
+                    print(f"  Hunk #{index + 1} (patch line {patch_line}) FAILED at {hunk.expected_line}")
+                else:
+                    print(f"  Hunk #{index + 1} (patch line {patch_line}) matches at {hunk.actual_line} (offset {hunk.offset:+d} lines, fuzz {hunk.fuzz})")
+        print(f"{len(results) - len(failed)} of {len(results)} patches apply")
+    if failed:
+        sys.exit(1)
+
+
 @wrap_errors([CalledProcessError], processor=handle_exc)
 @arg('--quiet', help="Only print messages when errors occur")
-def patch(quiet=False):
+@arg('--check', help="Only check if the patches apply, without touching the patched directory")
+@arg('--json', dest='json_output', help="Output a machine readable summary when checking")
+@arg('--jobs', '-j', help="The number of processes to check patches with")
+@arg('--max-fuzz', help="The maximum number of context lines to ignore when locating failed hunks")
+@arg('--mc-version', help="The minecraft version to use, instead of the one TacoSpigot is built for")
+def patch(quiet=False, check=False, json_output=False, jobs=None, max_fuzz=DEFAULT_MAX_FUZZ, mc_version=None):
     """Applies the patch files to the working directory, overriding any existing work."""
-    setup = setup_patching()
-    patches, unpatched_sources, patched_sources = setup.patches, setup.unpatched_sources, setup.patched_sources
-    print("---- Applying Fountain patches via DiffUtils")
-    for patch_root, dirs, files in os.walk(str(patches)):
-        for patch_file_name in files:
-            patch_file = Path(patch_root, patch_file_name)
-            if patch_file.suffix != '.patch':
-                raise CommandError(f"Patch file doesn't end with '.patch': {patch_file_name}")
-            relative_path = Path(patch_file.parent.relative_to(patches), patch_file.stem)
-            original_file = Path(unpatched_sources, relative_path)
-            output_file = Path(patched_sources, relative_path)
-            if not original_file.exists():
-                raise CommandError(f"Couldn't find  original {original_file} for patch {patch_file}!")
-            output_file.parent.mkdir(parents=True, exist_ok=True)
-            patch_lines = []
-            with open(patch_file, 'rt') as f:
-                for line in f:
-                    patch_lines.append(line.rstrip('\r\n'))
-            patch = parse_unified_diff(patch_lines)
-            patch_lines = None  # Free
-            original_lines = []
-            with open(original_file, 'rt') as f:
-                for line in f:
-                    original_lines.append(line.rstrip('\r\n'))
-            try:
-                result_lines = patch.apply_to(original_lines)
-            except PatchFailedException as e:
-                raise CommandError(
-                    f"Unable to apply {relative_path}.patch: {e}"
-                ) from None
-            # TODO: Should we be forcibly overriding files here?
-            with open(output_file, 'wt') as f:
-                for line in result_lines:
-                    f.write(line)
-                    f.write('\n')
+    select_minecraft_version(mc_version)
+    if check:
+        unpatched_sources = stage_tree("unpatched")
+        if not unpatched_sources.exists():
+            raise CommandError("Couldn't find unpatched sources!")
+        with unpatched_sources.lock(shared=True):
+            check_patches(
+                Path(Path.cwd(), "patches"), unpatched_sources, quiet=quiet, json_output=json_output,
+                jobs=int(jobs) if jobs is not None else None, max_fuzz=int(max_fuzz)
+            )
+        return
+    with stage_tree("unpatched").lock(shared=True), patched_lock():
+        setup = setup_patching()
+        if setup is None:
+            return
+        patches, unpatched_sources, patched_sources = setup.patches, setup.unpatched_sources, setup.patched_sources
+        print("---- Applying Fountain patches via DiffUtils")
+        with metrics.stage("applyPatches"):
+            for patch_file, relative_path in iter_patch_files(patches):
+                original_name = relative_path.as_posix()
+                output_file = Path(patched_sources, relative_path)
+                if not unpatched_sources.contains(original_name):
+                    raise CommandError(f"Couldn't find  original {original_name} for patch {patch_file}!")
+                output_file.parent.mkdir(parents=True, exist_ok=True)
+                patch = parse_unified_diff(read_lines(patch_file))
+                original_data = unpatched_sources.read_bytes(original_name)
+                original_lines = decode_lines(original_data)
+                try:
+                    result_lines = patch.apply_to(original_lines)
+                except PatchFailedException as e:
+                    metrics.PATCH_FAILURES.inc(kind="patch")
+                    raise CommandError(
+                        f"Unable to apply {relative_path}.patch: {e}"
+                    ) from None
+                # TODO: Should we be forcibly overriding files here?
+                result_data = encode_lines(result_lines, newline_style(original_data))
+                write_bytes(output_file, result_data)
+                metrics.record_files("patched", num_bytes=len(result_data))
+        # Remember what the patches rely on, so we can tell which are affected by upstream changes
+        PatchIndex.build(patches, unpatched_sources).save()
+
+
+@wrap_errors([CalledProcessError], processor=handle_exc)
+@arg('--apply', dest='apply_changes', help="Reapply the affected patches and copy the changed files into the patched directory")
+@arg('--old', help="Index the patches against an old copy of the unpatched sources, instead of the existing index")
+@arg('--json', dest='json_output', help="Output a machine readable summary")
+@arg('--max-fuzz', help="The maximum number of context lines to ignore when locating moved hunks")
+@arg('--mc-version', help="The minecraft version to use, instead of the one TacoSpigot is built for")
+def impact(apply_changes=False, old=None, json_output=False, max_fuzz=DEFAULT_MAX_FUZZ, mc_version=None):
+    """Determine which patches are affected by changes to the unpatched sources, like after updating TacoSpigot"""
+    select_minecraft_version(mc_version)
+    max_fuzz = int(max_fuzz)
+    unpatched_sources = stage_tree("unpatched")
+    with unpatched_sources.lock(shared=True), patched_lock(shared=not apply_changes):
+        if not unpatched_sources.exists():
+            raise CommandError("Couldn't find unpatched sources!")
+        patches = Path(Path.cwd(), "patches")
+        if old is not None:
+            old_sources = DirectoryTree(Path(old))
+            if not old_sources.exists():
+                raise CommandError(f"Couldn't find old unpatched sources: {old}")
+            index = PatchIndex.build(patches, old_sources, max_fuzz=max_fuzz)
+        else:
+            index = PatchIndex.load()
+            if index is None:
+                raise CommandError("Missing patch index, please run 'fountain.sh patch' or specify the old sources with --old")
+        impacts, changed, digests = analyze_impact(patches, unpatched_sources, index, max_fuzz=max_fuzz)
+        conflicting = [result for patch_file, result in impacts if result.status == "conflicting"]
+        if json_output:
+            json.dump({
+                "changedFiles": len(changed),
+                "patches": [{
+                    "patch": f"{result.target}.patch",
+                    "status": result.status,
+                    "error": result.error,
+                    "hunks": [{
+                        "hunk": hunk.hunk.index + 1,
+                        "patchLine": hunk.hunk.patch_line,
+                        "status": hunk_status(hunk),
+                        "expectedLine": hunk.expected_line,
+                        "actualLine": hunk.actual_line,
+                        "offset": hunk.offset,
+                        "fuzz": hunk.fuzz
+                    } for hunk in result.hunks]
+                } for patch_file, result in impacts]
+            }, sys.stdout, indent=4)
+            print()
+        else:
+            print(f"{len(changed)} unpatched files changed, affecting {len(impacts)} patches")
+            for patch_file, result in impacts:
+                print(f"{result.status.capitalize()}: {result.target}.patch")
+                if result.error is not None:
+                    print(f"  {result.error}")
+                for hunk in result.hunks:
+                    status = hunk_status(hunk)
+                    if status == "failed":
+                        print(f"  Hunk #{hunk.hunk.index + 1} (patch line {hunk.hunk.patch_line}) FAILED at {hunk.expected_line}")
+                    elif status != "clean":
+                        print(f"  Hunk #{hunk.hunk.index + 1} (patch line {hunk.hunk.patch_line}) moved to {hunk.actual_line} (offset {hunk.offset:+d} lines, fuzz {hunk.fuzz})")
+        if apply_changes:
+            patched_sources = patched_location()
+            if not patched_sources.exists():
+                raise CommandError("No patched files found, please run 'fountain.sh patch'")
+            patch_targets = {relative_path.as_posix() for patch_file, relative_path in iter_patch_files(patches)}
+            for name in sorted(changed):
+                if name in patch_targets:
+                    continue
+                output_file = Path(patched_sources, name)
+                if unpatched_sources.contains(name):
+                    output_file.parent.mkdir(parents=True, exist_ok=True)
+                    write_bytes(output_file, unpatched_sources.read_bytes(name))
+                elif output_file.exists():
+                    os.remove(output_file)
+            for patch_file, result in impacts:
+                if result.status == "conflicting":
+                    index.patches.pop(result.target, None)
+                    continue
+                original_data = unpatched_sources.read_bytes(result.target)
+                result_lines = apply_located(decode_lines(original_data), result.hunks)
+                output_file = Path(patched_sources, result.target)
+                output_file.parent.mkdir(parents=True, exist_ok=True)
+                write_bytes(output_file, encode_lines(result_lines, newline_style(original_data)), skip_unchanged=True)
+                index.update(patch_file, result.target, unpatched_sources, max_fuzz=max_fuzz)
+            index.files = digests
+            index.save()
+            if not json_output:
+                print(f"Reapplied {len(impacts) - len(conflicting)} patches")
+        if conflicting:
+            if not json_output:
+                print(f"{len(conflicting)} patches conflict, please resolve them with 'fountain.sh wiggle'", file=sys.stderr)
+            metrics.PATCH_FAILURES.inc(len(conflicting), kind="patch")
+            sys.exit(1)
+
+
+_diff_engines = {}
+
+
+def cached_diff_engine(implementation: str) -> DiffEngine:
+    """Create the diff engine, reusing the one we already created if we're long-lived (like the daemon)"""
+    engine = _diff_engines.get(implementation)
+    if engine is None:
+        engine = _diff_engines[implementation] = DiffEngine.create(implementation)
+    return engine
 
 
 @wrap_errors([CalledProcessError], processor=handle_exc)
 @arg('--quiet', help="Only print messages when errors occur")
 @arg('--context', help="The number of context lines to output in the patches")
 @arg('--implementation', '--impl', help="Specify the diff implementation to use")
-def diff(quiet=False, context=5, implementation=None):
+@arg('--mc-version', help="The minecraft version to use, instead of the one TacoSpigot is built for")
+def diff(quiet=False, context=5, implementation=None, mc_version=None):
     """Regenerates the patch files from the contents of the working directory."""
-    unpatched_sources = Path(WORK_DIR, "unpatched")
-    if not unpatched_sources.exists():
-        raise CommandError("Couldn't find unpatched sources!")
-    patched_dir = Path(Path.cwd(), "patched")
-    if not patched_dir.exists():
-        raise CommandError("No patched files found!")
-    patches = Path(Path.cwd(), "patches")
-    patches.mkdir(exist_ok=True)
-    if implementation is not None:
-        try:
-            engine = DiffEngine.create(implementation)
-            print(f"Using {repr(engine)} diff implementation.")
-        except ImportError as e:
-            raise CommandError(
-                f"Unable to import {implementation} engine: {e}"
-            )
+    select_minecraft_version(mc_version)
+    unpatched_sources = stage_tree("unpatched")
+    with unpatched_sources.lock(shared=True), patched_lock(shared=True):
+        if not unpatched_sources.exists():
+            raise CommandError("Couldn't find unpatched sources!")
+        patched_dir = patched_location()
+        if not patched_dir.exists():
+            raise CommandError("No patched files found!")
+        patches = Path(Path.cwd(), "patches")
+        patches.mkdir(exist_ok=True)
+        if implementation is not None:
+            try:
+                engine = cached_diff_engine(implementation)
+                print(f"Using {repr(engine)} diff implementation.")
+            except ImportError as e:
+                raise CommandError(
+                    f"Unable to import {implementation} engine: {e}"
+                )
+        else:
+            try:
+                engine = cached_diff_engine('native')
+            except ImportError:
+                print("WARNING: Unable to import native diff implementation", file=sys.stderr)
+                print("Calculating diffs will be over 10 times slower!", file=sys.stderr)
+                engine = cached_diff_engine('plain')
+        print("---- Recomputing Fountain patches via DiffUtils")
+        interner = LineInterner()
+        with metrics.stage("diff"):
+            for revised_root, dirs, files in os.walk(str(patched_dir)):
+                for revised_file_name in files:
+                    if revised_file_name.startswith('.'):
+                        continue  # Ignore dotfiles
+                    revised_file = Path(revised_root, revised_file_name)
+                    relative_path = revised_file.relative_to(patched_dir)
+                    if not unpatched_sources.contains(relative_path.as_posix()):
+                        raise CommandError(f"Revised file {revised_file} doesn't have matching original!")
+                    patch_file = Path(patches, relative_path.parent, relative_path.name + ".patch")
+                    patch_file.parent.mkdir(parents=True, exist_ok=True)
+                    original_lines = unpatched_sources.read_lines(relative_path.as_posix())
+                    revised_data = read_bytes(revised_file)
+                    revised_lines = decode_lines(revised_data)
+                    result = diff_lines(engine, original_lines, revised_lines, interner)
+                    metrics.record_files("diffed", num_bytes=len(revised_data))
+                    # NOTE: Use the same names for every version and storage format, so the patches don't churn
+                    original_name = str(Path("work", "unpatched", relative_path))
+                    revised_name = str(Path("patched", relative_path))
+                    result_lines = []
+                    empty = True
+                    for line in generate_unified_diff(
+                        original_name,
+                        revised_name,
+                        original_lines,
+                        result,
+                        context_size=context
+                    ):
+                        if empty and line.strip():
+                            empty = False
+                        result_lines.append(line)
+                    if empty:
+                        continue
+                    elif not quiet:
+                        print(f"Found diff for {relative_path}")
+                    write_lines(patch_file, result_lines, skip_unchanged=True)
+                # Strip hidden dotfile dirs
+                hidden_dirs = [d for d in dirs if d.startswith('.')]
+                for d in hidden_dirs:
+                    dirs.remove(d)
+
+@wrap_errors([CalledProcessError], processor=handle_exc)
+@arg('good', help="A TacoSpigot revision the patches apply to")
+@arg('bad', help="A later TacoSpigot revision the patches no longer apply to")
+@arg('--jobs', '-j', help="The number of commits to probe concurrently")
+@arg('--keep-workspaces', help="Keep the temporary workspace of each probe, to investigate failures")
+def bisect_upstream(good, bad, jobs=None, keep_workspaces=False):
+    """Find the first TacoSpigot commit which breaks the patches, probing several commits at once"""
+    result = upstream.bisect_upstream(
+        good, bad, jobs=int(jobs) if jobs is not None else None,
+        keep_workspaces=keep_workspaces
+    )
+    bad_result = result.results[result.first_bad]
+    if bad_result.status != "bad":
+        raise CommandError([
+            f"The patches don't fail at {result.first_bad[:10]} ({bad_result.status})",
+            f"See {bad_result.log} for details"
+        ])
+    if len(result.candidates) > 1:
+        print("The first bad commit couldn't be determined, since some commits couldn't be built:")
+        for commit in result.candidates:
+            print(f"  {commit[:10]}")
     else:
-        try:
-            engine = DiffEngine.create('native')
-        except ImportError:
-            print("WARNING: Unable to import native diff implementation", file=stderr)
-            print("Calculating diffs will be over 10 times slower!", file=stderr)
-            engine = DiffEngine.create('plain')
-    print("---- Recomputing Fountain patches via DiffUtils")
-    for revised_root, dirs, files in os.walk(str(patched_dir)):
-        for revised_file_name in files:
-            if revised_file_name.startswith('.'):
-                continue  # Ignore dotfiles
-            revised_file = Path(revised_root, revised_file_name)
-            relative_path = revised_file.relative_to(patched_dir)
-            original_file = Path(unpatched_sources, relative_path)
-            if not original_file.exists():
-                raise CommandError(f"Revised file {revised_file} doesn't have matching original!")
-            patch_file = Path(patches, relative_path.parent, relative_path.name + ".patch")
-            patch_file.parent.mkdir(parents=True, exist_ok=True)
-            original_lines = []
-            revised_lines = []
-            with open(original_file, 'rt') as f:
-                for line in f:
-                    original_lines.append(line.rstrip('\r\n'))
-            with open(revised_file, 'rt') as f:
-                for line in f:
-                    revised_lines.append(line.rstrip('\r\n'))
-            result = engine.diff(original_lines, revised_lines)
-            original_name = str(original_file.absolute().relative_to(ROOT_DIR))
-            revised_name = str(revised_file.absolute().relative_to(ROOT_DIR))
-            result_lines = []
-            empty = True
-            for line in generate_unified_diff(
-                original_name,
-                revised_name,
-                original_lines,
-                result,
-                context_size=context
-            ):
-                if empty and line.strip():
-                    empty = False
-                result_lines.append(line)
-            if empty:
-                continue
-            elif not quiet:
-                print(f"Found diff for {relative_path}")
-            with open(patch_file, 'wt') as f:
-                for line in result_lines:
-                    f.write(line)
-                    f.write('\n')
-        # Strip hidden dotfile dirs
-        hidden_dirs = [d for d in dirs if d.startswith('.')]
-        for d in hidden_dirs:
-            dirs.remove(d)
+        print(f"First bad commit: {result.first_bad}")
+    print(f"Patches broken by {result.first_bad[:10]}:")
+    for failed_patch in bad_result.failed_patches:
+        print(f"  {failed_patch}")
+
 
 @wrap_errors(processor=handle_exc)
 @arg('--ignore-unresolved', '-i', help="Emit a warning when unresolvable conflicts are found, instead of failing entirely.")
-def wiggle(ignore_unresolved=False):
+@arg('--mc-version', help="The minecraft version to use, instead of the one TacoSpigot is built for")
+def wiggle(ignore_unresolved=False, mc_version=None):
     """Attempt to apply the patches via the wiggle command"""
+    select_minecraft_version(mc_version)
     def remove_porig(*files: Path):
         """Remove wiggle's backup filess, which aren't nessicarry since we're already using VCS"""
         for f in files:
@@ -354,28 +572,25 @@ def wiggle(ignore_unresolved=False):
             error_message.append("Wiggle isn't supported on windows and other non POSIX systems!")
         raise CommandError(error_message)
     # NOTE: We have to use wiggle directly, since wigglePatches.py doesn't work for some reason
-    setup = setup_patching()
-    patches, unpatched_sources, patched_sources = setup.patches, setup.unpatched_sources, setup.patched_sources
-    has_unresolved = False
-    for patch_root, dirs, files in os.walk(str(patches)):
-        for patch_file_name in files:
-            patch_file = Path(patch_root, patch_file_name)
-            if patch_file.suffix != '.patch':
-                raise CommandError(f"Patch file doesn't end with '.patch': {patch_file_name}")
-            relative_path = Path(patch_file.parent.relative_to(patches), patch_file.stem)
-            original_file = Path(unpatched_sources, relative_path)
+    with stage_tree("unpatched").lock(shared=True), patched_lock():
+        setup = setup_patching()
+        if setup is None:
+            return
+        patches, unpatched_sources, patched_sources = setup.patches, setup.unpatched_sources, setup.patched_sources
+        has_unresolved = False
+        for patch_file, relative_path in iter_patch_files(patches):
             output_file = Path(patched_sources, relative_path)
-            if not original_file.exists():
-                raise CommandError(f"Couldn't find  original {original_file} for patch {patch_file}!")
+            if not unpatched_sources.contains(relative_path.as_posix()):
+                raise CommandError(f"Couldn't find  original {relative_path} for patch {patch_file}!")
             output_file.parent.mkdir(parents=True, exist_ok=True)
-            remove_porig(original_file, patch_file, output_file)
+            remove_porig(patch_file, output_file)
             command = [
                 "wiggle",
                 "--replace",
                 str(output_file.relative_to(Path.cwd())),  # Target
                 str(patch_file.relative_to(Path.cwd()))  # Patch
             ]
-            remove_porig(original_file, patch_file, output_file)
+            remove_porig(patch_file, output_file)
             try:
                 run(command, check=True, encoding='utf-8', stdout=PIPE, stderr=PIPE)
             except CalledProcessError as e:
@@ -393,7 +608,7 @@ def wiggle(ignore_unresolved=False):
                     if not ignore_unresolved:
                         raise CommandError(error_message)
                     else:
-                        print(f"WARNING: Unresolved conflicts found while wiggling {relative_path}.patch", file=stderr)
+                        print(f"WARNING: Unresolved conflicts found while wiggling {relative_path}.patch", file=sys.stderr)
                         has_unresolved = True
                 else:
                     if error_message is None:
@@ -403,15 +618,60 @@ def wiggle(ignore_unresolved=False):
                     raise CommandError(error_message)
             else:
                 print(f"Successfully wiggled {patch_file}!")
-    if has_unresolved:
-        assert ignore_unresolved
-        print("WARNING: Unresolved conflicts found, please manually resolve!", file=stderr)
-        sys.exit(2)  # Exit with an 'error' value to make them notice!
-    else:
-        print("All patches successfully applied!")
+        if has_unresolved:
+            assert ignore_unresolved
+            print("WARNING: Unresolved conflicts found, please manually resolve!", file=sys.stderr)
+            sys.exit(2)  # Exit with an 'error' value to make them notice!
+        else:
+            print("All patches successfully applied!")
 
 
-if __name__ == "__main__":
+@wrap_errors(processor=handle_exc)
+@arg('--stop', help="Stop the running daemon instead of starting one")
+@arg('--idle-timeout', help="Exit after this many seconds without any requests")
+def daemon(stop=False, idle_timeout=3600):
+    """Answer quick commands (like print-server-classpath and diff) from a long-lived process, so they skip startup"""
+    from . import daemon as fountain_daemon
+    if stop:
+        if not fountain_daemon.stop_daemon():
+            raise CommandError("The daemon isn't running")
+        print("Stopped the daemon")
+        return
+    fountain_daemon.serve(build_parser(), idle_timeout=float(idle_timeout) if idle_timeout else None)
+
+
+@wrap_errors(processor=handle_exc)
+@arg('--listen', help="The address to accept shards on, like 0.0.0.0:7370")
+@arg('--jobs', '-j', help="The number of shards to run at once")
+def shard_worker(listen=f"127.0.0.1:{distributed.DEFAULT_PORT}", jobs=None):
+    """Run shards of the expensive stages (like decompiling) for the builds of other machines, which requires FOUNTAIN_SHARD_TOKEN"""
+    token = distributed.shard_token()
+    if not token:
+        raise CommandError("Set FOUNTAIN_SHARD_TOKEN (or 'shardToken') before running a shard worker")
+    if jobs is None:
+        # NOTE: Every fernflower wants a couple of processors
+        jobs = max(1, jvm.budget().processors // jvm.profile("fernflower").processors)
+    # NOTE: Workers only ever run their own tools, so provision them before accepting shards
+    tools.resolve("forgeFlower")
+    distributed.serve_worker(listen, int(jobs), token=token)
+
+
+@wrap_errors(processor=handle_exc)
+@arg('names', nargs='*', help="The tools to pin, instead of every downloaded tool")
+def pin_tools(*names):
+    """Pin the sha256 of the downloaded tools in buildData/tools.json, trusting the copies provisioned now"""
+    for name, digest in tools.pin(names or tools.manifest().keys()).items():
+        print(f"Pinned {name} to sha256 {digest}")
+
+
+def build_parser() -> ArghParser:
     parser = ArghParser(prog="fountain.sh", description="The TacoFountain build system")
-    parser.add_commands([setup, patch, diff, wiggle, clean, remap_source, print_server_classpath, print_bukkit_classpath])
-    parser.dispatch()
+    parser.add_commands([
+        setup, patch, diff, impact, bisect_upstream, wiggle, clean, remap_source,
+        print_server_classpath, print_bukkit_classpath, daemon, shard_worker, pin_tools
+    ])
+    return parser
+
+
+if __name__ == "__main__":
+    dispatch_with_metrics(build_parser(), profile_dir=Path(WORK_DIR, "profiles"))
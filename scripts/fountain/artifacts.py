@@ -0,0 +1,170 @@
+"""
+A cache of expensive pipeline outputs, which can be shared between workspaces.
+
+The store is just a directory (possibly on a network mount), specified by
+the FOUNTAIN_ARTIFACT_CACHE environment variable or the 'artifactCache' configuration option.
+Artifacts are keyed by the digests of their inputs, and are immutable once published.
+"""
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, Optional
+from uuid import uuid4
+
+from . import configuration, secure_hash
+from .locking import FileLock
+
+__all__ = (
+    "ArtifactStore",
+    "artifact_store",
+    "cached_artifact",
+)
+
+
+class ArtifactStore:
+    def __init__(self, location: Path):
+        self.location = Path(location)
+
+    @staticmethod
+    def key(kind: str, inputs) -> str:
+        """Compute the key of an artifact from the digests of its inputs"""
+        return f"{kind}/{secure_hash(inputs).hex()}"
+
+    def _entry(self, key: str) -> Path:
+        return Path(self.location, key)
+
+    def lock(self, key: str) -> FileLock:
+        """A lock for computing the specified artifact, so multiple workspaces don't compute it at once"""
+        entry = self._entry(key)
+        return FileLock(Path(entry.parent, entry.name + ".lock"))
+
+    def contains(self, key: str) -> bool:
+        return Path(self._entry(key), "artifact").exists()
+
+    def fetch(self, key: str, target: Path, extras: Optional[Dict[str, Path]] = None) -> bool:
+        """
+        Copy the artifact to the target location, returning False if it isn't in the store.
+
+        The target must not already exist, but the extra files published with the artifact replace their locations.
+        """
+        artifact = Path(self._entry(key), "artifact")
+        if not artifact.exists():
+            return False
+        assert not target.exists(), f"Target already exists: {target}"
+        for name, location in (extras or {}).items():
+            extra = Path(self._entry(key), "extras", name)
+            if extra.exists():  # Older entries may not have it
+                _copy(extra, location)
+        _copy(artifact, target)
+        return True
+
+    def publish(self, key: str, source: Path, extras: Optional[Dict[str, Path]] = None, **info):
+        """
+        Atomically publish a copy of the source into the store, unless it's already there.
+
+        The extra files (like metadata describing the artifact) are stored alongside it under the specified names.
+        """
+        entry = self._entry(key)
+        if entry.exists():
+            return  # Someone else beat us to it
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        temp_entry = Path(entry.parent, f".{entry.name}.{uuid4().hex}.tmp")
+        try:
+            temp_entry.mkdir()
+            if source.is_dir():
+                shutil.copytree(source, Path(temp_entry, "artifact"))
+            else:
+                shutil.copy2(source, Path(temp_entry, "artifact"))
+            if extras:
+                Path(temp_entry, "extras").mkdir()
+                for name, location in extras.items():
+                    shutil.copy2(location, Path(temp_entry, "extras", name))
+            with open(Path(temp_entry, "info.json"), 'wt') as f:
+                json.dump({"key": key, "published": time.time(), **info}, f, sort_keys=True, indent=4)
+            try:
+                os.rename(temp_entry, entry)
+            except OSError:
+                if not entry.exists():
+                    raise
+                # Someone else published it concurrently, which is fine since they're identical
+        finally:
+            _remove(temp_entry)
+
+
+def _copy(source: Path, target: Path):
+    """Copy to a temporary location first, so we never leave a partial copy behind"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    temp_target = Path(target.parent, f".{target.name}.{uuid4().hex}.tmp")
+    try:
+        if source.is_dir():
+            shutil.copytree(source, temp_target)
+        else:
+            shutil.copy2(source, temp_target)
+        os.replace(temp_target, target)
+    except BaseException:
+        _remove(temp_target)
+        raise
+
+
+def _remove(location: Path):
+    if location.is_dir():
+        shutil.rmtree(location, ignore_errors=True)
+    elif location.exists():
+        os.remove(location)
+
+
+_artifact_store = None
+
+
+def artifact_store() -> Optional[ArtifactStore]:
+    """The shared artifact store, or None if one isn't configured"""
+    global _artifact_store
+    result = _artifact_store
+    if result is not None:
+        return result
+    location = os.getenv("FOUNTAIN_ARTIFACT_CACHE")
+    if not location:
+        location = configuration().get("artifactCache")
+    if not location:
+        return None
+    result = ArtifactStore(Path(location).expanduser())
+    _artifact_store = result
+    return result
+
+
+def reset_command_state():
+    """Forget the artifact store, since the next command may configure a different one"""
+    global _artifact_store
+    _artifact_store = None
+
+
+def cached_artifact(kind: str, inputs, target: Path, compute, extras: Optional[Dict[str, Path]] = None) -> bool:
+    """
+    Fetch the target from the shared artifact store, or compute and publish it if it's missing.
+
+    The compute function must create the target, and if there's no store it's simply invoked directly.
+    If it returns False the target is incomplete, so it isn't published.
+    The extra files are written by the compute function too, and are published and fetched along with the target.
+    :return: whether the artifact was fetched from the store
+    """
+    store = artifact_store()
+    if store is None:
+        compute()
+        return False
+    key = ArtifactStore.key(kind, inputs)
+    if store.fetch(key, target, extras=extras):
+        print(f"Fetched {kind} from the shared artifact cache")
+        return True
+    with store.lock(key):
+        # Check again, since someone else may have computed it while we were waiting
+        if store.fetch(key, target, extras=extras):
+            print(f"Fetched {kind} from the shared artifact cache")
+            return True
+        if compute() is False:
+            print(f"Not publishing the incomplete {kind} to the shared artifact cache")
+            return False
+        assert target.exists(), f"Failed to compute {kind}: {target}"
+        store.publish(key, target, extras=extras, kind=kind)
+    return False
@@ -1,15 +1,22 @@
-from sys import stderr, stdout
+import sys
 
 from pathlib import Path
 import json
 from argh import CommandError
 import re
-from typing import Sequence
-from subprocess import run, PIPE, CalledProcessError
+from typing import Sequence, Mapping
+from collections import namedtuple
+import os
+from subprocess import PIPE, CalledProcessError
 from argh import arg
 from . import WORK_DIR, download_file, CacheInfo, current_tacospigot_commit,\
-    resolve_maven_dependenices, PAPER_WORK_DIR, minecraft_version, download_file,\
-    SPECIALSOURCE_URL, SPECIALSOURCE_JAR
+    resolve_maven_dependenices, PAPER_WORK_DIR, minecraft_version, download_file, specialsource_jar, require_detected_version
+from . import metrics, tools
+from .metrics import run
+from .artifacts import cached_artifact
+from .jvm import jvm_job
+from .fingerprint import fingerprint
+from .download import default_manager, DownloadRequest, DownloadError
 from tempfile import NamedTemporaryFile
 from zipfile import ZipFile
 
@@ -44,35 +51,117 @@ included_server_libraries = {
 include_patterns = None
 
 
+VERSION_MANIFEST_URL = "https://launchermeta.mojang.com/mc/game/version_manifest_v2.json"
+VERSION_MANIFEST_FILE = Path(WORK_DIR, "versions", "version_manifest.json")
+VERSION_INDEX_FILE = Path(WORK_DIR, "versions", "version_index.json")
+VersionMetadata = namedtuple("VersionMetadata", ["url", "sha1", "releaseTime"])
+
+
 def load_version_manifest(refresh=False):
-    version_manifest_file = Path(WORK_DIR, "versions", "version_manifest.json")
-    if not version_manifest_file.exists() or refresh:
-        print("---- Refreshing version manifest", file=stderr)
-        download_file(version_manifest_file, "https://launchermeta.mojang.com/mc/game/version_manifest.json")
-    with open(version_manifest_file) as f:
+    if not VERSION_MANIFEST_FILE.exists() or refresh:
+        print("---- Refreshing version manifest", file=sys.stderr)
+        download_file(VERSION_MANIFEST_FILE, VERSION_MANIFEST_URL, conditional=refresh)
+    with open(VERSION_MANIFEST_FILE) as f:
         return json.load(f)
 
 
-def parse_version_metadata(version):
-    versions = load_version_manifest()['versions']
+def _build_version_index():
+    """Index the version manifest by id, so we never have to parse the whole thing again"""
+    manifest_stat = VERSION_MANIFEST_FILE.stat()
+    versions = {}
+    for entry in load_version_manifest()['versions']:
+        versions[entry['id']] = (entry['url'], entry.get('sha1'), entry.get('releaseTime'))
+    index = {
+        "manifest": {"size": manifest_stat.st_size, "mtime": manifest_stat.st_mtime_ns},
+        "versions": versions
+    }
+    temp_file = Path(VERSION_INDEX_FILE.parent, f"{VERSION_INDEX_FILE.name}.{os.getpid()}.tmp")
+    with open(temp_file, 'wt') as f:
+        # NOTE: Don't pretty print, since this is purely for the machines
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(temp_file, VERSION_INDEX_FILE)
+    return versions
+
+
+_version_index = None
+
+
+def load_version_index(refresh=False):
+    """Load the index of version ids to their metadata, refreshing the manifest if requested"""
+    global _version_index
+    if refresh:
+        # NOTE: This is a conditional request, so it's cheap when nothing has changed
+        changed = download_file(
+            VERSION_MANIFEST_FILE, VERSION_MANIFEST_URL, conditional=True
+        )
+        if changed or _version_index is None:
+            _version_index = None
+        else:
+            return _version_index
+    result = _version_index
+    if result is not None:
+        return result
     try:
-        return versions[version]
-    except KeyError:
-        versions = load_version_manifest(refresh=True)['versions']
+        with open(VERSION_INDEX_FILE) as f:
+            index = json.load(f)
+        manifest_stat = VERSION_MANIFEST_FILE.stat()
+        manifest_info = index['manifest']
+        if manifest_info['size'] != manifest_stat.st_size or manifest_info['mtime'] != manifest_stat.st_mtime_ns:
+            raise ValueError("Outdated index")
+        result = index['versions']
+    except (FileNotFoundError, ValueError, KeyError):
+        if not VERSION_MANIFEST_FILE.exists():
+            print("---- Downloading version manifest", file=sys.stderr)
+            download_file(VERSION_MANIFEST_FILE, VERSION_MANIFEST_URL)
+        result = _build_version_index()
+    _version_index = result
+    return result
+
+
+def resolve_versions(versions):
+    """
+    Resolve the metadata for all the specified versions at once,
+    refreshing the manifest at most once if any of them are missing.
+
+    :return: a dictionary of version ids to their VersionMetadata
+    """
+    index = load_version_index()
+    missing = [version for version in versions if version not in index]
+    if missing:
+        index = load_version_index(refresh=True)
+        missing = [version for version in versions if version not in index]
+        if missing:
+            raise CommandError(f"Missing versions: {', '.join(missing)}")
+    return {version: VersionMetadata(*index[version]) for version in versions}
+
+
+def parse_version_metadata(version) -> VersionMetadata:
+    return resolve_versions((version,))[version]
+
+
+def parse_version_infos(versions):
+    """Parse the version info of all the specified versions, concurrently downloading any missing ones"""
+    version_files = {version: Path(WORK_DIR, "versions", f"version-{version}.json") for version in versions}
+    missing = [version for version, version_file in version_files.items() if not version_file.exists()]
+    if missing:
+        metadata = resolve_versions(missing)
+        print(f"Downloading {', '.join(missing)} version info", file=sys.stderr)
         try:
-            return versions[version]
-        except KeyError:
-            raise CommandError(f"Missing version: {version}")
+            default_manager().download_all(
+                DownloadRequest(metadata[version].url, version_files[version], sha1=metadata[version].sha1)
+                for version in missing
+            )
+        except DownloadError as e:
+            raise CommandError(str(e)) from None
+    result = {}
+    for version, version_file in version_files.items():
+        with open(version_file) as f:
+            result[version] = json.load(f)
+    return result
 
 
 def parse_version_info(version):
-    version_file = Path(WORK_DIR, "versions", f"version-{version}.json")
-    if not version_file.exists():
-        metadata = parse_version_metadata(version)
-        print(f"Downloading {version} version info", file=stderr)
-        download_file(version_file, metadata['url'])
-    with open(version_file) as f:
-        return json.load(f)
+    return parse_version_infos((version,))[version]
 
 
 def is_included_library(name):
@@ -98,38 +187,48 @@ def is_included_library(name):
 _cached_classpaths = {}
 
 
+def determine_server_classpaths(versions) -> Mapping[str, Sequence[str]]:
+    """Determine the server classpaths of all the specified versions at once"""
+    missing = [version for version in versions if version not in _cached_classpaths]
+    if missing:
+        for version, info in parse_version_infos(missing).items():
+            result = []
+            for library in info['libraries']:
+                name = library['name']
+                if is_included_library(name):
+                    result.append(name)
+            _cached_classpaths[version] = tuple(result)
+    return {version: _cached_classpaths[version] for version in versions}
+
+
 def determine_server_classpath(version) -> Sequence[str]:
-    try:
-        return _cached_classpaths[version]
-    except KeyError:
-        pass
-    result = []
-    for library in parse_version_info(version)['libraries']:
-        name = library['name']
-        if is_included_library(name):
-            result.append(name)
-    _cached_classpaths[version] = tuple(result)
-    return result
+    return determine_server_classpaths((version,))[version]
 
 
 def determine_bukkit_classpath(force=False):
     """Parse the craftbukkit pom to determine their classpath, reusing cached info if possible"""
     current_commit = current_tacospigot_commit()
     cache = CacheInfo.load()
-    if not force and cache.bukkitClasspathCommit == current_commit:
+    cached = not force and cache.bukkitClasspathCommit == current_commit
+    metrics.cache_lookup("bukkitClasspath", cached)
+    if cached:
         result = cache.bukkitClasspath
         assert result, f"Unexpected cached result: {result}"
         return result
-    print("---- Recomputing bukkit classpath", file=stderr)
+    print("---- Recomputing bukkit classpath", file=sys.stderr)
     try:
-        proc = run(["mvn", "dependency:tree", "-B"], check=True, cwd="TacoSpigot", stdout=PIPE, stderr=PIPE, encoding='utf-8')
+        with jvm_job("maven") as job:
+            proc = job.run(
+                ["mvn", "dependency:tree", "-B"], check=True, cwd="TacoSpigot",
+                stdout=PIPE, stderr=PIPE, encoding='utf-8', env=job.environment()
+            )
     except CalledProcessError as e:
         error_lines = e.stderr.splitlines()
         if not error_lines:
             error_lines = e.stdout.splitlines()
-        print("Error running mvn dependency tree:", file=stderr)
+        print("Error running mvn dependency tree:", file=sys.stderr)
         for line in error_lines:
-            print(line, file=stderr)
+            print(line, file=sys.stderr)
         raise CommandError("Error running mvn dependency tree")
     start_pattern = re.compile("maven-dependency-plugin:.*:tree")
     artifact_pattern = re.compile("(.*):(.*):(\w+):([^:]+)(?::(.*))?")
@@ -166,6 +265,14 @@ def determine_bukkit_classpath(force=False):
     return tuple(result)
 
 _valid_tacospigot_unshaded = False
+
+
+def reset_command_state():
+    """Forget that the unshaded jar was valid, since TacoSpigot may have been rebuilt since the last command"""
+    global _valid_tacospigot_unshaded
+    _valid_tacospigot_unshaded = False
+
+
 def unshaded_tacospigot(force=False):
     global _valid_tacospigot_unshaded
     tacospigot_unshaded_jar = Path(WORK_DIR, "jars", "TacoSpigot-unshaded.jar")
@@ -173,7 +280,9 @@ def unshaded_tacospigot(force=False):
         # NOTE: Now we just remap the TacoSpigot jar to undo the shading
         cache = CacheInfo.load()
         current_commit = current_tacospigot_commit()
-        if not tacospigot_unshaded_jar.exists() or cache.tacospigotUnshadedCommit != current_commit:
+        cached = tacospigot_unshaded_jar.exists() and cache.tacospigotUnshadedCommit == current_commit
+        metrics.cache_lookup("tacospigot.unshadedCommit", cached)
+        if not cached:
             print("---- Detecting NMS package versioning")
             name_pattern = re.compile("net/minecraft/server/(\w+)/MinecraftServer.class")
             version_signature = None
@@ -185,18 +294,26 @@ def unshaded_tacospigot(force=False):
                         break
             if version_signature is None:
                 raise CommandError("Unable to detect NMS package versioning")    
-            if not SPECIALSOURCE_JAR.exists():
-                print("---- Downloading SpecialSource")
-                download_file(SPECIALSOURCE_JAR, SPECIALSOURCE_URL)
-            print(f"---- Reversing TacoSpigot version shading for {version_signature}")
-            with NamedTemporaryFile('wt', encoding='utf-8', prefix='package') as f:
-                f.write(f"PK: net/minecraft/server/{version_signature} net/minecraft/server\n")
-                f.write(f"PK: org/bukkit/craftbukkit/{version_signature} org/bukkit/craftbukkit\n")
-                f.flush()
-                run([
-                    "java", "-jar", str(SPECIALSOURCE_JAR), "-i", "TacoSpigot/build/TacoSpigot-illegal.jar",
-                    "-o", str(tacospigot_unshaded_jar), "-m", f.name
-                ], check=True)
+            if tacospigot_unshaded_jar.exists():
+                os.remove(tacospigot_unshaded_jar)
+
+            def reverse_shading():
+                print(f"---- Reversing TacoSpigot version shading for {version_signature}")
+                with NamedTemporaryFile('wt', encoding='utf-8', prefix='package') as f:
+                    f.write(f"PK: net/minecraft/server/{version_signature} net/minecraft/server\n")
+                    f.write(f"PK: org/bukkit/craftbukkit/{version_signature} org/bukkit/craftbukkit\n")
+                    f.flush()
+                    with jvm_job("specialSource") as job:
+                        job.run(job.java(
+                            "-jar", str(specialsource_jar()), "-i", "TacoSpigot/build/TacoSpigot-illegal.jar",
+                            "-o", str(tacospigot_unshaded_jar), "-m", f.name
+                        ), check=True)
+            unshading_inputs = (
+                fingerprint(Path('TacoSpigot/build/TacoSpigot-illegal.jar')).hex(),
+                tools.manifest()["specialSource"].version,
+                version_signature
+            )
+            cached_artifact("unshadedTacoSpigot", unshading_inputs, tacospigot_unshaded_jar, reverse_shading)
             cache.tacospigotUnshadedCommit = current_commit
             cache.save()
         _valid_tacospigot_unshaded = True
@@ -204,6 +321,7 @@ def unshaded_tacospigot(force=False):
     return tacospigot_unshaded_jar
 
 def tacospigot_classpath():
+    require_detected_version("use the TacoSpigot classpath")
     return [unshaded_tacospigot()]
     #version = minecraft_version()
     # Use the mojang jar itself as a library
@@ -214,13 +332,16 @@ def tacospigot_classpath():
     #return server_classpath
 
 
-@arg('version', help="The version to determine the classpath for")
-def print_server_classpath(version):
-    """Print the server classpath as a json list"""
-    from . import classpath
-    result = determine_server_classpath(version)
+@arg('versions', nargs='+', help="The versions to determine the classpath for")
+def print_server_classpath(*versions):
+    """Print the server classpath as a json list, or a json object if multiple versions are given"""
+    classpaths = determine_server_classpaths(versions)
+    if len(versions) == 1:
+        result = classpaths[versions[0]]
+    else:
+        result = classpaths
     # NOTE: Pretty print to make it easier to read
-    json.dump(result, stdout, sort_keys=True, indent=4)
+    json.dump(result, sys.stdout, sort_keys=True, indent=4)
 
 
 @arg('--force', help="Forcibly recompute the bukkit classpath")
@@ -228,4 +349,4 @@ def print_bukkit_classpath(force=False):
     """Print the bukkit classpath as a json list"""
     result = determine_bukkit_classpath(force=force)
     # NOTE: Pretty print to make it easier to read
-    json.dump(result, stdout, sort_keys=True, indent=4)
+    json.dump(result, sys.stdout, sort_keys=True, indent=4)
@@ -0,0 +1,88 @@
+"""
+A thin client for the build system daemon, forwarding quick commands to it over a unix socket.
+
+NOTE: This module must only depend on the standard library,
+since fountain.sh runs it directly to avoid paying for importing the build system.
+It exits with FALLBACK_CODE when the command should be run in-process instead, like when there's no daemon.
+Our FOUNTAIN_* environment variables are sent along, and the daemon uses them instead of its own while running the command.
+"""
+import json
+import os
+import socket
+import sys
+from pathlib import Path
+from typing import Iterator, Optional
+
+__all__ = (
+    "DAEMON_COMMANDS",
+    "FALLBACK_CODE",
+    "socket_location",
+    "connect",
+    "forward",
+)
+
+# The commands which are quick enough to be worth answering from the daemon
+DAEMON_COMMANDS = frozenset(("print-server-classpath", "print-bukkit-classpath", "diff", "patch", "impact"))
+FALLBACK_CODE = 75  # EX_TEMPFAIL
+ENVIRONMENT_PREFIX = "FOUNTAIN_"
+# Metrics and profiling instrument the whole process, so they're only done in-process
+INSTRUMENTATION_VARIABLES = ("FOUNTAIN_METRICS_FILE", "FOUNTAIN_PROFILE")
+
+
+def socket_location(root=None) -> Path:
+    location = os.getenv("FOUNTAIN_DAEMON_SOCKET")
+    if location:
+        return Path(location)
+    return Path(root or Path.cwd(), "work", "daemon.sock")
+
+
+def connect(location: Path) -> Optional[socket.socket]:
+    """Connect to the daemon, or return None if it isn't running"""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(str(location))
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        return None
+    return connection
+
+
+def send_message(connection: socket.socket, message: dict):
+    connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def read_messages(connection: socket.socket) -> Iterator[dict]:
+    with connection.makefile('r', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def forward(argv) -> int:
+    """Run the command in the daemon, returning its exit code (or FALLBACK_CODE if it can't)"""
+    if not argv or argv[0] not in DAEMON_COMMANDS or os.getenv("FOUNTAIN_NO_DAEMON"):
+        return FALLBACK_CODE
+    if any(os.getenv(variable) for variable in INSTRUMENTATION_VARIABLES):
+        return FALLBACK_CODE
+    connection = connect(socket_location())
+    if connection is None:
+        return FALLBACK_CODE
+    with connection:
+        environment = {key: value for key, value in os.environ.items() if key.startswith(ENVIRONMENT_PREFIX)}
+        send_message(connection, {"argv": list(argv), "cwd": os.getcwd(), "env": environment})
+        for message in read_messages(connection):
+            if "stdout" in message:
+                sys.stdout.write(message["stdout"])
+                sys.stdout.flush()
+            elif "stderr" in message:
+                sys.stderr.write(message["stderr"])
+                sys.stderr.flush()
+            elif "fallback" in message:
+                return FALLBACK_CODE
+            elif "exit" in message:
+                return message["exit"]
+    print("ERROR: The daemon exited before finishing the command", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(forward(sys.argv[1:]))
@@ -0,0 +1,178 @@
+"""
+A long-lived build system process, answering quick commands without paying for startup each time.
+
+It listens on a unix socket (work/daemon.sock) for newline delimited JSON requests from fountain/client.py,
+runs the command in-process while streaming its output back, and finishes with the command's exit code.
+Commands run one at a time, since they share the state of the process (like the selected minecraft version).
+Anything which might go stale is forgotten between commands, but the parsed version metadata, classpaths,
+resolved tools and diff engines stay warm. Each command sees the client's FOUNTAIN_* environment variables instead of ours. The daemon exits once its own sources change, or after being idle.
+"""
+import io
+import json
+import os
+import socketserver
+import time
+import traceback
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from pathlib import Path
+from threading import Lock
+
+from argh import CommandError
+
+from . import ROOT_DIR, reset_command_state
+from . import artifacts, classpath
+from .client import DAEMON_COMMANDS, ENVIRONMENT_PREFIX, connect, read_messages, send_message, socket_location
+
+__all__ = (
+    "serve",
+    "stop_daemon",
+)
+
+
+def _sources_stamp():
+    """The modification times of the build system's sources, to notice when we're running stale code"""
+    return tuple(sorted((path.name, path.stat().st_mtime_ns) for path in Path(__file__).parent.glob("*.py")))
+
+
+@contextmanager
+def _client_environment(environment: dict):
+    """Temporarily replace our FOUNTAIN_* environment variables with the client's"""
+    original = {key: value for key, value in os.environ.items() if key.startswith(ENVIRONMENT_PREFIX)}
+    for key in original:
+        del os.environ[key]
+    os.environ.update({key: value for key, value in environment.items() if key.startswith(ENVIRONMENT_PREFIX)})
+    try:
+        yield
+    finally:
+        for key in [key for key in os.environ if key.startswith(ENVIRONMENT_PREFIX)]:
+            del os.environ[key]
+        os.environ.update(original)
+
+
+class _MessageStream(io.TextIOBase):
+    """Forwards everything written to it to the client, as messages of the specified kind"""
+
+    def __init__(self, connection, kind: str):
+        self.connection = connection
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if text:
+            send_message(self.connection, {self.kind: text})
+        return len(text)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server  # type: DaemonServer
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        server.last_request = time.monotonic()
+        if request.get("stop"):
+            server.stopping = True
+            send_message(self.connection, {"exit": 0})
+            return
+        argv = request.get("argv") or []
+        if not argv or argv[0] not in DAEMON_COMMANDS or Path(request.get("cwd", "")).resolve() != ROOT_DIR.resolve():
+            send_message(self.connection, {"fallback": True})
+            return
+        with server.command_lock:
+            if _sources_stamp() != server.sources_stamp:
+                # The build system was changed underneath us, so let the client run the new version
+                print("Exiting, since the build system changed")
+                server.stopping = True
+                send_message(self.connection, {"fallback": True})
+                return
+            with _client_environment(request.get("env") or {}):
+                exit_code = server.run_command(argv, self.connection)
+            server.last_request = time.monotonic()
+        if exit_code is not None:
+            send_message(self.connection, {"exit": exit_code})
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, location: Path, parser):
+        super().__init__(str(location), _RequestHandler)
+        self.parser = parser
+        self.command_lock = Lock()
+        self.sources_stamp = _sources_stamp()
+        self.last_request = time.monotonic()
+        self.stopping = False
+
+    def server_bind(self):
+        # NOTE: Create the socket private to us, since chmod'ing it afterwards leaves a window where anyone can connect
+        old_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(old_umask)
+
+    def run_command(self, argv, connection):
+        """Run the command with its output sent to the client, returning its exit code or None if the client left"""
+        reset_command_state()
+        classpath.reset_command_state()
+        artifacts.reset_command_state()
+        stdout, stderr = _MessageStream(connection, "stdout"), _MessageStream(connection, "stderr")
+        start = time.perf_counter()
+        try:
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                self.parser.dispatch(argv=argv, output_file=stdout, errors_file=stderr)
+            exit_code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                exit_code = e.code or 0
+            else:
+                stderr.write(f"{e.code}\n")
+                exit_code = 1
+        except (BrokenPipeError, ConnectionResetError):
+            print(f"Client disconnected while running {' '.join(argv)}")
+            return None
+        except Exception:
+            stderr.write(traceback.format_exc())
+            exit_code = 1
+        print(f"Ran {' '.join(argv)} in {(time.perf_counter() - start) * 1000:.1f}ms (exit code {exit_code})")
+        return exit_code
+
+
+def serve(parser, idle_timeout=None):
+    """Answer requests until stopped, our sources change, or we've been idle for idle_timeout seconds"""
+    location = socket_location(ROOT_DIR)
+    if location.exists():
+        existing = connect(location)
+        if existing is not None:
+            existing.close()
+            raise CommandError(f"The daemon is already running at {location}")
+        os.remove(location)  # Left behind by a daemon which died
+    location.parent.mkdir(parents=True, exist_ok=True)
+    with DaemonServer(location, parser) as server:
+        server.timeout = 1
+        print(f"Listening on {location}")
+        try:
+            while not server.stopping:
+                server.handle_request()
+                idle = time.monotonic() - server.last_request
+                if idle_timeout is not None and idle > idle_timeout and not server.command_lock.locked():
+                    print(f"Exiting after being idle for {idle:.0f} seconds")
+                    break
+        finally:
+            if location.exists():
+                os.remove(location)
+
+
+def stop_daemon() -> bool:
+    """Ask the running daemon to exit, returning False if there wasn't one"""
+    connection = connect(socket_location(ROOT_DIR))
+    if connection is None:
+        return False
+    with connection:
+        send_message(connection, {"stop": True})
+        for _ in read_messages(connection):
+            pass
+    return True
@@ -0,0 +1,359 @@
+"""
+Decompiling the minecraft classes TacoSpigot doesn't have sources for.
+
+The classes are split into shards which are decompiled concurrently, each by its own fernflower.
+If shard workers are configured, the shards are decompiled by them instead (see fountain.distributed).
+Fernflower occasionally spends minutes on a single pathological class, so each class gets a time budget.
+When a class exceeds it, the rest of its shard is decompiled again without it,
+and the slow class is retried on its own with a larger budget.
+Classes which still don't finish are left without sources, and are reported as candidates for the blacklist.
+"""
+import json
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import count
+from pathlib import Path
+from typing import Dict, FrozenSet, List, Optional
+from zipfile import ZIP_STORED, ZipFile
+
+from . import ROOT_DIR, DecompileTimeout, FERNFLOWER_OPTIONS,\
+    configuration, decompile_blacklist, forgeflower_jar, run_fernflower, version_work_dir
+from . import jvm, metrics, tools
+from .artifacts import cached_artifact
+from .distributed import ShardCluster, ShardWorkerError, configured_cluster
+from .fileio import write_bytes
+from .fingerprint import fingerprint
+from .stages import SourceTree, stage_tree
+
+NMS_PACKAGE = "net/minecraft/server/"
+TACOSPIGOT_SERVER_SOURCES = Path(ROOT_DIR, "TacoSpigot", "TacoSpigot-Server", "src", "main", "java")
+
+# The seconds fernflower may spend on a single class, unless 'decompileClassTimeout' is configured
+DEFAULT_CLASS_TIMEOUT = 120
+# A class which timed out is retried alone with this many times the budget, since it's no longer competing for the JVM
+ISOLATED_TIMEOUT_FACTOR = 5
+# Don't bother starting another fernflower for less than this many classes
+MIN_SHARD_SIZE = 100
+# The number of the slowest classes kept in the timings file
+SLOWEST_CLASSES = 50
+
+DECOMPILE_DURATION = metrics.histogram(
+    "fountain_decompile_class_seconds", "Time fernflower spent on each class",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300)
+)
+
+
+def _is_nms_class(name: str) -> bool:
+    return name.startswith(NMS_PACKAGE) and name.endswith(".class") and '/' not in name[len(NMS_PACKAGE):]
+
+
+def _outer_class(name: str) -> str:
+    """The outer class of the class file, like 'Entity' for 'net/minecraft/server/Entity$1.class'"""
+    return name[len(NMS_PACKAGE):-len(".class")].split('$', 1)[0]
+
+
+def _logged_class(name: str) -> str:
+    """The outer class of a name fernflower logged, like 'Entity' for 'net/minecraft/server/Entity$1'"""
+    return name.rsplit('/', 1)[-1].split('$', 1)[0]
+
+
+def needed_decompile_classes(jar_file: Path):
+    """The outer classes in the jar which TacoSpigot doesn't already have sources for"""
+    with ZipFile(str(jar_file), "r") as jar:
+        classes = {_outer_class(name) for name in jar.namelist() if _is_nms_class(name)}
+    return frozenset(
+        name for name in classes
+        if not Path(TACOSPIGOT_SERVER_SOURCES, NMS_PACKAGE, name + ".java").exists()
+    )
+
+
+def _write_filtered_jar(source: ZipFile, target: Path, names):
+    """Copy the entries into a new jar, storing them uncompressed since it's only read once"""
+    with ZipFile(str(target), "w", compression=ZIP_STORED) as jar:
+        for name in names:
+            jar.writestr(name, source.read(name))
+
+
+def _split_jar(jar_file: Path, classes: FrozenSet[str], shard_dir: Path):
+    """Split the jar into the classes of the shard and a library of the rest, which is None if there aren't any"""
+    input_jar = Path(shard_dir, "classes.jar")
+    library_jar = Path(shard_dir, "libraries.jar")
+    with ZipFile(str(jar_file), "r") as jar:
+        members = [name for name in jar.namelist() if _is_nms_class(name)]
+        _write_filtered_jar(jar, input_jar, [name for name in members if _outer_class(name) in classes])
+        # The rest are only needed to resolve references, so they're passed as a library
+        library_members = [name for name in members if _outer_class(name) not in classes]
+        if not library_members:
+            return input_jar, None
+        _write_filtered_jar(jar, library_jar, library_members)
+    return input_jar, library_jar
+
+
+def _check_decompiler(request: dict) -> Path:
+    """
+    Check we'd decompile the shard like the coordinator, returning our ForgeFlower.
+
+    We only ever run our own ForgeFlower, so coordinators can't make us run arbitrary code.
+    Its builds aren't reproducible, so we go by the source revision it was built from rather than its hash.
+    """
+    tool = tools.manifest()["forgeFlower"]
+    expected = request["decompiler"]
+    if expected["version"] != tool.version:
+        raise ShardWorkerError(f"Expected ForgeFlower {expected['version']}, but this worker has {tool.version}")
+    if request["options"] != FERNFLOWER_OPTIONS:
+        raise ShardWorkerError(f"Expected fernflower options {FERNFLOWER_OPTIONS}, but got {request['options']}")
+    return forgeflower_jar()
+
+
+def run_decompile_shard(inputs: Dict[str, Path], request: dict, shard_dir: Path):
+    """Decompile a shard sent by another machine's build, returning the jar of sources and the timings"""
+    decompiler = _check_decompiler(request)
+    input_jar, library_jar = _split_jar(inputs["jar"], frozenset(request["classes"]), shard_dir)
+    output = Path(shard_dir, "output")
+    try:
+        timings = run_fernflower(
+            input_jar, output,
+            libraries=[library_jar] if library_jar is not None else [],
+            verbose=False,
+            class_timeout=request["timeout"],
+            decompiler=decompiler
+        )
+    except DecompileTimeout as e:
+        # NOTE: The coordinator handles timeouts, since it knows the rest of the shards
+        return None, {"timeout": {"className": e.class_name, "elapsed": e.elapsed}, "timings": e.timings}
+    return Path(output, input_jar.name), {"timings": timings}
+
+
+def decompiled_classes(version, decompiled_sources: SourceTree):
+    """The outer classes which have been decompiled, or None if nothing has been"""
+    if not decompiled_sources.exists():
+        return None
+    try:
+        with open(Path(version_work_dir(version), "decompiled-classes.json")) as f:
+            return frozenset(json.load(f))
+    except (FileNotFoundError, ValueError):
+        # Decompiled before we kept a manifest, so go by the sources themselves
+        return frozenset(Path(name).stem for name in decompiled_sources.iter_files(NMS_PACKAGE.rstrip('/')))
+
+
+def class_timeout() -> float:
+    return float(configuration().get("decompileClassTimeout", DEFAULT_CLASS_TIMEOUT))
+
+
+def timings_location(version=None) -> Path:
+    return Path(version_work_dir(version), "decompile-timings.json")
+
+
+def blacklist_candidates(version=None) -> List[str]:
+    """
+    The classes which timed out the last time they were decompiled, and aren't blacklisted yet.
+
+    Classes TacoSpigot has sources for are never candidates, since the blacklist can't contain them.
+    """
+    try:
+        with open(timings_location(version)) as f:
+            timeouts = json.load(f)['timeouts']
+    except (FileNotFoundError, ValueError, KeyError):
+        return []
+    return sorted(
+        name for name in timeouts
+        if name not in decompile_blacklist()
+        and not Path(TACOSPIGOT_SERVER_SOURCES, NMS_PACKAGE, name + ".java").exists()
+    )
+
+
+ShardResult = namedtuple("ShardResult", ["classes", "timeout", "output_jar", "timings"])
+
+
+class ShardedDecompiler:
+    """Decompiles the classes of a jar in concurrent shards, isolating the classes which take too long"""
+
+    def __init__(self, jar_file: Path, classes: FrozenSet[str], temp_dir: Path, timeout: float, cluster: Optional[ShardCluster] = None):
+        self.jar_file = jar_file
+        self.classes = classes
+        self.temp_dir = temp_dir
+        self.timeout = timeout
+        self.cluster = cluster
+        self.timings = {}  # type: Dict[str, float]
+        self.timeouts = {}  # type: Dict[str, float]
+        self._shard_ids = count()
+
+    def initial_shards(self, num_shards: int) -> List[FrozenSet[str]]:
+        with ZipFile(str(self.jar_file), "r") as jar:
+            sizes = {}
+            for info in jar.infolist():
+                if _is_nms_class(info.filename) and _outer_class(info.filename) in self.classes:
+                    outer = _outer_class(info.filename)
+                    sizes[outer] = sizes.get(outer, 0) + info.file_size
+        # Deal out the biggest classes first, so the shards take about as long as each other
+        shards = [set() for _ in range(num_shards)]
+        for index, name in enumerate(sorted(sizes, key=lambda name: sizes[name], reverse=True)):
+            shards[index % num_shards].add(name)
+        return [frozenset(shard) for shard in shards if shard]
+
+    def decompile_shard(self, classes: FrozenSet[str], timeout: float) -> ShardResult:
+        """Decompile a single shard, which is run on a worker thread"""
+        shard_dir = Path(self.temp_dir, f"shard-{next(self._shard_ids)}")
+        shard_dir.mkdir()
+        if self.cluster is not None:
+            try:
+                return self._decompile_remotely(classes, timeout, shard_dir)
+            except ShardWorkerError as e:
+                print(f"WARNING: Decompiling {len(classes)} classes locally instead: {e}")
+        input_jar, library_jar = _split_jar(self.jar_file, classes, shard_dir)
+        output = Path(shard_dir, "output")
+        try:
+            timings = run_fernflower(
+                input_jar, output,
+                libraries=[library_jar] if library_jar is not None else [],
+                verbose=False,
+                class_timeout=timeout
+            )
+        finally:
+            os.remove(input_jar)
+            if library_jar is not None:
+                os.remove(library_jar)
+        # NOTE: Fernflower outputs a jar of sources with the same name as its input
+        return ShardResult(classes, timeout, Path(output, input_jar.name), timings)
+
+    def _decompile_remotely(self, classes: FrozenSet[str], timeout: float, shard_dir: Path) -> ShardResult:
+        # NOTE: Not in the output directory, which has to be free for decompiling locally if no worker can
+        output_jar = Path(shard_dir, "remote", "classes.jar")
+        output_jar.parent.mkdir()
+        decompiler = {"version": tools.manifest()["forgeFlower"].version}
+        summary = self.cluster.run(
+            "decompile",
+            {"classes": sorted(classes), "timeout": timeout, "options": FERNFLOWER_OPTIONS, "decompiler": decompiler},
+            {"jar": self.jar_file},
+            output_jar
+        )
+        if "timeout" in summary:
+            raise DecompileTimeout(summary["timeout"]["className"], summary["timeout"]["elapsed"], summary["timings"])
+        return ShardResult(classes, timeout, output_jar, summary["timings"])
+
+    def _record_timings(self, timings: Dict[str, float]):
+        for name, seconds in timings.items():
+            name = _logged_class(name)
+            self.timings[name] = max(seconds, self.timings.get(name, 0))
+            DECOMPILE_DURATION.observe(seconds)
+
+    def decompile(self, writer, num_shards: int):
+        """Decompile all the classes into the writer, which is only ever touched from this thread"""
+        shards = self.initial_shards(num_shards)
+        print(f"---- Decompiling {len(self.classes)} classes in {len(shards)} shards, "
+              f"allowing {self.timeout:.0f} seconds per class")
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            pending = {
+                executor.submit(self.decompile_shard, shard, self.timeout): (shard, self.timeout)
+                for shard in shards
+            }
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    shard, timeout = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except DecompileTimeout as e:
+                        self._record_timings(e.timings)
+                        slow_class = _logged_class(e.class_name)
+                        if len(shard) == 1 or slow_class not in shard:
+                            # It didn't finish even on its own, so give up on it
+                            for name in (shard if slow_class not in shard else (slow_class,)):
+                                self.timeouts[name] = e.elapsed
+                            print(f"WARNING: Gave up decompiling {', '.join(sorted(shard))} after {e.elapsed:.0f} seconds")
+                            continue
+                        print(f"{slow_class} took longer than {timeout:.0f} seconds, decompiling it separately")
+                        isolated_timeout = timeout * ISOLATED_TIMEOUT_FACTOR
+                        for retry, retry_timeout in ((shard - {slow_class}, timeout), (frozenset({slow_class}), isolated_timeout)):
+                            if retry:
+                                pending[executor.submit(self.decompile_shard, retry, retry_timeout)] = (retry, retry_timeout)
+                        continue
+                    self._record_timings(result.timings)
+                    with ZipFile(str(result.output_jar), "r") as decompiled:
+                        for info in decompiled.infolist():
+                            if not info.is_dir():
+                                writer.write_bytes(info.filename, decompiled.read(info))
+                    shutil.rmtree(result.output_jar.parent)
+                    print(f"Decompiled {len(shard)} classes")
+
+    def save_timings(self, location: Path):
+        slowest = sorted(self.timings.items(), key=lambda item: item[1], reverse=True)[:SLOWEST_CLASSES]
+        write_bytes(location, json.dumps({
+            "classTimeout": self.timeout,
+            "slowest": {name: round(seconds, 3) for name, seconds in slowest},
+            "timeouts": {name: round(seconds, 3) for name, seconds in sorted(self.timeouts.items())}
+        }, indent=4).encode('utf-8'))
+
+
+def _num_shards(num_classes: int, cluster: Optional[ShardCluster] = None) -> int:
+    configured = configuration().get("decompileShards")
+    if configured:
+        return max(1, int(configured))
+    # NOTE: Each fernflower mostly decompiles on a single thread, so use a shard per processor (or worker slot)
+    slots = cluster.total_slots if cluster is not None else jvm.budget().processors
+    return max(1, min(slots, num_classes // MIN_SHARD_SIZE))
+
+
+def decompile_sources(version, jar_file: Path):
+    """
+    Decompile the classes of the jar which TacoSpigot doesn't have sources for.
+
+    The manifest of decompiled classes is recorded, so the sources are only decompiled again
+    when TacoSpigot drops one of its sources. Classes it adds sources for are just ignored.
+    Classes which timed out are left out of the manifest, so they're tried again until they're blacklisted.
+    """
+    decompiled_sources = stage_tree("decompiled", version=version)
+    needed_classes = needed_decompile_classes(jar_file)
+    timeout = class_timeout()
+    with decompiled_sources.lock():
+        existing_classes = decompiled_classes(version, decompiled_sources)
+        # NOTE: Blacklisted classes are never used, so there's no point in trying them again
+        missing_classes = needed_classes - (existing_classes or frozenset()) - decompile_blacklist()
+        if existing_classes is None or missing_classes:
+            timeouts = set()
+
+            def decompile():
+                version_work_dir(version).mkdir(parents=True, exist_ok=True)
+                legacy_class_files = Path(version_work_dir(version), "bin")
+                if legacy_class_files.exists():
+                    shutil.rmtree(legacy_class_files)  # Left over from when we extracted the class files
+                with tempfile.TemporaryDirectory(prefix="decompile-", dir=version_work_dir(version)) as temp_dir:
+                    cluster = configured_cluster()
+                    decompiler = ShardedDecompiler(jar_file, needed_classes, Path(temp_dir), timeout, cluster=cluster)
+                    print(f"---- Decompiling {version} classes TacoSpigot doesn't have sources for")
+                    if cluster is not None:
+                        print(f"Using {cluster.total_slots} slots on {len(cluster.workers)} shard workers")
+                    with metrics.stage("decompile"), decompiled_sources.replace() as writer:
+                        decompiler.decompile(writer, _num_shards(len(needed_classes), cluster))
+                decompiler.save_timings(timings_location(version))
+                if decompiler.timeouts:
+                    print(f"WARNING: Couldn't decompile {len(decompiler.timeouts)} classes in time:")
+                    for name in sorted(decompiler.timeouts):
+                        print(f"  {name}")
+                    print("Run 'python3 -m fountain.utils regenerate-blacklist' to add them to the decompile blacklist")
+                metrics.record_files("decompiled", num_files=len(needed_classes) - len(decompiler.timeouts))
+                timeouts.update(decompiler.timeouts)
+                # NOTE: Don't share sources which are missing classes, since another machine may well manage them
+                return not decompiler.timeouts
+            decompile_inputs = (
+                fingerprint(jar_file).hex(),
+                tools.manifest()["forgeFlower"].version,
+                {key: str(value) for key, value in FERNFLOWER_OPTIONS.items()},
+                sorted(needed_classes),
+                timeout
+            )
+            if decompiled_sources.exists():
+                print(f"---- Redecompiling, since {len(missing_classes)} classes are missing from the decompiled sources")
+                decompiled_sources.remove()
+            cached_artifact(
+                f"decompiled-{decompiled_sources.format}", decompile_inputs, decompiled_sources.location, decompile,
+                extras={"timings": timings_location(version)}
+            )
+            write_bytes(
+                Path(version_work_dir(version), "decompiled-classes.json"),
+                json.dumps(sorted(needed_classes - timeouts), indent=4).encode('utf-8')
+            )
+        return decompiled_sources
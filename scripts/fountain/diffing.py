@@ -0,0 +1,114 @@
+"""
+Diffing the sources, without handing the diff engine the whole of each (huge) decompiled file.
+
+The lines of both files are interned into integer ids shared by every file diffed in a run,
+which are stored in compact arrays so the preprocessing only ever compares integers.
+The common prefix and suffix are trimmed, and lines which only appear on one side are dropped,
+since they can never match anything anyway. Only what's left is diffed by the engine,
+and the resulting matches are mapped back to the full text when building the patch.
+"""
+from array import array
+from typing import Dict, List, Optional
+
+from diffutils.core import Chunk, Delta, Patch
+from diffutils.engine import DiffEngine
+
+__all__ = (
+    "LineInterner",
+    "diff_lines",
+)
+
+# The engines which can diff the line ids directly, instead of hashing the text of each line
+ID_ENGINES = frozenset(("plain_myers",))
+SENTINEL_ID = -1  # Never a valid id, since they're unsigned
+SENTINEL_LINE = "\n"  # Never a valid line, since they're already split
+
+
+class LineInterner:
+    """Maps each distinct line to an integer id, so repeated lines (like '}' or imports) are only stored once"""
+
+    def __init__(self):
+        self._ids = {}  # type: Dict[str, int]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def intern(self, lines: List[str]) -> array:
+        ids = self._ids
+        result = array('I')
+        append = result.append
+        for line in lines:
+            line_id = ids.get(line)
+            if line_id is None:
+                line_id = ids[line] = len(ids)
+            append(line_id)
+        return result
+
+
+def _common_affixes(original_ids: array, revised_ids: array):
+    """Determine the length of the common prefix and suffix, which never overlap"""
+    limit = min(len(original_ids), len(revised_ids))
+    prefix = 0
+    while prefix < limit and original_ids[prefix] == revised_ids[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and original_ids[-1 - suffix] == revised_ids[-1 - suffix]:
+        suffix += 1
+    return prefix, suffix
+
+
+def _shared_indexes(ids: array, start: int, end: int, other_ids: set) -> array:
+    """The indexes of the lines in the range which also appear in the other file"""
+    return array('I', [index for index in range(start, end) if ids[index] in other_ids])
+
+
+def _matches(engine: DiffEngine, original, original_ids: array, original_indexes: array, revised, revised_ids: array, revised_indexes: array):
+    """Diff the reduced lines with the engine, yielding the pairs of indexes which it matched up"""
+    if not original_indexes or not revised_indexes:
+        return
+    # NOTE: Both sides start with the same sentinel, since diffutils' engines lose a delta at the very start
+    # (which would be almost every time, since we've trimmed the common prefix)
+    if engine.name in ID_ENGINES:
+        original_tokens = [SENTINEL_ID, *(original_ids[index] for index in original_indexes)]
+        revised_tokens = [SENTINEL_ID, *(revised_ids[index] for index in revised_indexes)]
+    else:
+        original_tokens = [SENTINEL_LINE, *(original[index] for index in original_indexes)]
+        revised_tokens = [SENTINEL_LINE, *(revised[index] for index in revised_indexes)]
+
+    def equal_run(original_position, revised_position, length):
+        for offset in range(length):
+            if original_position + offset > 0:
+                yield original_indexes[original_position + offset - 1], revised_indexes[revised_position + offset - 1]
+
+    original_position = revised_position = 0
+    for delta in engine.diff(original_tokens, revised_tokens).deltas:
+        yield from equal_run(original_position, revised_position, delta.original.position - original_position)
+        original_position = delta.original.position + len(delta.original)
+        revised_position = delta.revised.position + len(delta.revised)
+    yield from equal_run(original_position, revised_position, len(original_tokens) - original_position)
+
+
+def diff_lines(engine: DiffEngine, original: List[str], revised: List[str], interner: Optional[LineInterner] = None) -> Patch:
+    """Compute the patch between the lines with the engine, after reducing them to the part which actually differs"""
+    if interner is None:
+        interner = LineInterner()
+    original_ids = interner.intern(original)
+    revised_ids = interner.intern(revised)
+    result = Patch()
+    if original_ids == revised_ids:
+        return result
+    prefix, suffix = _common_affixes(original_ids, revised_ids)
+    original_end, revised_end = len(original) - suffix, len(revised) - suffix
+    original_indexes = _shared_indexes(original_ids, prefix, original_end, set(revised_ids[prefix:revised_end]))
+    revised_indexes = _shared_indexes(revised_ids, prefix, revised_end, set(original_ids[prefix:original_end]))
+    # Everything in between two matched lines (including the lines we dropped) is part of a delta
+    original_position = revised_position = prefix
+    matches = _matches(engine, original, original_ids, original_indexes, revised, revised_ids, revised_indexes)
+    for original_match, revised_match in [*matches, (original_end, revised_end)]:
+        if original_match > original_position or revised_match > revised_position:
+            result.add_delta(Delta.create(
+                Chunk(original_position, original[original_position:original_match]),
+                Chunk(revised_position, revised[revised_position:revised_match])
+            ))
+        original_position, revised_position = original_match + 1, revised_match + 1
+    return result
@@ -0,0 +1,452 @@
+"""
+Running shards of the expensive stages (like decompiling) on other machines.
+
+Idle builders run 'fountain.sh shard-worker', and the build lists them in 'shardWorkers' (or FOUNTAIN_SHARD_WORKERS).
+The coordinator opens a TCP connection per shard, which starts with the shared token (FOUNTAIN_SHARD_TOKEN or 'shardToken')
+and the shard's request. Its inputs (like the server jar) are content addressed by their sha256,
+so the worker only asks for the ones it hasn't cached from an earlier shard. Workers never receive code to run:
+they provision their own tools, and refuse shards asking for different versions of them. The worker runs the shard,
+sending heartbeats while it's busy, and finally streams back the result.
+A worker which disconnects or goes quiet is presumed lost, and its shards are reassigned to the others,
+falling back to running them locally once no workers are left.
+
+Every message is a line of JSON, followed by 'size' bytes of payload if it has one.
+"""
+import hashlib
+import hmac
+import json
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import time
+from collections import namedtuple
+from pathlib import Path
+from threading import Event, Lock, Semaphore, Thread
+from typing import Dict, List, Optional, Tuple
+
+from argh import CommandError
+
+from . import WORK_DIR, configuration
+from . import metrics
+
+__all__ = (
+    "ShardWorkerError",
+    "ShardCluster",
+    "serve_worker",
+    "shard_token",
+    "configured_cluster",
+)
+
+DEFAULT_PORT = 7370
+PROTOCOL_VERSION = 1
+HEARTBEAT_INTERVAL = 10
+# A worker which hasn't said anything for this long is presumed lost
+WORKER_TIMEOUT = 6 * HEARTBEAT_INTERVAL
+CONNECT_TIMEOUT = 10
+# The number of workers a shard is tried on, before giving up and running it locally
+MAX_ATTEMPTS = 3
+BUFFER_SIZE = 1024 * 64
+# Cached inputs which haven't been used for this long are removed when the worker starts
+BLOB_EXPIRY = 7 * 24 * 60 * 60
+
+REMOTE_SHARDS = metrics.counter("fountain_remote_shards_total", "Shards sent to remote workers, by kind and outcome")
+
+
+class ShardWorkerError(Exception):
+    """Raised when a worker couldn't run a shard, so it needs to be run somewhere else"""
+
+
+class _LostWorker(ShardWorkerError):
+    """The worker disconnected, went quiet or broke the protocol, so it shouldn't get any more shards"""
+
+
+def shard_token() -> Optional[str]:
+    return os.getenv("FOUNTAIN_SHARD_TOKEN") or configuration().get("shardToken")
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, separator, port = address.rpartition(':')
+    if not separator:
+        return address, DEFAULT_PORT
+    return host.strip('[]'), int(port)
+
+
+def sha256_file(location: Path) -> str:
+    h = hashlib.sha256()
+    with open(location, 'rb') as f:
+        while True:
+            data = f.read(BUFFER_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def send_message(connection: socket.socket, message: dict, payload: Optional[Path] = None):
+    if payload is not None:
+        message = dict(message, size=payload.stat().st_size)
+    connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+    if payload is not None:
+        with open(payload, 'rb') as f:
+            connection.sendfile(f)
+
+
+def read_message(stream) -> dict:
+    line = stream.readline()
+    if not line:
+        raise EOFError("Connection closed")
+    return json.loads(line)
+
+
+def receive_payload(stream, size: int, target: Path, digest: Optional[str] = None):
+    """Write the payload following a message to the target, verifying it matches the digest if specified"""
+    h = hashlib.sha256()
+    remaining = size
+    with open(target, 'wb') as f:
+        while remaining:
+            data = stream.read(min(remaining, BUFFER_SIZE))
+            if not data:
+                raise EOFError(f"Connection closed with {remaining} bytes of payload left")
+            f.write(data)
+            h.update(data)
+            remaining -= len(data)
+    if digest is not None and h.hexdigest() != digest:
+        os.remove(target)
+        raise ValueError(f"Expected sha256 {digest}, but received {h.hexdigest()}")
+
+
+class BlobStore:
+    """The worker's cache of shard inputs, stored by their sha256"""
+
+    def __init__(self, location: Path):
+        self.location = location
+        location.mkdir(parents=True, exist_ok=True)
+
+    def path(self, digest: str) -> Path:
+        if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            raise ValueError(f"Invalid digest: {digest!r}")
+        return Path(self.location, digest)
+
+    def contains(self, digest: str) -> bool:
+        location = self.path(digest)
+        try:
+            os.utime(location)  # Mark it as used, so it doesn't expire
+        except FileNotFoundError:
+            return False
+        return True
+
+    def receive(self, stream, digest: str, size: int):
+        temp_file = Path(self.location, f".{digest}.{os.getpid()}.{id(stream)}.tmp")
+        try:
+            receive_payload(stream, size, temp_file, digest=digest)
+            os.replace(temp_file, self.path(digest))
+        finally:
+            if temp_file.exists():
+                os.remove(temp_file)
+
+    def expire(self, max_age=BLOB_EXPIRY):
+        now = time.time()
+        for entry in self.location.iterdir():
+            if now - entry.stat().st_mtime > max_age:
+                os.remove(entry)
+
+
+def _run_decompile(inputs: Dict[str, Path], request: dict, shard_dir: Path):
+    from .decompile import run_decompile_shard
+    return run_decompile_shard(inputs, request, shard_dir)
+
+
+# The kinds of shards workers can run, which return the result file (if any) and a json summary
+SHARD_KINDS = {
+    "decompile": _run_decompile,
+}
+
+
+class _WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server  # type: WorkerServer
+        self.connection.settimeout(WORKER_TIMEOUT)
+        self.send_lock = Lock()
+        try:
+            hello = read_message(self.rfile)
+            token = str(hello.get("token") or "")
+            if hello.get("type") != "hello" or not server.token or not hmac.compare_digest(token, server.token):
+                self.send({"type": "rejected", "error": "Invalid token"})
+                return
+            if hello.get("version") != PROTOCOL_VERSION:
+                self.send({"type": "rejected", "error": f"Expected protocol version {PROTOCOL_VERSION}"})
+                return
+            self.send({"type": "welcome", "slots": server.slots})
+            try:
+                request = read_message(self.rfile)
+            except EOFError:
+                return  # Just probing us
+            if not server.slot_semaphore.acquire(blocking=False):
+                self.send({"type": "failed", "error": "All slots are busy"})
+                return
+            try:
+                self.run_shard(request)
+            finally:
+                server.slot_semaphore.release()
+        except (OSError, EOFError, ValueError) as e:
+            print(f"Lost connection to {self.client_address[0]}: {e}")
+
+    def send(self, message, payload=None):
+        with self.send_lock:
+            send_message(self.connection, message, payload)
+
+    def run_shard(self, request):
+        server = self.server  # type: WorkerServer
+        kind = request.get("kind")
+        if kind not in SHARD_KINDS:
+            self.send({"type": "failed", "error": f"Unknown shard kind: {kind}"})
+            return
+        blobs = request.get("blobs", {})
+        self.send({"type": "need", "blobs": sorted({digest for digest in blobs.values() if not server.blobs.contains(digest)})})
+        while True:
+            message = read_message(self.rfile)
+            if message.get("type") != "blob":
+                break
+            server.blobs.receive(self.rfile, message["digest"], message["size"])
+        inputs = {name: server.blobs.path(digest) for name, digest in blobs.items()}
+        missing = [name for name, location in inputs.items() if not location.exists()]
+        if missing:
+            self.send({"type": "failed", "error": f"Missing inputs: {', '.join(missing)}"})
+            return
+        start = time.monotonic()
+        print(f"Running {kind} shard for {self.client_address[0]}")
+        with tempfile.TemporaryDirectory(prefix=f"{kind}-", dir=server.work_dir) as shard_dir:
+            outcome = {}
+            finished = Event()
+
+            def run():
+                try:
+                    outcome['result'] = SHARD_KINDS[kind](inputs, request.get("request", {}), Path(shard_dir))
+                except Exception as e:
+                    outcome['error'] = e
+                finally:
+                    finished.set()
+            Thread(target=run, name=f"{kind}-shard", daemon=True).start()
+            while not finished.wait(HEARTBEAT_INTERVAL):
+                self.send({"type": "heartbeat"})
+            if 'error' in outcome:
+                error = outcome['error']
+                print(f"Failed to run {kind} shard: {error}")
+                self.send({"type": "failed", "error": str(error) or type(error).__name__})
+                return
+            result_file, summary = outcome['result']
+            self.send({"type": "result", "summary": summary}, payload=result_file)
+        print(f"Finished {kind} shard in {time.monotonic() - start:.1f} seconds")
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], slots: int, token: str, work_dir: Path):
+        super().__init__(address, _WorkerHandler)
+        self.slots = slots
+        self.slot_semaphore = Semaphore(slots)
+        self.token = token
+        self.work_dir = work_dir
+        self.blobs = BlobStore(Path(work_dir, "blobs"))
+
+
+def serve_worker(listen: str, slots: int, token: Optional[str], work_dir: Optional[Path] = None):
+    """
+    Run shards for coordinators until interrupted.
+
+    A token is always required, since even on loopback any local user could connect.
+    """
+    host, port = parse_address(listen)
+    if not token:
+        raise CommandError("Set FOUNTAIN_SHARD_TOKEN (or 'shardToken') before running a shard worker")
+    if work_dir is None:
+        work_dir = Path(WORK_DIR, "shard-worker")
+    with WorkerServer((host, port), slots, token, work_dir) as server:
+        server.blobs.expire()
+        print(f"Running up to {slots} shards at once on {host}:{server.server_address[1]}", flush=True)
+        server.serve_forever()
+
+
+WorkerState = namedtuple("WorkerState", ["address", "slots"])
+
+
+class ShardCluster:
+    """The remote workers available to this build, handing out their slots to shards"""
+
+    def __init__(self, workers: List[WorkerState], token: Optional[str]):
+        self.workers = workers
+        self.token = token
+        self._free = queue.Queue()
+        self._lost = set()
+        self._lock = Lock()
+        self._digests = {}  # type: Dict[Path, Tuple[Tuple[int, int], str]]
+        for worker in workers:
+            for _ in range(worker.slots):
+                self._free.put(worker.address)
+
+    @staticmethod
+    def connect(addresses: List[str], token: Optional[str]) -> Optional["ShardCluster"]:
+        """Ask each worker how many shards it can run, returning None if none of them are reachable"""
+        workers = []
+        for address in addresses:
+            try:
+                with ShardCluster._open(address, token) as (_, welcome):
+                    workers.append(WorkerState(address, max(1, int(welcome.get("slots", 1)))))
+            except (OSError, EOFError, ValueError, ShardWorkerError) as e:
+                print(f"WARNING: Skipping shard worker {address}: {e}")
+        if not workers:
+            return None
+        return ShardCluster(workers, token)
+
+    @property
+    def total_slots(self) -> int:
+        return sum(worker.slots for worker in self.workers if worker.address not in self._lost)
+
+    @staticmethod
+    def _open(address: str, token: Optional[str]):
+        host, port = parse_address(address)
+        connection = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+        try:
+            connection.settimeout(WORKER_TIMEOUT)
+            stream = connection.makefile('rb')
+            send_message(connection, {"type": "hello", "version": PROTOCOL_VERSION, "token": token})
+            welcome = read_message(stream)
+            if welcome.get("type") != "welcome":
+                raise ShardWorkerError(welcome.get("error", f"Unexpected response {welcome.get('type')}"))
+        except BaseException:
+            connection.close()
+            raise
+        return _Connection(connection, stream, welcome)
+
+    def digest(self, location: Path) -> str:
+        """The sha256 of the input, which is only computed again if it changes"""
+        stat = location.stat()
+        key = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            cached = self._digests.get(location)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        result = sha256_file(location)
+        with self._lock:
+            self._digests[location] = (key, result)
+        return result
+
+    def _acquire(self) -> Optional[str]:
+        """Wait for a free slot on a worker which isn't lost, returning None if they all are"""
+        while True:
+            with self._lock:
+                if len(self._lost) == len(self.workers):
+                    return None
+            try:
+                address = self._free.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self._lock:
+                if address not in self._lost:
+                    return address
+
+    def _release(self, address: str):
+        with self._lock:
+            if address not in self._lost:
+                self._free.put(address)
+
+    def _mark_lost(self, address: str):
+        with self._lock:
+            self._lost.add(address)
+
+    def run(self, kind: str, request: dict, inputs: Dict[str, Path], output: Path) -> dict:
+        """
+        Run the shard on a worker, writing its result to the output and returning its summary.
+
+        The shard is reassigned to another worker if the one running it is lost.
+
+        :exception ShardWorkerError: if no worker could run the shard
+        """
+        blobs = {name: self.digest(location) for name, location in inputs.items()}
+        last_error = None
+        for attempt in range(MAX_ATTEMPTS):
+            address = self._acquire()
+            if address is None:
+                break
+            try:
+                summary = self._run_on(address, kind, request, inputs, blobs, output)
+                REMOTE_SHARDS.inc(kind=kind, outcome="success")
+                return summary
+            except _LostWorker as e:
+                last_error = e
+                REMOTE_SHARDS.inc(kind=kind, outcome="lost")
+                print(f"WARNING: Lost shard worker {address} ({e}), reassigning its {kind} shard")
+                self._mark_lost(address)
+            except ShardWorkerError as e:
+                last_error = e
+                REMOTE_SHARDS.inc(kind=kind, outcome="failure")
+                print(f"WARNING: Shard worker {address} failed to run a {kind} shard: {e}")
+            finally:
+                self._release(address)
+        raise ShardWorkerError(f"Unable to run the {kind} shard remotely: {last_error or 'All workers were lost'}")
+
+    def _run_on(self, address, kind, request, inputs, blobs, output) -> dict:
+        try:
+            with self._open(address, self.token) as (connection, _):
+                stream = connection.stream
+                send_message(connection.socket, {"type": "shard", "kind": kind, "request": request, "blobs": blobs})
+                needed = read_message(stream)
+                if needed.get("type") != "need":
+                    raise ShardWorkerError(needed.get("error", f"Unexpected response {needed.get('type')}"))
+                digests = {digest: name for name, digest in blobs.items()}
+                for digest in needed["blobs"]:
+                    send_message(connection.socket, {"type": "blob", "digest": digest}, payload=inputs[digests[digest]])
+                send_message(connection.socket, {"type": "run"})
+                while True:
+                    message = read_message(stream)
+                    message_type = message.get("type")
+                    if message_type == "heartbeat":
+                        continue
+                    elif message_type == "result":
+                        if "size" in message:
+                            receive_payload(stream, message["size"], output)
+                        return message["summary"]
+                    elif message_type == "failed":
+                        raise ShardWorkerError(message.get("error"))
+                    else:
+                        raise _LostWorker(f"Unexpected message {message_type}")
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            raise _LostWorker(str(e) or type(e).__name__) from e
+
+
+class _Connection(namedtuple("_Connection", ["socket", "stream", "welcome"])):
+    def __enter__(self):
+        return self, self.welcome
+
+    def __exit__(self, *args):
+        self.stream.close()
+        self.socket.close()
+
+
+def configured_workers() -> List[str]:
+    workers = os.getenv("FOUNTAIN_SHARD_WORKERS")
+    if workers is not None:
+        return [worker.strip() for worker in workers.split(',') if worker.strip()]
+    return list(configuration().get("shardWorkers", []))
+
+
+_cluster = None
+_cluster_lock = Lock()
+
+
+def configured_cluster() -> Optional[ShardCluster]:
+    """The cluster of the configured workers, or None if there aren't any (or they're all unreachable)"""
+    global _cluster
+    with _cluster_lock:
+        if _cluster is None:
+            addresses = configured_workers()
+            token = shard_token()
+            if addresses and not token:
+                print("WARNING: Ignoring the shard workers, since FOUNTAIN_SHARD_TOKEN (or 'shardToken') isn't set")
+                addresses = []
+            _cluster = ShardCluster.connect(addresses, token) if addresses else False
+        return _cluster or None
@@ -0,0 +1,311 @@
+"""
+Robust downloading of remote files, shared by the build system and the dependency bootstrap.
+
+NOTE: This module must only depend on the standard library,
+since downloadDependency.py uses it before our dependencies are available.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import ssl
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from pathlib import Path
+from threading import Lock
+from urllib.parse import urlsplit, urljoin
+
+__all__ = (
+    "DownloadError",
+    "DownloadRequest",
+    "DownloadManager",
+    "default_manager",
+)
+
+USER_AGENT = "TacoFountain"
+REDIRECT_CODES = frozenset((301, 302, 303, 307, 308))
+MAX_REDIRECTS = 10
+BUFFER_SIZE = 1024 * 64
+
+
+class DownloadError(Exception):
+    """Raised when a file can't be downloaded, even after retrying"""
+
+
+class _RetryableError(DownloadError):
+    """An error which may be fixed by trying again, like a server error or a truncated response"""
+
+
+DownloadRequest = namedtuple("DownloadRequest", ["url", "target", "sha1", "sha256", "conditional"])
+DownloadRequest.__new__.__defaults__ = (None, None, False)
+
+
+class ConnectionPool:
+    """Keeps idle keep-alive connections around, so repeated requests to the same host can reuse them"""
+
+    def __init__(self, max_idle_per_host=4, timeout=30):
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = Lock()
+        self._ssl_context = ssl.create_default_context()
+
+    def acquire(self, scheme, netloc):
+        key = (scheme, netloc)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return HTTPSConnection(netloc, timeout=self.timeout, context=self._ssl_context)
+        elif scheme == 'http':
+            return HTTPConnection(netloc, timeout=self.timeout)
+        else:
+            raise DownloadError(f"Unsupported url scheme: {scheme}")
+
+    def release(self, scheme, netloc, connection, reusable=True):
+        if not reusable:
+            connection.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+def _metadata_file(target: Path) -> Path:
+    return Path(target.parent, target.name + ".download.json")
+
+
+def _partial_file(target: Path) -> Path:
+    return Path(target.parent, target.name + ".part")
+
+
+@contextmanager
+def _download_lock(target: Path):
+    """Lock the target, so concurrent builds don't write to the same partial file"""
+    fd = os.open(str(Path(target.parent, target.name + ".download.lock")), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # Releases the lock
+
+
+def _load_metadata(location: Path):
+    try:
+        with open(location) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_metadata(location: Path, metadata):
+    temp_file = Path(location.parent, f"{location.name}.{os.getpid()}.tmp")
+    with open(temp_file, 'wt') as f:
+        json.dump(metadata, f, sort_keys=True, indent=4)
+    os.replace(temp_file, location)
+
+
+def _hash_file(location, algorithm):
+    h = hashlib.new(algorithm)
+    with open(location, 'rb') as f:
+        while True:
+            data = f.read(BUFFER_SIZE)
+            if not data:
+                return h.hexdigest()
+            h.update(data)
+
+
+def _verify_hashes(location, expected_hashes):
+    for algorithm, expected in expected_hashes.items():
+        actual = _hash_file(location, algorithm)
+        if actual != expected.lower():
+            raise _RetryableError(f"Invalid {algorithm} for {location.name}: Expected {expected}, but got {actual}")
+
+
+class DownloadManager:
+    """
+    Downloads files with retries, resuming partial downloads with HTTP Range requests.
+
+    Files are first written to a '.part' file next to the target, which is only renamed into place
+    once it's complete and has been verified against the expected hashes.
+    The ETag and Last-Modified headers of each file are saved,
+    so conditional downloads can avoid transferring unchanged files.
+    """
+
+    def __init__(self, max_workers=4, retries=3, timeout=30, backoff=1.0, quiet=False):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.quiet = quiet
+        self.pool = ConnectionPool(max_idle_per_host=max_workers, timeout=timeout)
+
+    def download(self, url: str, target: Path, sha1=None, sha256=None, conditional=False) -> bool:
+        """
+        Download the url to the target file, returning if anything new was downloaded.
+
+        If the target already exists, it's only downloaded again when conditional is true
+        and the server reports that it has changed, or if it doesn't match the expected hashes.
+
+        :param conditional: whether to check if the server has a newer version of an existing file
+        :exception DownloadError: if the file couldn't be downloaded even after retrying
+        """
+        target = Path(target)
+        expected_hashes = {}
+        if sha1 is not None:
+            expected_hashes['sha1'] = sha1
+        if sha256 is not None:
+            expected_hashes['sha256'] = sha256
+        metadata_file = _metadata_file(target)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE: Check the target under the lock, since another process may have just finished downloading it
+        with _download_lock(target):
+            if target.exists():
+                if expected_hashes:
+                    try:
+                        _verify_hashes(target, expected_hashes)
+                    except _RetryableError:
+                        os.remove(target)
+                    else:
+                        if not conditional:
+                            return False
+                elif not conditional:
+                    return False
+            last_error = None
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(self.backoff * (2 ** (attempt - 1)))
+                try:
+                    return self._attempt_download(url, target, metadata_file, expected_hashes)
+                except (_RetryableError, OSError, HTTPException) as e:
+                    last_error = e
+                    if not self.quiet:
+                        print(f"WARNING: Error downloading {url} (attempt {attempt + 1}): {e}", file=sys.stderr)
+            raise DownloadError(f"Unable to download {url}: {last_error}")
+
+    def download_all(self, requests) -> dict:
+        """
+        Concurrently download all the specified DownloadRequests
+
+        :return: a dictionary of each target to whether anything new was downloaded
+        :exception DownloadError: if any of the downloads failed
+        """
+        requests = [DownloadRequest(*request) for request in requests]
+        if not requests:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(requests))) as executor:
+            futures = [
+                (request.target, executor.submit(
+                    self.download, request.url, request.target,
+                    sha1=request.sha1, sha256=request.sha256,
+                    conditional=request.conditional
+                ))
+                for request in requests
+            ]
+            return {target: future.result() for target, future in futures}
+
+    def _attempt_download(self, url, target, metadata_file, expected_hashes) -> bool:
+        partial_file = _partial_file(target)
+        metadata = _load_metadata(metadata_file)
+        headers = {"User-Agent": USER_AGENT, "Accept-Encoding": "identity"}
+        if target.exists():
+            if 'etag' in metadata:
+                headers['If-None-Match'] = metadata['etag']
+            if 'lastModified' in metadata:
+                headers['If-Modified-Since'] = metadata['lastModified']
+        resume_offset = partial_file.stat().st_size if partial_file.exists() else 0
+        partial_validator = metadata.get('partialValidator')
+        if resume_offset and partial_validator:
+            headers['Range'] = f"bytes={resume_offset}-"
+            # Only resume if the remote file is still the one we started downloading
+            headers['If-Range'] = partial_validator
+        else:
+            resume_offset = 0
+        for _ in range(MAX_REDIRECTS):
+            parts = urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            connection = self.pool.acquire(parts.scheme, parts.netloc)
+            reusable = False
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                if response.status in REDIRECT_CODES:
+                    response.read()
+                    reusable = not response.will_close
+                    url = urljoin(url, response.getheader('Location'))
+                    continue
+                elif response.status == 304:
+                    response.read()
+                    reusable = not response.will_close
+                    return False
+                elif response.status == 416:
+                    # Our partial file is bogus, so start over from scratch
+                    response.read()
+                    os.remove(partial_file)
+                    raise _RetryableError("Unsatisfiable range request")
+                elif response.status >= 500:
+                    raise _RetryableError(f"Server error {response.status} {response.reason}")
+                elif response.status not in (200, 206):
+                    raise DownloadError(f"Unexpected response {response.status} {response.reason} for {url}")
+                resuming = response.status == 206 and resume_offset
+                validator = response.getheader('ETag') or response.getheader('Last-Modified')
+                if validator != partial_validator:
+                    metadata['partialValidator'] = validator
+                    _save_metadata(metadata_file, metadata)
+                expected_length = response.getheader('Content-Length')
+                written = 0
+                with open(partial_file, 'ab' if resuming else 'wb') as f:
+                    while True:
+                        data = response.read(BUFFER_SIZE)
+                        if not data:
+                            break
+                        f.write(data)
+                        written += len(data)
+                if expected_length is not None and written != int(expected_length):
+                    raise _RetryableError(f"Truncated response: Expected {expected_length} bytes, but got {written}")
+                reusable = not response.will_close
+                break
+            finally:
+                self.pool.release(parts.scheme, parts.netloc, connection, reusable=reusable)
+        else:
+            raise DownloadError(f"Too many redirects for {url}")
+        try:
+            _verify_hashes(partial_file, expected_hashes)
+        except _RetryableError:
+            os.remove(partial_file)
+            raise
+        os.replace(partial_file, target)
+        metadata = {"url": url}
+        if response.getheader('ETag') is not None:
+            metadata['etag'] = response.getheader('ETag')
+        if response.getheader('Last-Modified') is not None:
+            metadata['lastModified'] = response.getheader('Last-Modified')
+        _save_metadata(metadata_file, metadata)
+        return True
+
+
+_default_manager = None
+
+
+def default_manager() -> DownloadManager:
+    global _default_manager
+    result = _default_manager
+    if result is None:
+        result = _default_manager = DownloadManager()
+    return result
@@ -0,0 +1,103 @@
+"""
+Reading and writing source files as lines, which sits under every loop of the patch, diff and fix pipeline.
+
+Files are always UTF-8, and are read in a single operation then split in a single pass.
+Writes are a single buffered operation, atomically replacing the existing file.
+"""
+import mmap
+import os
+from pathlib import Path
+from typing import List
+
+__all__ = (
+    "read_bytes",
+    "read_lines",
+    "decode_lines",
+    "encode_lines",
+    "newline_style",
+    "write_bytes",
+    "write_lines",
+)
+
+ENCODING = 'utf-8'
+# Larger files are memory mapped instead of read into a temporary buffer
+MMAP_THRESHOLD = 1024 * 1024
+
+
+def decode_lines(data) -> List[str]:
+    """
+    Decode the bytes into lines without their line endings.
+
+    Like text-mode files, '\\r\\n', '\\r' and '\\n' are all line endings, and a trailing newline doesn't add an empty line.
+    """
+    text = str(data, ENCODING)
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def encode_lines(lines, newline='\n') -> bytes:
+    """Encode the lines, terminating each of them with the newline"""
+    return ''.join(line + newline for line in lines).encode(ENCODING)
+
+
+def newline_style(data) -> str:
+    """Detect the newline style of the data from its first line ending, defaulting to unix newlines"""
+    index = data.find(b'\n')
+    if index > 0 and data[index - 1:index] == b'\r':
+        return '\r\n'
+    return '\n'
+
+
+def read_bytes(location) -> bytes:
+    with open(location, 'rb') as f:
+        return f.read()
+
+
+def read_lines(location) -> List[str]:
+    """Read the lines of the file, memory mapping it if it's large"""
+    with open(location, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            return decode_lines(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return decode_lines(data)
+
+
+def _unchanged(location: Path, data: bytes) -> bool:
+    try:
+        if os.stat(location).st_size != len(data):
+            return False
+    except FileNotFoundError:
+        return False
+    return read_bytes(location) == data
+
+
+def write_bytes(location, data: bytes, skip_unchanged=False) -> bool:
+    """
+    Atomically replace the file with the data, so readers never see a partially written file.
+
+    :param skip_unchanged: don't touch the file if it already has the same contents, preserving its mtime
+    :return: whether the file was written
+    """
+    location = Path(location)
+    if skip_unchanged and _unchanged(location, data):
+        return False
+    temp_file = Path(location.parent, f".{location.name}.{os.getpid()}.tmp")
+    try:
+        with open(temp_file, 'wb') as f:
+            f.write(data)
+        os.replace(temp_file, location)
+    except BaseException:
+        if temp_file.exists():
+            os.remove(temp_file)
+        raise
+    return True
+
+
+def write_lines(location, lines, newline='\n', skip_unchanged=False) -> bool:
+    """Atomically write the lines to the file, returning whether it was written"""
+    return write_bytes(location, encode_lines(lines, newline), skip_unchanged=skip_unchanged)
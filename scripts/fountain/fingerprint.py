@@ -0,0 +1,162 @@
+"""
+Fast change detection for source trees and jars, in the spirit of git's index.
+
+The (size, mtime, inode) of each file is cached alongside its digest,
+so only files whose stat information changed ever need to be rehashed.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict
+
+from . import WORK_DIR, hash_file
+
+FINGERPRINT_CACHE = Path(WORK_DIR, "fingerprints")
+# Files modified this close to when the cache was written may be modified again without changing their mtime
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+
+class TreeFingerprint(namedtuple("TreeFingerprint", ["root", "files"])):
+    """The merkle root of a tree, along with the digests of each of its files"""
+    root: bytes
+    files: Dict[str, bytes]
+
+    def changed_files(self, other: "TreeFingerprint"):
+        """Determine the relative paths of files which differ from the other fingerprint"""
+        if self.root == other.root:
+            return set()
+        result = set()
+        for name, digest in self.files.items():
+            if other.files.get(name) != digest:
+                result.add(name)
+        result.update(name for name in other.files.keys() if name not in self.files)
+        return result
+
+
+def _cache_file(location: Path, algorithm) -> Path:
+    key = hashlib.sha256(str(location).encode('utf-8')).hexdigest()[:32]
+    return Path(FINGERPRINT_CACHE, f"{key}-{algorithm}.json")
+
+
+def _load_cache(cache_file: Path, location: Path):
+    try:
+        with open(cache_file) as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if data.get('location') != str(location):
+        return {}  # Hash collision
+    timestamp = data['timestamp']
+    result = {}
+    for name, (size, mtime, inode, digest) in data['entries'].items():
+        if mtime + RACY_WINDOW_NS >= timestamp:
+            continue  # Racily clean, so we can't trust it
+        result[name] = (size, mtime, inode, digest)
+    return result
+
+
+def _save_cache(cache_file: Path, location: Path, entries):
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = Path(cache_file.parent, f"{cache_file.name}.{os.getpid()}.tmp")
+    with open(temp_file, 'wt') as f:
+        json.dump({
+            "location": str(location),
+            "timestamp": time.time_ns(),
+            "entries": entries
+        }, f, separators=(',', ':'))
+    os.replace(temp_file, cache_file)
+
+
+def _scan_tree(root: Path, ignore_hidden):
+    """Recursively list the stats of each regular file in the tree, keyed by their relative posix paths"""
+    result = {}
+    pending = [(root, "")]
+    while pending:
+        directory, prefix = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if ignore_hidden and entry.name.startswith('.'):
+                    continue
+                name = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append((entry.path, name + "/"))
+                elif entry.is_file():
+                    stat = entry.stat()
+                    result[name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    return result
+
+
+def merkle_root(files: Dict[str, bytes], algorithm='sha256') -> bytes:
+    """Compute the merkle root of the specified file digests, hashing each directory's children together"""
+    children = {}
+    for name in files.keys():
+        parts = name.split('/')
+        for depth in range(len(parts)):
+            parent = '/'.join(parts[:depth])
+            children.setdefault(parent, set()).add('/'.join(parts[:depth + 1]))
+
+    def directory_digest(directory):
+        h = hashlib.new(algorithm)
+        for child in sorted(children.get(directory, ())):
+            if child in files:
+                child_digest = files[child]
+                h.update(b'f')
+            else:
+                child_digest = directory_digest(child)
+                h.update(b'd')
+            h.update(child.rpartition('/')[2].encode('utf-8'))
+            h.update(b'\0')
+            h.update(child_digest)
+        return h.digest()
+    return directory_digest("")
+
+
+def fingerprint_tree(location: Path, algorithm='sha256', jobs=None, ignore_hidden=True) -> TreeFingerprint:
+    """
+    Fingerprint the specified tree, only rehashing files whose stat information has changed.
+
+    If the location is a single file, the root is just the digest of the file.
+    """
+    location = Path(location).absolute()
+    cache_file = _cache_file(location, algorithm)
+    cached_entries = _load_cache(cache_file, location)
+    if location.is_file():
+        stat = location.stat()
+        stats = {location.name: (stat.st_size, stat.st_mtime_ns, stat.st_ino)}
+        base = location.parent
+    elif location.is_dir():
+        stats = _scan_tree(location, ignore_hidden)
+        base = location
+    else:
+        raise FileNotFoundError(f"Can't fingerprint missing file: {location}")
+    files = {}
+    stale = []
+    for name, stat in stats.items():
+        cached = cached_entries.get(name)
+        if cached is not None and tuple(cached[:3]) == stat:
+            files[name] = bytes.fromhex(cached[3])
+        else:
+            stale.append(name)
+    if stale:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for name, digest in zip(stale, executor.map(
+                lambda name: hash_file(Path(base, name), algorithm), stale
+            )):
+                files[name] = digest
+    if stale or len(cached_entries) != len(stats):
+        _save_cache(cache_file, location, {
+            name: [*stat, files[name].hex()]
+            for name, stat in stats.items()
+        })
+    if location.is_file():
+        return TreeFingerprint(root=files[location.name], files=files)
+    return TreeFingerprint(root=merkle_root(files, algorithm), files=files)
+
+
+def fingerprint(location: Path, algorithm='sha256') -> bytes:
+    """Compute the fingerprint of the specified tree or file"""
+    return fingerprint_tree(location, algorithm=algorithm).root
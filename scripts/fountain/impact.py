@@ -0,0 +1,168 @@
+"""
+Determine which patches are affected when the unpatched sources change, like when TacoSpigot is updated.
+
+After the patches are applied, we index the digest of every unpatched file,
+along with where each hunk applied and a fingerprint of the lines it relies on.
+Comparing the index against the new unpatched sources only needs to look at the files which actually changed.
+"""
+import hashlib
+import json
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import version_work_dir
+from .fileio import read_bytes, read_lines, write_bytes
+from .fingerprint import fingerprint_tree
+from .patching import HunkResult, parse_hunks, locate_hunk, iter_patch_files, DEFAULT_MAX_FUZZ
+from .stages import SourceTree, DirectoryTree
+
+
+IndexedHunk = namedtuple("IndexedHunk", ["start", "length", "context"])
+IndexedPatch = namedtuple("IndexedPatch", ["target", "patch_hash", "hunks"])
+
+
+class PatchImpact(namedtuple("PatchImpact", ["target", "status", "hunks", "error"])):
+    """How a single patch is affected by the changes to its target"""
+    target: str
+    status: str  # One of 'untouched', 'shifted', 'conflicting'
+    hunks: List[HunkResult]
+    error: Optional[str]
+
+
+def _context_hash(lines) -> str:
+    h = hashlib.sha256()
+    for line in lines:
+        h.update(line.encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+def _tree_digests(tree: SourceTree) -> Dict[str, str]:
+    if isinstance(tree, DirectoryTree):
+        # NOTE: Reuse the stat cache, so unchanged files are never reread
+        return {name: digest.hex() for name, digest in fingerprint_tree(tree.location).files.items()}
+    return {name: hashlib.sha256(tree.read_bytes(name)).hexdigest() for name in tree.iter_files()}
+
+
+def _index_patch(patch_file: Path, target: str, lines, max_fuzz=DEFAULT_MAX_FUZZ) -> IndexedPatch:
+    hunks = []
+    for hunk in parse_hunks(read_lines(patch_file)):
+        located = locate_hunk(hunk, lines, max_fuzz=max_fuzz)
+        start = located.actual_line - 1 if located is not None else None
+        hunks.append(IndexedHunk(start, len(hunk.original_lines), _context_hash(hunk.original_lines)))
+    return IndexedPatch(target, hashlib.sha256(read_bytes(patch_file)).hexdigest(), hunks)
+
+
+class PatchIndex:
+    patches: Dict[str, IndexedPatch]
+    files: Dict[str, str]
+
+    def __init__(self, patches: Dict[str, IndexedPatch], files: Dict[str, str]):
+        self.patches = patches
+        self.files = files
+
+    @staticmethod
+    def build(patches: Path, tree: SourceTree, max_fuzz=DEFAULT_MAX_FUZZ) -> "PatchIndex":
+        """Index the patches against the specified unpatched sources"""
+        indexed = {}
+        for patch_file, relative_path in iter_patch_files(patches):
+            target = relative_path.as_posix()
+            if tree.contains(target):
+                indexed[target] = _index_patch(patch_file, target, tree.read_lines(target), max_fuzz=max_fuzz)
+        return PatchIndex(indexed, _tree_digests(tree))
+
+    @staticmethod
+    def location(version=None) -> Path:
+        return Path(version_work_dir(version), "patch-index.json")
+
+    @staticmethod
+    def load() -> Optional["PatchIndex"]:
+        try:
+            with open(PatchIndex.location()) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        patches = {
+            target: IndexedPatch(target, entry['patchHash'], [IndexedHunk(*hunk) for hunk in entry['hunks']])
+            for target, entry in data['patches'].items()
+        }
+        return PatchIndex(patches, data['files'])
+
+    def update(self, patch_file: Path, target: str, tree: SourceTree, max_fuzz=DEFAULT_MAX_FUZZ):
+        """Reindex the patch against the new version of its target"""
+        self.patches[target] = _index_patch(patch_file, target, tree.read_lines(target), max_fuzz=max_fuzz)
+
+    def save(self):
+        location = PatchIndex.location()
+        location.parent.mkdir(parents=True, exist_ok=True)
+        write_bytes(location, json.dumps({
+            "patches": {
+                target: {"patchHash": patch.patch_hash, "hunks": [list(hunk) for hunk in patch.hunks]}
+                for target, patch in self.patches.items()
+            },
+            "files": self.files
+        }, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+
+def changed_files(index: PatchIndex, digests: Dict[str, str]):
+    """Determine which files were modified, added or removed since the index was built"""
+    result = {name for name, digest in digests.items() if index.files.get(name) != digest}
+    result.update(name for name in index.files.keys() if name not in digests)
+    return result
+
+
+def _hunk_in_place(indexed: IndexedHunk, lines) -> bool:
+    if indexed.start is None or indexed.start + indexed.length > len(lines):
+        return False
+    return _context_hash(lines[indexed.start:indexed.start + indexed.length]) == indexed.context
+
+
+def classify_patch(patch_file: Path, target: str, tree: SourceTree, indexed: Optional[IndexedPatch], max_fuzz=DEFAULT_MAX_FUZZ) -> PatchImpact:
+    """Determine how the patch is affected by the new version of its target"""
+    if not tree.contains(target):
+        return PatchImpact(target, "conflicting", [], f"Couldn't find original {target}")
+    lines = tree.read_lines(target)
+    hunks = parse_hunks(read_lines(patch_file))
+    if indexed is not None and indexed.patch_hash != hashlib.sha256(read_bytes(patch_file)).hexdigest():
+        indexed = None  # The patch itself changed, so the index is useless
+    results = []
+    status = "untouched"
+    for hunk in hunks:
+        indexed_hunk = indexed.hunks[hunk.index] if indexed is not None and hunk.index < len(indexed.hunks) else None
+        if indexed_hunk is not None and _hunk_in_place(indexed_hunk, lines):
+            # Fast path: the lines the hunk relies on haven't moved
+            results.append(HunkResult(hunk, indexed_hunk.start + 1, indexed_hunk.start + 1, 0, 0))
+            continue
+        located = locate_hunk(hunk, lines, max_fuzz=max_fuzz)
+        if located is None:
+            results.append(HunkResult(hunk, hunk.original_start + 1, None, None, None))
+            status = "conflicting"
+            continue
+        expected_start = indexed_hunk.start if indexed_hunk is not None and indexed_hunk.start is not None else hunk.original_start
+        if located.fuzz or located.actual_line - 1 != expected_start:
+            located = located._replace(expected_line=expected_start + 1, offset=located.actual_line - 1 - expected_start)
+            if status == "untouched":
+                status = "shifted"
+        results.append(located)
+    return PatchImpact(target, status, results, None)
+
+
+def analyze_impact(patches: Path, tree: SourceTree, index: PatchIndex, max_fuzz=DEFAULT_MAX_FUZZ):
+    """
+    Classify every patch whose target (or the patch itself) changed since the index was built.
+
+    :return: the affected patch files and their impact, the set of changed files, and the new digests of every file
+    """
+    digests = _tree_digests(tree)
+    changed = changed_files(index, digests)
+    impacts = []
+    for patch_file, relative_path in iter_patch_files(patches):
+        target = relative_path.as_posix()
+        indexed = index.patches.get(target)
+        if target not in changed and indexed is not None \
+                and indexed.patch_hash == hashlib.sha256(read_bytes(patch_file)).hexdigest():
+            continue  # Neither the patch nor its target changed
+        impacts.append((patch_file, classify_patch(patch_file, target, tree, indexed, max_fuzz=max_fuzz)))
+    impacts.sort(key=lambda impact: impact[1].target)
+    return impacts, changed, digests
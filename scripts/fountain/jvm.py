@@ -0,0 +1,337 @@
+"""
+Admission control for the JVMs we run, so concurrent stages don't oversubscribe the machine.
+
+Each tool has a profile of how much heap and how many processors it wants,
+and every job reserves its memory and processors in a ledger shared by all the builds on the machine.
+Jobs which don't fit wait in line instead of overcommitting, since an OOM-killed JVM throws away the whole stage.
+The line is first come first served, so a stream of small jobs can't keep overtaking a big one.
+The peak RSS of each job is recorded, so later jobs reserve what the tool actually uses.
+"""
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+from subprocess import CalledProcessError, CompletedProcess, Popen
+from threading import Lock, Thread
+from typing import Dict, Iterator, List, Optional
+
+from . import WORK_DIR, configuration, locking, metrics
+from .fileio import write_bytes
+from .metrics import track_command
+
+__all__ = (
+    "JvmProfile",
+    "JvmJob",
+    "jvm_job",
+    "PROFILES",
+)
+
+
+class JvmProfile(namedtuple("JvmProfile", ["heap", "min_heap", "max_heap", "processors", "overhead"])):
+    """The resource needs of a tool, with all memory in megabytes"""
+    heap: int
+    min_heap: int  # Don't bother running it with less
+    max_heap: int  # The most heap it's given when it's been close to running out
+    processors: Optional[int]  # None if it can use every processor
+    overhead: int  # Memory used outside the heap, like metaspace and thread stacks
+
+
+PROFILES = {
+    "fernflower": JvmProfile(heap=2048, min_heap=1024, max_heap=4096, processors=2, overhead=384),
+    "rangeExtractor": JvmProfile(heap=2048, min_heap=1024, max_heap=6144, processors=None, overhead=384),
+    "findDecompileErrors": JvmProfile(heap=512, min_heap=256, max_heap=1536, processors=2, overhead=256),
+    "specialSource": JvmProfile(heap=1024, min_heap=512, max_heap=2048, processors=2, overhead=256),
+    "maven": JvmProfile(heap=1536, min_heap=768, max_heap=3072, processors=None, overhead=512),
+    "gradle": JvmProfile(heap=1024, min_heap=512, max_heap=2048, processors=None, overhead=512),
+}  # type: Dict[str, JvmProfile]
+
+# Leave some headroom when reserving from the observed peak, since runs vary
+PEAK_MARGIN = 1.25
+# Give a tool more heap if it previously peaked this close to its limit
+GROW_THRESHOLD = 0.9
+# The number of recent peaks remembered for each tool
+PEAK_HISTORY = 5
+
+QUEUE_DURATION = metrics.histogram("fountain_jvm_queue_seconds", "Time JVM jobs spent waiting for resources")
+PEAK_MEMORY = metrics.histogram(
+    "fountain_jvm_peak_rss_megabytes", "Peak RSS of JVM jobs, by tool",
+    buckets=(128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+)
+
+# NOTE: File locks are shared by the whole process, so threads need their own lock too
+_thread_lock = Lock()
+
+
+def state_dir() -> Path:
+    """The directory of the ledger, shared between builds (like the probes of bisect-upstream)"""
+    return Path(os.getenv("FOUNTAIN_JVM_STATE") or Path(WORK_DIR, "jvm"))
+
+
+def _total_memory() -> int:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except FileNotFoundError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+
+
+def _available_processors() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+Budget = namedtuple("Budget", ["memory", "processors"])
+
+
+def budget() -> Budget:
+    """The memory and processors all our JVMs may use at once, which defaults to 3/4 of the machine's memory"""
+    config = configuration()
+    memory = os.getenv("FOUNTAIN_JVM_MEMORY") or config.get("jvmMemory")
+    processors = os.getenv("FOUNTAIN_JVM_PROCESSORS") or config.get("jvmProcessors")
+    return Budget(
+        memory=int(memory) if memory else _total_memory() * 3 // 4,
+        processors=int(processors) if processors else _available_processors()
+    )
+
+
+def profile(tool: str) -> JvmProfile:
+    result = PROFILES[tool]
+    overrides = configuration().get("jvmProfiles", {}).get(tool)
+    if overrides:
+        result = result._replace(**{key: value for key, value in overrides.items() if key in JvmProfile._fields})
+    return result
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Ledger:
+    """The reservations of every running job and the line of waiting ones, which are only accessed while holding its lock"""
+
+    def __init__(self, location: Path):
+        self.location = location
+        self.queue_location = Path(location.parent, "queue.json")
+
+    @contextmanager
+    def lock(self):
+        with _thread_lock, locking.hold(Path(self.location.parent, ".locks", "ledger.lock")):
+            yield
+
+    def load(self) -> Dict[str, dict]:
+        try:
+            with open(self.location) as f:
+                reservations = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        # Forget the reservations of builds which died without releasing them
+        return {key: value for key, value in reservations.items() if _pid_alive(value['pid'])}
+
+    def save(self, reservations: Dict[str, dict]):
+        self.location.parent.mkdir(parents=True, exist_ok=True)
+        write_bytes(self.location, json.dumps(reservations, sort_keys=True, indent=4).encode('utf-8'))
+
+    def load_queue(self) -> List[dict]:
+        """The waiting jobs, in the order they arrived"""
+        try:
+            with open(self.queue_location) as f:
+                queue = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return []
+        # Forget the jobs of builds which died while waiting
+        return [entry for entry in queue if _pid_alive(entry['pid'])]
+
+    def save_queue(self, queue: List[dict]):
+        self.queue_location.parent.mkdir(parents=True, exist_ok=True)
+        write_bytes(self.queue_location, json.dumps(queue, indent=4).encode('utf-8'))
+
+    def leave_queue(self, key: str):
+        self.save_queue([entry for entry in self.load_queue() if entry['key'] != key])
+
+
+class PeakHistory:
+    """The recently observed peak RSS of each tool, along with the heap it was given"""
+
+    def __init__(self, location: Path):
+        self.location = location
+
+    def load(self) -> Dict[str, List[List[int]]]:
+        try:
+            with open(self.location) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def record(self, tool: str, heap: int, peak: int):
+        with _thread_lock, locking.hold(Path(self.location.parent, ".locks", "peaks.lock")):
+            history = self.load()
+            peaks = history.setdefault(tool, [])
+            peaks.append([heap, peak])
+            del peaks[:-PEAK_HISTORY]
+            self.location.parent.mkdir(parents=True, exist_ok=True)
+            write_bytes(self.location, json.dumps(history, sort_keys=True, indent=4).encode('utf-8'))
+
+
+def _size_job(tool: str, available: Budget, history) -> "JvmJob":
+    """Decide the heap, processors and reservation of the job, refined by the tool's previous peaks"""
+    tool_profile = profile(tool)
+    heap = tool_profile.heap
+    peaks = history.get(tool, [])
+    if any(peak >= (previous_heap + tool_profile.overhead) * GROW_THRESHOLD for previous_heap, peak in peaks):
+        # It came close to running out last time, so give it more room before it does
+        heap = min(tool_profile.max_heap, max(previous_heap for previous_heap, peak in peaks) * 3 // 2)
+    # Never ask for more than the whole budget, but don't bother going below the minimum
+    heap = max(tool_profile.min_heap, min(heap, available.memory - tool_profile.overhead))
+    limit = heap + tool_profile.overhead
+    if peaks and heap == tool_profile.heap:
+        # The JVM rarely fills its heap, so reserve what it actually used (but at least its minimum)
+        observed = int(max(peak for previous_heap, peak in peaks) * PEAK_MARGIN)
+        reservation = min(limit, max(tool_profile.min_heap + tool_profile.overhead, observed))
+    else:
+        reservation = limit
+    processors = min(tool_profile.processors or available.processors, available.processors)
+    return JvmJob(tool, heap, processors, reservation)
+
+
+class JvmJob:
+    """A JVM which has been admitted to run, with the heap and processors it was given"""
+    tool: str
+    heap: int
+    processors: int
+    reservation: int
+    peak: Optional[int]
+
+    def __init__(self, tool: str, heap: int, processors: int, reservation: int):
+        self.tool = tool
+        self.heap = heap
+        self.processors = processors
+        self.reservation = reservation
+        self.peak = None
+
+    @property
+    def options(self) -> List[str]:
+        return [f"-Xmx{self.heap}M", f"-XX:ActiveProcessorCount={self.processors}"]
+
+    def java(self, *args) -> List[str]:
+        """The command to run java with the job's options"""
+        return ["java", *self.options, *args]
+
+    def environment(self, env=None, variable='MAVEN_OPTS') -> Dict[str, str]:
+        """The environment for running maven (or a script which runs it) with the job's options"""
+        result = dict(os.environ if env is None else env)
+        result[variable] = ' '.join(filter(None, [result.get(variable), *self.options]))
+        return result
+
+    def wait(self, proc: Popen) -> int:
+        """
+        Wait for the process to exit, recording its peak RSS.
+
+        This must be used instead of proc.wait(), since we need the resource usage from wait4.
+        """
+        if proc.returncode is not None:
+            return proc.returncode
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        # NOTE: Linux reports the peak RSS in kilobytes
+        self.peak = rusage.ru_maxrss // 1024 if sys.platform != "darwin" else rusage.ru_maxrss // (1024 * 1024)
+        return proc.returncode
+
+    def run(self, command, check=False, **kwargs) -> CompletedProcess:
+        """Like subprocess.run, but recording the peak RSS of the process"""
+        with track_command(command), Popen(command, **kwargs) as proc:
+            outputs = {}
+            readers = []
+            for name, stream in (("stdout", proc.stdout), ("stderr", proc.stderr)):
+                if stream is not None:
+                    reader = Thread(target=lambda name=name, stream=stream: outputs.__setitem__(name, stream.read()))
+                    reader.start()
+                    readers.append(reader)
+            for reader in readers:
+                reader.join()
+            returncode = self.wait(proc)
+        result = CompletedProcess(command, returncode, outputs.get("stdout"), outputs.get("stderr"))
+        if check and returncode != 0:
+            raise CalledProcessError(returncode, command, result.stdout, result.stderr)
+        return result
+
+    def __repr__(self):
+        return f"JvmJob({self.tool}, heap={self.heap}M, processors={self.processors}, reservation={self.reservation}M)"
+
+
+@contextmanager
+def jvm_job(tool: str) -> Iterator[JvmJob]:
+    """
+    Wait until there's room to run the tool, then reserve its memory and processors until the block exits.
+
+    Jobs are admitted in the order they arrived, and a job which doesn't fit is still run once nothing else is,
+    so oversized jobs aren't starved.
+    """
+    directory = state_dir()
+    ledger = Ledger(Path(directory, "reservations.json"))
+    history = PeakHistory(Path(directory, "peaks.json"))
+    available = budget()
+    job = _size_job(tool, available, history.load())
+    key = f"{os.getpid()}-{id(job)}"
+    start = time.perf_counter()
+    delay = 0.1
+    warned = False
+    with ledger.lock():
+        queue = ledger.load_queue()
+        queue.append({"key": key, "pid": os.getpid(), "tool": tool})
+        ledger.save_queue(queue)
+    try:
+        while True:
+            with ledger.lock():
+                reservations = ledger.load()
+                queue = ledger.load_queue()
+                used_memory = sum(value['memory'] for value in reservations.values())
+                used_processors = sum(value['processors'] for value in reservations.values())
+                # NOTE: Only the job at the front of the line may start, even if a later one would fit
+                if queue[0]['key'] == key and (not reservations or (
+                    used_memory + job.reservation <= available.memory
+                    and used_processors + job.processors <= available.processors
+                )):
+                    reservations[key] = {
+                        "pid": os.getpid(), "tool": tool,
+                        "memory": job.reservation, "processors": job.processors
+                    }
+                    ledger.save(reservations)
+                    ledger.save_queue(queue[1:])
+                    break
+            if not warned:
+                print(f"Waiting for {job.reservation}M of memory to run {tool} ({used_memory}M of {available.memory}M in use)")
+                warned = True
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+    except BaseException:
+        with ledger.lock():
+            ledger.leave_queue(key)
+        raise
+    QUEUE_DURATION.observe(time.perf_counter() - start, tool=tool)
+    try:
+        yield job
+    finally:
+        with ledger.lock():
+            reservations = ledger.load()
+            reservations.pop(key, None)
+            ledger.save(reservations)
+        if job.peak is not None:
+            history.record(tool, job.heap, job.peak)
+            PEAK_MEMORY.observe(job.peak, tool=tool)
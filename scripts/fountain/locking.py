@@ -0,0 +1,98 @@
+"""Inter-process file locks, so concurrent builds don't trample on each other"""
+import fcntl
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Dict
+
+__all__ = ("FileLock", "hold")
+
+
+class FileLock:
+    """
+    An advisory lock on a file, held using flock.
+
+    The lock file itself is never deleted, since that would race with other processes acquiring it.
+    Locks are reentrant within a single FileLock instance, but not across instances.
+    """
+
+    def __init__(self, location: Path, shared=False):
+        self.location = Path(location)
+        self.shared = shared
+        self._fd = None
+        self._count = 0
+        self._thread_lock = Lock()
+
+    def acquire(self, blocking=True) -> bool:
+        with self._thread_lock:
+            if self._fd is not None:
+                self._count += 1
+                return True
+            self.location.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(str(self.location), os.O_RDWR | os.O_CREAT, 0o644)
+            flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fd, flags)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            except BaseException:
+                os.close(fd)
+                raise
+            self._fd = fd
+            self._count = 1
+            return True
+
+    def release(self):
+        with self._thread_lock:
+            assert self._fd is not None, f"Lock not held: {self.location}"
+            self._count -= 1
+            if self._count == 0:
+                fd, self._fd = self._fd, None
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __repr__(self):
+        return f"FileLock({self.location}, shared={self.shared})"
+
+
+_held_locks = {}  # type: Dict[Path, FileLock]
+_held_locks_lock = Lock()
+
+
+@contextmanager
+def hold(location: Path, shared=False):
+    """
+    Hold the lock on the file for the duration of the block.
+
+    Unlike a plain FileLock, this reuses the lock if this process already holds it,
+    so nested blocks (like a stage being rewritten while it's already locked) don't deadlock.
+    An exclusive lock also satisfies a nested request for a shared one,
+    but upgrading a shared lock isn't supported since two processes doing it at once would deadlock.
+    """
+    location = Path(location).absolute()
+    with _held_locks_lock:
+        lock = _held_locks.get(location)
+        if lock is None or not lock.held:
+            lock = _held_locks[location] = FileLock(location, shared=shared)
+        elif lock.shared and not shared:
+            raise RuntimeError(f"Can't upgrade shared lock to an exclusive one: {location}")
+    lock.acquire()
+    try:
+        yield lock
+    finally:
+        lock.release()
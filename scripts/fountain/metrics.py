@@ -0,0 +1,319 @@
+"""
+Build pipeline metrics, exported as a Prometheus textfile for the node exporter to scrape.
+
+Metrics are disabled unless a metrics file is specified with '--metrics-file'
+(or the FOUNTAIN_METRICS_FILE environment variable),
+in which case recording them is just a single check of a global flag.
+"""
+import os
+import subprocess
+import sys
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+__all__ = (
+    "Counter",
+    "Histogram",
+    "counter",
+    "histogram",
+    "stage",
+    "record_files",
+    "run",
+    "track_command",
+    "cache_lookup",
+    "dispatch_with_metrics",
+)
+
+# Stages and commands range from milliseconds to tens of minutes
+DEFAULT_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+_enabled = False
+_metrics_file = None  # type: Optional[Path]
+_lock = Lock()
+_registry = {}  # type: Dict[str, "Metric"]
+
+
+def _label_key(labels) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key, extra=()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type_name: str
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        samples = self.samples()
+        if not samples:
+            return []
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+            *samples
+        ]
+
+
+class Counter(Metric):
+    """A monotonically increasing count, with optional labels"""
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        assert name.endswith("_total"), f"Counter name must end with _total: {name}"
+        super().__init__(name, documentation)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        if not _enabled:
+            return
+        key = _label_key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [
+            f"{self.name}{_format_labels(key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Histogram(Metric):
+    """A distribution of observed values (usually durations in seconds), with optional labels"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value, **labels):
+        if not _enabled:
+            return
+        key = _label_key(labels)
+        with _lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0]
+            bucket_counts = entry[0]
+            index = bisect_left(self.buckets, value)
+            if index < len(bucket_counts):
+                bucket_counts[index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, even if it fails"""
+        if not _enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        result = []
+        for key, (bucket_counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                result.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(float(bound)))])} {cumulative}")
+            result.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+            result.append(f"{self.name}_sum{_format_labels(key)} {_format_value(float(total))}")
+            result.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return result
+
+
+def _register(metric: Metric) -> Metric:
+    with _lock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            assert type(existing) is type(metric), f"Conflicting types for {metric.name}"
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+
+def counter(name: str, documentation: str) -> Counter:
+    """Get or register the counter with the specified name"""
+    return _register(Counter(name, documentation))
+
+
+def histogram(name: str, documentation: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    """Get or register the histogram with the specified name"""
+    return _register(Histogram(name, documentation, buckets))
+
+
+COMMAND_DURATION = histogram("fountain_command_duration_seconds", "Duration of fountain commands")
+STAGE_DURATION = histogram("fountain_stage_duration_seconds", "Duration of each stage of the build pipeline")
+SUBPROCESS_DURATION = histogram("fountain_subprocess_duration_seconds", "Duration of external processes")
+SUBPROCESSES = counter("fountain_subprocesses_total", "External processes run, by program and outcome")
+FILES = counter("fountain_files_total", "Source files processed, by operation")
+BYTES = counter("fountain_bytes_total", "Bytes of source files processed, by operation")
+CACHE_LOOKUPS = counter("fountain_cache_lookups_total", "Lookups of cache-info.json entries, by key and result")
+PATCH_FAILURES = counter("fountain_patch_failures_total", "Patches which failed to apply")
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def stage(name: str):
+    """Time the specified stage of the pipeline"""
+    return STAGE_DURATION.time(stage=name)
+
+
+def record_files(operation: str, num_files=1, num_bytes=0):
+    if not _enabled:
+        return
+    FILES.inc(num_files, operation=operation)
+    if num_bytes:
+        BYTES.inc(num_bytes, operation=operation)
+
+
+def cache_lookup(key: str, hit: bool):
+    CACHE_LOOKUPS.inc(key=key, result="hit" if hit else "miss")
+
+
+def _record_command(command, start, outcome):
+    program = Path(str(command[0])).name if command else "unknown"
+    SUBPROCESS_DURATION.observe(time.perf_counter() - start, program=program)
+    SUBPROCESSES.inc(program=program, outcome=outcome)
+
+
+@contextmanager
+def track_command(command):
+    """Track the count and duration of the external process run by the block, which fails if it raises"""
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    outcome = "failure"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        _record_command(command, start, outcome)
+
+
+def run(command, *args, **kwargs) -> subprocess.CompletedProcess:
+    """Like subprocess.run, but tracking the external process"""
+    if not _enabled:
+        return subprocess.run(command, *args, **kwargs)
+    start = time.perf_counter()
+    outcome = "failure"
+    try:
+        result = subprocess.run(command, *args, **kwargs)
+        if result.returncode == 0:
+            outcome = "success"
+        return result
+    finally:
+        _record_command(command, start, outcome)
+
+
+def render() -> str:
+    with _lock:
+        lines = []
+        for name in sorted(_registry.keys()):
+            lines.extend(_registry[name].render())
+    return "".join(line + "\n" for line in lines)
+
+
+def write_metrics(location: Path):
+    """Atomically write the metrics to the textfile, so the node exporter never sees a partial file"""
+    location.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = Path(location.parent, f".{location.name}.{os.getpid()}.tmp")
+    try:
+        with open(temp_file, 'wt') as f:
+            f.write(render())
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, location)
+    finally:
+        if temp_file.exists():
+            os.remove(temp_file)
+
+
+def enable(location: Path):
+    global _enabled, _metrics_file
+    _metrics_file = Path(location)
+    _enabled = True
+
+
+def dispatch_with_metrics(parser, profile_dir=Path("work", "profiles")):
+    """
+    Dispatch the parser's commands, writing metrics afterwards if a metrics file was specified.
+
+    The command is also profiled if requested, writing the reports to a new directory in profile_dir.
+    """
+    parser.add_argument(
+        '--metrics-file',
+        default=os.getenv("FOUNTAIN_METRICS_FILE"),
+        help="Write Prometheus metrics to the specified textfile after the command"
+    )
+    profile_modes = set(filter(None, os.getenv("FOUNTAIN_PROFILE", "").split(',')))
+    parser.add_argument(
+        '--profile', action='store_true', default="sample" in profile_modes,
+        help="Profile the command with a sampling profiler, writing the reports to work/profiles"
+    )
+    parser.add_argument(
+        '--profile-cprofile', action='store_true', default="cprofile" in profile_modes,
+        help="Also profile the command with cProfile, which is exact but much slower"
+    )
+    parser.add_argument(
+        '--profile-memory', action='store_true', default="memory" in profile_modes,
+        help="Also report the top memory allocations using tracemalloc, which is much slower"
+    )
+    command_name = None
+    profiling = None  # Only imported if we're profiling
+
+    def pre_call(namespace):
+        nonlocal command_name, profiling
+        if namespace.metrics_file:
+            enable(Path(namespace.metrics_file).absolute())
+        command_name = namespace.get_function().__name__
+        if namespace.profile or namespace.profile_cprofile or namespace.profile_memory:
+            from . import profiling
+            output_dir = Path(profile_dir, f"{command_name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}").absolute()
+            profiling.start(output_dir, cprofile=namespace.profile_cprofile, memory=namespace.profile_memory)
+    start = time.perf_counter()
+    outcome = "failure"
+    try:
+        parser.dispatch(pre_call=pre_call)
+        outcome = "success"
+    except SystemExit as e:
+        if not e.code:
+            outcome = "success"
+        raise
+    finally:
+        if profiling is not None:
+            print(f"Wrote profile to {profiling.stop()}", file=sys.stderr)
+        if _enabled and command_name is not None:
+            COMMAND_DURATION.observe(time.perf_counter() - start, command=command_name, outcome=outcome)
+            write_metrics(_metrics_file)
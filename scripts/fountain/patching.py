@@ -0,0 +1,211 @@
+"""Validating patches against the unpatched sources, without actually writing anything"""
+import os
+from collections import namedtuple
+from pathlib import Path
+from typing import List, Optional
+
+from argh import CommandError
+from diffutils.api import PatchFailedException, PatchFormatError, parse_unified_diff
+
+from .fileio import read_lines
+from .stages import SourceTree
+
+# The maximum number of context lines GNU patch will ignore by default
+DEFAULT_MAX_FUZZ = 2
+
+
+class Hunk(namedtuple("Hunk", ["index", "patch_line", "original_start", "original_lines", "revised_lines", "leading_context", "trailing_context"])):
+    """A single hunk of a unified diff, including its context lines"""
+    index: int
+    patch_line: int
+    original_start: int  # Zero based
+    original_lines: List[str]
+    revised_lines: List[str]
+    leading_context: int
+    trailing_context: int
+
+
+HunkResult = namedtuple("HunkResult", ["hunk", "expected_line", "actual_line", "offset", "fuzz"])
+PatchCheckResult = namedtuple("PatchCheckResult", ["relative_path", "applies", "error", "hunks"])
+
+
+def parse_hunks(patch_lines) -> List[Hunk]:
+    """Parse the hunks of the unified diff, keeping the context lines that diffutils throws away"""
+    result = []
+    current = None
+
+    def finish_hunk():
+        if current is None:
+            return
+        tags = current['tags']
+        leading = 0
+        while leading < len(tags) and tags[leading] == ' ':
+            leading += 1
+        trailing = 0
+        while trailing < len(tags) - leading and tags[len(tags) - trailing - 1] == ' ':
+            trailing += 1
+        result.append(Hunk(
+            index=len(result),
+            patch_line=current['patch_line'],
+            original_start=current['original_start'],
+            original_lines=current['original_lines'],
+            revised_lines=current['revised_lines'],
+            leading_context=leading,
+            trailing_context=trailing
+        ))
+    in_prelude = True
+    for line_number, line in enumerate(patch_lines, start=1):
+        if in_prelude:
+            if line.startswith("+++"):
+                in_prelude = False
+            continue
+        if line.startswith("@@"):
+            finish_hunk()
+            try:
+                original_range = line.split()[1]
+                assert original_range.startswith('-')
+                original_start = int(original_range[1:].split(',')[0])
+            except (IndexError, ValueError, AssertionError):
+                raise PatchFormatError("Invalid hunk header", line_number, line)
+            current = {
+                "patch_line": line_number,
+                "original_start": max(0, original_start - 1),
+                "original_lines": [],
+                "revised_lines": [],
+                "tags": []
+            }
+            continue
+        if current is None:
+            raise PatchFormatError("Expected hunk header", line_number, line)
+        tag, rest = (line[:1], line[1:]) if line else (' ', '')
+        if tag == ' ':
+            current['original_lines'].append(rest)
+            current['revised_lines'].append(rest)
+        elif tag == '-':
+            current['original_lines'].append(rest)
+        elif tag == '+':
+            current['revised_lines'].append(rest)
+        else:
+            raise PatchFormatError(f"Invalid tag {tag}", line_number, line)
+        current['tags'].append(tag)
+    finish_hunk()
+    return result
+
+
+def _matches_at(lines, position, expected) -> bool:
+    if position < 0 or position + len(expected) > len(lines):
+        return False
+    for offset, expected_line in enumerate(expected):
+        if lines[position + offset] != expected_line:
+            return False
+    return True
+
+
+def locate_hunk(hunk: Hunk, lines, max_fuzz=DEFAULT_MAX_FUZZ) -> Optional[HunkResult]:
+    """
+    Locate where the hunk applies in the lines, like GNU patch does.
+
+    Positions closest to the expected one are preferred,
+    and up to max_fuzz context lines are ignored at either end of the hunk if it doesn't match exactly.
+    :return: where the hunk applies, or None if it doesn't apply anywhere
+    """
+    for fuzz in range(max_fuzz + 1):
+        leading_fuzz = min(fuzz, hunk.leading_context)
+        trailing_fuzz = min(fuzz, hunk.trailing_context)
+        if fuzz and not leading_fuzz and not trailing_fuzz:
+            break  # No more context to ignore
+        expected = hunk.original_lines[leading_fuzz:len(hunk.original_lines) - trailing_fuzz]
+        start = hunk.original_start + leading_fuzz
+        max_offset = max(start, len(lines) - start)
+        for distance in range(max_offset + 1):
+            for offset in ((distance, -distance) if distance else (0,)):
+                if _matches_at(lines, start + offset, expected):
+                    return HunkResult(
+                        hunk=hunk,
+                        expected_line=hunk.original_start + 1,
+                        actual_line=hunk.original_start + offset + 1,
+                        offset=offset,
+                        fuzz=fuzz
+                    )
+    return None
+
+
+def apply_located(lines, located: List[HunkResult]) -> List[str]:
+    """
+    Apply hunks at the positions they were located, like GNU patch does with offsets and fuzz.
+
+    The hunks must have been located against the same lines, and must not overlap.
+    """
+    replacements = []
+    for result in located:
+        hunk = result.hunk
+        leading_fuzz = min(result.fuzz, hunk.leading_context)
+        trailing_fuzz = min(result.fuzz, hunk.trailing_context)
+        start = result.actual_line - 1 + leading_fuzz
+        end = start + len(hunk.original_lines) - leading_fuzz - trailing_fuzz
+        revised = hunk.revised_lines[leading_fuzz:len(hunk.revised_lines) - trailing_fuzz]
+        replacements.append((start, end, revised))
+    replacements.sort(key=lambda replacement: replacement[0])
+    result_lines = []
+    position = 0
+    for start, end, revised in replacements:
+        if start < position:
+            raise PatchFailedException(f"Overlapping hunks at line {start + 1}")
+        result_lines.extend(lines[position:start])
+        result_lines.extend(revised)
+        position = end
+    result_lines.extend(lines[position:])
+    return result_lines
+
+
+def check_patch(patch_file: Path, unpatched_sources: SourceTree, relative_path: Path, max_fuzz=DEFAULT_MAX_FUZZ) -> PatchCheckResult:
+    """
+    Check if the patch still applies to the original file, and locate each of its hunks.
+
+    This is run in worker processes, so it only needs picklable arguments and results.
+    """
+    patch_lines = read_lines(patch_file)
+    original_name = relative_path.as_posix()
+    if not unpatched_sources.contains(original_name):
+        return PatchCheckResult(relative_path, False, f"Couldn't find original {original_name}", [])
+    original_lines = unpatched_sources.read_lines(original_name)
+    try:
+        patch = parse_unified_diff(patch_lines)
+        hunks = parse_hunks(patch_lines)
+    except PatchFormatError as e:
+        return PatchCheckResult(relative_path, False, f"Invalid patch: {e}", [])
+    try:
+        patch.apply_to(original_lines)
+        error = None
+    except PatchFailedException as e:
+        error = str(e)
+    hunk_results = []
+    for hunk in hunks:
+        located = locate_hunk(hunk, original_lines, max_fuzz=max_fuzz)
+        if located is None:
+            located = HunkResult(hunk, hunk.original_start + 1, None, None, None)
+        # NOTE: Drop the lines themselves, since they're useless in the report
+        hunk_results.append(located._replace(hunk=(hunk.index, hunk.patch_line)))
+    return PatchCheckResult(relative_path, error is None, error, hunk_results)
+
+
+def hunk_status(result: HunkResult) -> str:
+    if result.actual_line is None:
+        return "failed"
+    elif result.fuzz:
+        return "fuzz"
+    elif result.offset:
+        return "offset"
+    else:
+        return "clean"
+
+
+def iter_patch_files(patches: Path):
+    """Iterate over the patch files in the specified directory, along with the relative path of their targets"""
+    for patch_root, dirs, files in os.walk(str(patches)):
+        for patch_file_name in files:
+            patch_file = Path(patch_root, patch_file_name)
+            if patch_file.suffix != '.patch':
+                raise CommandError(f"Patch file doesn't end with '.patch': {patch_file_name}")
+            relative_path = Path(patch_file.parent.relative_to(patches), patch_file.stem)
+            yield patch_file, relative_path
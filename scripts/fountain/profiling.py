@@ -0,0 +1,234 @@
+"""
+Profiling the python side of the build, enabled with the '--profile' global option.
+
+The default profiler samples the stacks of every thread at a fixed interval, which is cheap enough to leave on
+for whole builds, and writes them as collapsed stacks (for flamegraph.pl or speedscope) along with the hottest functions.
+cProfile ('--profile-cprofile') gives exact call counts at a much higher overhead,
+and tracemalloc ('--profile-memory') reports the top allocations.
+Forked worker processes (like the ones checking patches) are profiled too, and their samples are merged into the report.
+
+NOTE: This module must only depend on the standard library.
+"""
+import cProfile
+import multiprocessing.util
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+__all__ = (
+    "Profiler",
+    "start",
+    "stop",
+)
+
+DEFAULT_INTERVAL = 0.005
+# The number of functions and allocations included in the reports
+TOP_ENTRIES = 50
+# Tracing allocations gets much slower with every frame recorded
+TRACEMALLOC_FRAMES = 10
+
+
+_frame_labels = {}
+
+
+def _frame_label(code) -> str:
+    result = _frame_labels.get(code)
+    if result is None:
+        filename = Path(code.co_filename)
+        result = f"{code.co_name} ({filename.parent.name}/{filename.name}:{code.co_firstlineno})".replace(';', ':')
+        _frame_labels[code] = result
+    return result
+
+
+def _collapse(frame, role: str, thread_name: str) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.append(thread_name.replace(';', ':'))
+    labels.append(role)
+    labels.reverse()
+    return ';'.join(labels)
+
+
+class _Sampler(threading.Thread):
+    """Periodically records the stack of every other thread"""
+
+    def __init__(self, role: str, interval: float):
+        super().__init__(name="fountain-profiler", daemon=True)
+        self.role = role
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.samples[_collapse(frame, self.role, str(names.get(thread_id, thread_id)))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class Profiler:
+    """Profiles this process, and any worker processes forked while it's running"""
+
+    def __init__(self, output_dir: Path, cprofile=False, memory=False, interval=DEFAULT_INTERVAL):
+        self.output_dir = output_dir
+        self.use_cprofile = cprofile
+        self.use_memory = memory
+        self.interval = interval
+        self.role = "main"
+        self.sampler = None  # type: Optional[_Sampler]
+        self.cprofile = None  # type: Optional[cProfile.Profile]
+        self.start_time = None
+
+    @property
+    def workers_dir(self) -> Path:
+        return Path(self.output_dir, "workers")
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.sampler = _Sampler(self.role, self.interval)
+        self.sampler.start()
+        if self.use_cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        if self.use_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        if self.role == "main":
+            # NOTE: Runs in forked multiprocessing children, after they've forgotten our finalizers
+            multiprocessing.util.register_after_fork(self, Profiler._start_worker)
+
+    def _start_worker(self):
+        if self.cprofile is not None:
+            # We inherited the parent's profiler, which already has its stats
+            self.cprofile.disable()
+        self.role = "worker"
+        self.start()
+        # NOTE: Worker processes exit with os._exit, so atexit handlers never run
+        multiprocessing.util.Finalize(self, self._stop_worker, exitpriority=100)
+
+    def _stop_worker(self):
+        self._stop_profilers()
+        self.workers_dir.mkdir(parents=True, exist_ok=True)
+        name = f"worker-{os.getpid()}"
+        _write_collapsed(Path(self.workers_dir, f"{name}.collapsed"), self.sampler.samples)
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(str(Path(self.workers_dir, f"{name}.pstats")))
+        if self.use_memory:
+            _write_allocations(Path(self.workers_dir, f"{name}-allocations.txt"), tracemalloc.take_snapshot())
+
+    def _stop_profilers(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        self.sampler.stop()
+
+    def stop(self) -> Path:
+        """Stop profiling, and write the reports (merging in the workers) to the output directory"""
+        self._stop_profilers()
+        elapsed = time.perf_counter() - self.start_time
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        samples = Counter(self.sampler.samples)
+        worker_pstats = []
+        if self.workers_dir.exists():
+            for worker_file in sorted(self.workers_dir.iterdir()):
+                if worker_file.suffix == ".collapsed":
+                    samples.update(_read_collapsed(worker_file))
+                elif worker_file.suffix == ".pstats":
+                    worker_pstats.append(str(worker_file))
+        _write_collapsed(Path(self.output_dir, "samples.collapsed"), samples)
+        _write_hot_functions(Path(self.output_dir, "hot-functions.txt"), samples, self.interval, elapsed)
+        if self.cprofile is not None:
+            stats = pstats.Stats(self.cprofile)
+            for worker_file in worker_pstats:
+                stats.add(worker_file)
+            stats.dump_stats(str(Path(self.output_dir, "cprofile.pstats")))
+            with open(Path(self.output_dir, "cprofile.txt"), 'wt') as f:
+                stats.stream = f
+                stats.sort_stats("cumulative").print_stats(TOP_ENTRIES)
+        if self.use_memory:
+            _write_allocations(Path(self.output_dir, "allocations.txt"), tracemalloc.take_snapshot())
+            tracemalloc.stop()
+        return self.output_dir
+
+
+def _write_collapsed(location: Path, samples: Counter):
+    with open(location, 'wt', encoding='utf-8') as f:
+        for stack, count in sorted(samples.items()):
+            f.write(f"{stack} {count}\n")
+
+
+def _read_collapsed(location: Path) -> Counter:
+    result = Counter()
+    with open(location, encoding='utf-8') as f:
+        for line in f:
+            stack, count = line.rstrip('\n').rsplit(' ', 1)
+            result[stack] += int(count)
+    return result
+
+
+def _write_hot_functions(location: Path, samples: Counter, interval: float, elapsed: float):
+    """Summarize the samples by function, both by the time spent in the function itself and including its callees"""
+    self_samples = Counter()
+    total_samples = Counter()
+    for stack, count in samples.items():
+        # Skip the role and thread name
+        frames = stack.split(';')[2:]
+        if not frames:
+            continue
+        self_samples[frames[-1]] += count
+        for frame in set(frames):
+            total_samples[frame] += count
+    num_samples = sum(samples.values())
+    with open(location, 'wt', encoding='utf-8') as f:
+        f.write(f"{num_samples} samples every {interval * 1000:.1f}ms over {elapsed:.1f}s of wall time\n")
+        for title, counts in (("Self", self_samples), ("Total", total_samples)):
+            f.write(f"\n{title} samples:\n")
+            for frame, count in counts.most_common(TOP_ENTRIES):
+                f.write(f"{count:8d} {count * 100 / max(num_samples, 1):6.2f}% {frame}\n")
+
+
+def _write_allocations(location: Path, snapshot):
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ))
+    with open(location, 'wt', encoding='utf-8') as f:
+        f.write("Top allocations by line:\n")
+        for statistic in snapshot.statistics('lineno')[:TOP_ENTRIES]:
+            f.write(f"{statistic}\n")
+        f.write("\nTop allocations by traceback:\n")
+        for statistic in snapshot.statistics('traceback')[:10]:
+            f.write(f"\n{statistic}\n")
+            for line in statistic.traceback.format():
+                f.write(f"{line}\n")
+
+
+_profiler = None  # type: Optional[Profiler]
+
+
+def start(output_dir: Path, cprofile=False, memory=False):
+    global _profiler
+    assert _profiler is None, "Already profiling"
+    _profiler = Profiler(output_dir, cprofile=cprofile, memory=memory)
+    _profiler.start()
+
+
+def stop() -> Optional[Path]:
+    """Stop profiling if it was started, returning the directory of the reports"""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    return profiler.stop()
@@ -0,0 +1,230 @@
+"""
+A runnable check of the shard protocol, with several local worker processes standing in for other machines.
+
+Run it from the repository with 'PYTHONPATH=scripts python3 -m fountain.shardcheck check'.
+It starts the workers on loopback with a stub kind of shard (which just sleeps and echoes its input), and checks that:
+- Workers refuse coordinators with the wrong token
+- Shards are spread over the workers, and their results make it back
+- The shard of a worker killed while running it is reassigned to another worker
+- Decompiling a shard goes through the workers, and once every worker is gone falls back to decompiling locally
+Decompiling runs a stub 'java' (which turns each class into a comment naming it) instead of ForgeFlower,
+so the check doesn't need a JVM, but otherwise goes through the same code as a build.
+"""
+import os
+import re
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Set, Tuple
+from zipfile import ZipFile
+
+from argh import ArghParser, arg
+
+from . import distributed, tools
+from .decompile import NMS_PACKAGE, ShardedDecompiler
+from .distributed import ShardCluster, sha256_file
+
+STUB_KIND = "echo"
+STARTUP_TIMEOUT = 30
+# How long the shard whose worker is killed runs for, which has to be long enough to kill it midway
+SLOW_SHARD_SECONDS = 5
+STUB_CLASSES = 16
+# Stands in for 'java -jar forgeflower.jar <options> <classes> <output>', logging like fernflower does
+STUB_JAVA = """#!{python}
+import os
+import sys
+from pathlib import Path
+from zipfile import ZipFile
+
+classes, output = sys.argv[-2:]
+# NOTE: The parent is the process decompiling the shard, which tells us where it ran
+Path(os.environ["SHARDCHECK_DECOMPILERS"], str(os.getppid())).touch()
+with ZipFile(classes) as source, ZipFile(str(Path(output, Path(classes).name)), "w") as target:
+    for name in source.namelist():
+        print("INFO:  Decompiling class " + name[:-len(".class")], flush=True)
+        target.writestr(name[:-len(".class")] + ".java", "// " + name + "\\n")
+        print("INFO:  ... done", flush=True)
+"""
+
+
+def _run_echo(inputs: Dict[str, Path], request: dict, shard_dir: Path):
+    """The stub shard, which announces it started, sleeps and returns its input reversed"""
+    started = request.get("started")
+    if started:
+        Path(started, str(os.getpid())).touch()
+    time.sleep(request["seconds"])
+    result = Path(shard_dir, "result")
+    result.write_bytes(inputs["data"].read_bytes()[::-1])
+    return result, {"pid": os.getpid()}
+
+
+def _stub_decompiling(temp_dir: Path) -> Path:
+    """Put the stub java first on the path, and our stub ForgeFlower in a private tool cache, returning the marker directory"""
+    bin_dir = Path(temp_dir, "bin")
+    bin_dir.mkdir()
+    java = Path(bin_dir, "java")
+    java.write_text(STUB_JAVA.format(python=sys.executable))
+    java.chmod(0o755)
+    decompilers = Path(temp_dir, "decompilers")
+    decompilers.mkdir()
+    tool_cache = Path(temp_dir, "tools")
+    forgeflower = tools.tool_location(tools.manifest()["forgeFlower"], tool_cache)
+    forgeflower.parent.mkdir(parents=True)
+    forgeflower.write_bytes(b"stub")
+    # NOTE: Record it as if we built it, since a stub can't be pinned
+    forgeflower.with_name(forgeflower.name + ".sha256").write_text(sha256_file(forgeflower) + "\n")
+    # The workers inherit all of these
+    os.environ.update(
+        PATH=os.pathsep.join([str(bin_dir), os.environ.get("PATH", "")]),
+        FOUNTAIN_TOOL_CACHE=str(tool_cache),
+        FOUNTAIN_JVM_STATE=str(Path(temp_dir, "jvm")),
+        SHARDCHECK_DECOMPILERS=str(decompilers)
+    )
+    return decompilers
+
+
+def _write_server_jar(location: Path) -> Set[str]:
+    """Write a jar of stub classes, returning the sources they decompile to"""
+    with ZipFile(str(location), "w") as jar:
+        for index in range(STUB_CLASSES):
+            jar.writestr(f"{NMS_PACKAGE}Stub{index}.class", secrets.token_bytes(1024))
+    return {f"{NMS_PACKAGE}Stub{index}.java" for index in range(STUB_CLASSES)}
+
+
+def _decompile(decompiler: ShardedDecompiler, decompilers: Path) -> Tuple[Set[str], Set[int]]:
+    """Decompile every class in a single shard, returning the sources and the processes which decompiled them"""
+    for marker in decompilers.iterdir():
+        marker.unlink()
+    result = decompiler.decompile_shard(decompiler.classes, decompiler.timeout)
+    with ZipFile(str(result.output_jar), "r") as jar:
+        sources = set(jar.namelist())
+    return sources, {int(marker.name) for marker in decompilers.iterdir()}
+
+
+def _expect(condition, message):
+    if not condition:
+        # NOTE: Exit with an error, unlike a CommandError
+        raise SystemExit(f"Check failed: {message}")
+
+
+class _Worker:
+    def __init__(self, process: subprocess.Popen, address: str):
+        self.process = process
+        self.address = address
+
+    @staticmethod
+    def start(work_dir: Path, token: str) -> "_Worker":
+        work_dir.mkdir()
+        log_file = Path(work_dir, "worker.log")
+        with open(log_file, 'w') as log:
+            process = subprocess.Popen(
+                [sys.executable, "-m", "fountain.shardcheck", "worker", "--work-dir", str(work_dir)],
+                stdout=log, stderr=subprocess.STDOUT, env=dict(os.environ, FOUNTAIN_SHARD_TOKEN=token)
+            )
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline and process.poll() is None:
+            match = re.search(r" on ([\w.]+):(\d+)$", log_file.read_text(), re.MULTILINE)
+            if match is not None:
+                return _Worker(process, f"{match.group(1)}:{match.group(2)}")
+            time.sleep(0.1)
+        process.kill()
+        raise SystemExit(f"Shard worker didn't start:\n{log_file.read_text()}")
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+
+@arg('--workers', '-w', help="The number of worker processes to start")
+def check(workers=3):
+    """Check the shard protocol against several local worker processes"""
+    workers = int(workers)
+    _expect(workers >= 2, "at least two workers are needed to check reassignment")
+    token = secrets.token_hex(16)
+    with tempfile.TemporaryDirectory(prefix="shardcheck-") as temp_dir:
+        temp_dir = Path(temp_dir)
+        started = Path(temp_dir, "started")
+        started.mkdir()
+        data = Path(temp_dir, "data")
+        data.write_bytes(secrets.token_bytes(1024 * 1024))
+        expected = data.read_bytes()[::-1]
+        decompilers = _stub_decompiling(temp_dir)
+        server_jar = Path(temp_dir, "server.jar")
+        expected_sources = _write_server_jar(server_jar)
+        decompile_dir = Path(temp_dir, "decompile")
+        decompile_dir.mkdir()
+        running = []
+        try:
+            for index in range(workers):
+                running.append(_Worker.start(Path(temp_dir, f"worker-{index}"), token))
+            addresses = [worker.address for worker in running]
+            by_pid = {worker.process.pid: worker for worker in running}
+            print(f"---- Started {workers} shard workers on {', '.join(addresses)}")
+
+            _expect(ShardCluster.connect(addresses, "wrong-token") is None, "workers accepted the wrong token")
+            cluster = ShardCluster.connect(addresses, token)
+            _expect(cluster is not None and len(cluster.workers) == workers, "couldn't connect to every worker")
+
+            print(f"---- Running {workers} shards at once")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                summaries = list(executor.map(
+                    lambda index: cluster.run(STUB_KIND, {"seconds": 1}, {"data": data}, Path(temp_dir, f"spread-{index}")),
+                    range(workers)
+                ))
+            for index in range(workers):
+                _expect(Path(temp_dir, f"spread-{index}").read_bytes() == expected, f"wrong result for shard {index}")
+            _expect({summary["pid"] for summary in summaries} == set(by_pid), "shards weren't spread over every worker")
+
+            print("---- Decompiling a shard on the workers")
+            decompiler = ShardedDecompiler(
+                server_jar, frozenset(Path(name).stem for name in expected_sources), decompile_dir, STARTUP_TIMEOUT, cluster=cluster
+            )
+            sources, decompiled_by = _decompile(decompiler, decompilers)
+            _expect(sources == expected_sources, "wrong sources for the decompiled shard")
+            _expect(len(decompiled_by) == 1 and decompiled_by <= set(by_pid), "the shard wasn't decompiled by a worker")
+
+            print("---- Killing a worker while it runs a shard")
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                output = Path(temp_dir, "reassigned")
+                future = executor.submit(cluster.run, STUB_KIND, {"seconds": SLOW_SHARD_SECONDS, "started": str(started)}, {"data": data}, output)
+                deadline = time.monotonic() + STARTUP_TIMEOUT
+                while not any(started.iterdir()):
+                    _expect(time.monotonic() < deadline, "the shard never started")
+                    time.sleep(0.1)
+                killed = by_pid[int(next(started.iterdir()).name)]
+                killed.kill()
+                summary = future.result()
+            _expect(output.read_bytes() == expected, "wrong result for the reassigned shard")
+            _expect(summary["pid"] != killed.process.pid, "the shard wasn't reassigned")
+            _expect(cluster.total_slots == workers - 1, "the killed worker wasn't marked as lost")
+            print(f"Reassigned the shard of {killed.address} to {by_pid[summary['pid']].address}")
+
+            print("---- Killing every worker")
+            for worker in running:
+                worker.kill()
+            sources, decompiled_by = _decompile(decompiler, decompilers)
+            _expect(sources == expected_sources, "wrong sources for the locally decompiled shard")
+            _expect(decompiled_by == {os.getpid()}, "the shard didn't fall back to decompiling locally")
+            _expect(cluster.total_slots < workers - 1, "the dead workers weren't marked as lost")
+        finally:
+            for worker in running:
+                if worker.process.poll() is None:
+                    worker.kill()
+    print("All shard checks passed")
+
+
+@arg('--work-dir', help="The directory to cache inputs and run shards in")
+def worker(work_dir=None):
+    """Run a shard worker on a free loopback port, which can also run the stub shards"""
+    distributed.SHARD_KINDS[STUB_KIND] = _run_echo
+    distributed.serve_worker("127.0.0.1:0", 1, distributed.shard_token(), work_dir=Path(work_dir) if work_dir else None)
+
+
+if __name__ == "__main__":
+    parser = ArghParser(prog="shardcheck", description="Check the shard protocol against local workers")
+    parser.add_commands([check, worker])
+    parser.dispatch()
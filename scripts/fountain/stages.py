@@ -0,0 +1,426 @@
+"""
+Storage for the intermediate source trees of the pipeline.
+
+Each stage is either stored as a plain directory, or as an indexed zip archive
+which is read lazily, depending on the 'stageStorage' configuration option
+(or the FOUNTAIN_STAGE_STORAGE environment variable).
+Archives have far fewer inodes and take up much less disk,
+while the final patched sources are always a real directory.
+
+Concurrent builds coordinate through a lock per stage in 'work/<version>/.locks'.
+Replacing a stage holds its lock exclusively, and commands hold a shared lock on the stages they read.
+To avoid deadlocks, commands take their locks in pipeline order with the patched sources last,
+and rebuilding a stage only ever waits for shared locks on the stages before it.
+"""
+import os
+import shutil
+import tempfile
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from argh import CommandError
+
+from . import WORK_DIR, configuration, version_work_dir, files_identical, metrics
+from . import fileio, locking
+from .fileio import decode_lines, encode_lines
+
+__all__ = (
+    "SourceTree",
+    "DirectoryTree",
+    "ArchiveTree",
+    "stage_tree",
+    "stage_storage",
+    "patched_lock",
+)
+
+STORAGE_FORMATS = ("directory", "archive")
+
+
+class SourceTree(metaclass=ABCMeta):
+    """A tree of source files, addressed by their relative posix paths"""
+    location: Path
+
+    def __init__(self, location: Path):
+        self.location = Path(location)
+
+    @property
+    @abstractmethod
+    def format(self) -> str:
+        pass
+
+    @abstractmethod
+    def exists(self) -> bool:
+        pass
+
+    @abstractmethod
+    def iter_files(self, prefix="") -> Iterator[str]:
+        """Iterate over the relative paths of all files in the tree, optionally only those in a directory"""
+        pass
+
+    @abstractmethod
+    def contains(self, name: str) -> bool:
+        pass
+
+    @abstractmethod
+    def read_bytes(self, name: str) -> bytes:
+        pass
+
+    def read_lines(self, name: str) -> List[str]:
+        return decode_lines(self.read_bytes(name))
+
+    def identical(self, name: str, other: "SourceTree", other_name=None) -> bool:
+        """Check if the specified file is byte-for-byte identical to the file in the other tree"""
+        if other_name is None:
+            other_name = name
+        return self.read_bytes(name) == other.read_bytes(other_name)
+
+    def lock(self, shared=False):
+        """Lock the tree against concurrent replacement, or hold a shared lock while reading it"""
+        base = _base_location(self)
+        return locking.hold(Path(base.parent, ".locks", base.name + ".lock"), shared=shared)
+
+    @abstractmethod
+    def remove(self):
+        """Remove the entire tree"""
+        pass
+
+    @abstractmethod
+    def remove_files(self, names):
+        """Remove the specified files from the tree"""
+        pass
+
+    @abstractmethod
+    def extract_to(self, target: Path):
+        """Copy the tree into a new real directory"""
+        pass
+
+    @contextmanager
+    def materialize(self) -> Iterator[Path]:
+        """Access the tree as a real directory, for external tools that can't read archives"""
+        with tempfile.TemporaryDirectory(prefix=f"{self.location.name}-", dir=WORK_DIR) as temp_dir:
+            target = Path(temp_dir, self.location.name)
+            self.extract_to(target)
+            yield target
+
+    @contextmanager
+    def replace(self) -> Iterator["TreeWriter"]:
+        """
+        Create a new version of the tree, replacing the existing one once complete.
+
+        If an error occurs, the existing tree is left untouched.
+        The tree stays locked until the new version is in place.
+        """
+        with self.lock():
+            writer = self._create_writer()
+            try:
+                yield writer
+            except BaseException:
+                writer.abort()
+                raise
+            else:
+                writer.commit()
+                # Remove the tree if it was stored in a different format
+                for storage in STORAGE_FORMATS:
+                    if storage != self.format:
+                        other = _create_tree(_base_location(self), storage)
+                        if other.exists():
+                            other.remove()
+
+    @abstractmethod
+    def _create_writer(self) -> "TreeWriter":
+        pass
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.location})"
+
+
+class TreeWriter(metaclass=ABCMeta):
+    """Writes a new version of a tree, which is only visible once it's committed"""
+
+    def __init__(self, temp_location: Path):
+        self.temp_location = temp_location
+        self._directory = Path(temp_location.parent, temp_location.name + ".d")
+
+    @property
+    def directory(self) -> Path:
+        """
+        A directory external tools can write their output into, which doesn't exist yet.
+
+        Everything in it becomes part of the tree when it's committed.
+        """
+        return self._directory
+
+    @abstractmethod
+    def write_bytes(self, name: str, data: bytes):
+        pass
+
+    def write_lines(self, name: str, lines, newline='\n'):
+        self.write_bytes(name, encode_lines(lines, newline))
+
+    def copy_from(self, source: SourceTree, names=None):
+        """Copy the specified files (or everything) from the source tree"""
+        for name in (source.iter_files() if names is None else names):
+            data = source.read_bytes(name)
+            self.write_bytes(name, data)
+            metrics.record_files("copied", num_bytes=len(data))
+
+    def copy_directory(self, source: Path):
+        """Copy all the files from the real directory into the tree"""
+        for root, dirs, files in os.walk(str(source)):
+            for file_name in files:
+                location = Path(root, file_name)
+                self.write_bytes(location.relative_to(source).as_posix(), location.read_bytes())
+
+    @abstractmethod
+    def commit(self):
+        pass
+
+    @abstractmethod
+    def abort(self):
+        pass
+
+
+class DirectoryTree(SourceTree):
+    format = "directory"
+
+    def exists(self) -> bool:
+        return self.location.is_dir()
+
+    def iter_files(self, prefix="") -> Iterator[str]:
+        root = Path(self.location, prefix) if prefix else self.location
+        for directory, dirs, files in os.walk(str(root)):
+            for file_name in files:
+                yield Path(directory, file_name).relative_to(self.location).as_posix()
+
+    def contains(self, name: str) -> bool:
+        return Path(self.location, name).is_file()
+
+    def read_bytes(self, name: str) -> bytes:
+        return fileio.read_bytes(Path(self.location, name))
+
+    def read_lines(self, name: str) -> List[str]:
+        return fileio.read_lines(Path(self.location, name))
+
+    def identical(self, name: str, other: SourceTree, other_name=None) -> bool:
+        if other_name is None:
+            other_name = name
+        if isinstance(other, DirectoryTree):
+            return files_identical(Path(self.location, name), Path(other.location, other_name))
+        return super().identical(name, other, other_name)
+
+    def remove(self):
+        shutil.rmtree(self.location)
+
+    def remove_files(self, names):
+        for name in names:
+            os.remove(Path(self.location, name))
+
+    def extract_to(self, target: Path):
+        shutil.copytree(self.location, target)
+
+    @contextmanager
+    def materialize(self) -> Iterator[Path]:
+        yield self.location
+
+    def _create_writer(self):
+        return DirectoryTreeWriter(self)
+
+
+class DirectoryTreeWriter(TreeWriter):
+    def __init__(self, tree: DirectoryTree):
+        super().__init__(Path(tree.location.parent, f".{tree.location.name}.{os.getpid()}.tmp"))
+        self.tree = tree
+        if self.temp_location.exists():
+            shutil.rmtree(self.temp_location)
+        self.temp_location.parent.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def directory(self) -> Path:
+        # NOTE: External tools can write directly into the new tree
+        return self.temp_location
+
+    def write_bytes(self, name: str, data: bytes):
+        target = Path(self.temp_location, name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(data)
+
+    def copy_from(self, source: SourceTree, names=None):
+        if not isinstance(source, DirectoryTree):
+            return super().copy_from(source, names)
+        for name in (source.iter_files() if names is None else names):
+            target = Path(self.temp_location, name)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(Path(source.location, name), target)
+            if metrics.enabled():
+                metrics.record_files("copied", num_bytes=target.stat().st_size)
+
+    def copy_directory(self, source: Path):
+        if not self.temp_location.exists():
+            shutil.copytree(source, self.temp_location)
+        else:
+            super().copy_directory(source)
+
+    def commit(self):
+        self.temp_location.mkdir(parents=True, exist_ok=True)
+        if self.tree.location.exists():
+            # NOTE: Move the old tree out of the way first, so the new one appears all at once
+            old_location = Path(self.tree.location.parent, f".{self.tree.location.name}.{os.getpid()}.old")
+            os.rename(self.tree.location, old_location)
+            os.rename(self.temp_location, self.tree.location)
+            shutil.rmtree(old_location)
+        else:
+            os.rename(self.temp_location, self.tree.location)
+
+    def abort(self):
+        shutil.rmtree(self.temp_location, ignore_errors=True)
+
+
+class ArchiveTree(SourceTree):
+    format = "archive"
+
+    def __init__(self, location: Path):
+        super().__init__(location)
+        self._archive = None
+        self._archive_stat = None
+
+    def __getstate__(self):
+        # NOTE: Don't pickle our open archive when we're sent to worker processes
+        return {"location": self.location}
+
+    def __setstate__(self, state):
+        self.__init__(state['location'])
+
+    def _open(self) -> ZipFile:
+        stat = self.location.stat()
+        stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        archive = self._archive
+        if archive is None or self._archive_stat != stat:
+            # The archive has been replaced since we last opened it
+            if archive is not None:
+                archive.close()
+            archive = self._archive = ZipFile(str(self.location), 'r')
+            self._archive_stat = stat
+        return archive
+
+    def exists(self) -> bool:
+        return self.location.is_file()
+
+    def iter_files(self, prefix="") -> Iterator[str]:
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        for info in self._open().infolist():
+            if not info.is_dir() and info.filename.startswith(prefix):
+                yield info.filename
+
+    def contains(self, name: str) -> bool:
+        try:
+            self._open().getinfo(name)
+            return True
+        except KeyError:
+            return False
+
+    def read_bytes(self, name: str) -> bytes:
+        try:
+            return self._open().read(name)
+        except KeyError:
+            raise FileNotFoundError(f"{name} not found in {self.location}") from None
+
+    def identical(self, name: str, other: SourceTree, other_name=None) -> bool:
+        if other_name is None:
+            other_name = name
+        if isinstance(other, ArchiveTree):
+            # NOTE: The central directory gives us the sizes and checksums for free
+            first, second = self._open().getinfo(name), other._open().getinfo(other_name)
+            if first.file_size != second.file_size or first.CRC != second.CRC:
+                return False
+        return super().identical(name, other, other_name)
+
+    def remove(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+        os.remove(self.location)
+
+    def remove_files(self, names):
+        names = frozenset(names)
+        if not names:
+            return
+        with self.replace() as writer:
+            writer.copy_from(self, [name for name in self.iter_files() if name not in names])
+
+    def extract_to(self, target: Path):
+        self._open().extractall(str(target))
+
+    def _create_writer(self):
+        return ArchiveTreeWriter(self)
+
+
+class ArchiveTreeWriter(TreeWriter):
+    def __init__(self, tree: ArchiveTree):
+        super().__init__(Path(tree.location.parent, f".{tree.location.name}.{os.getpid()}.tmp"))
+        self.tree = tree
+        self.temp_location.parent.mkdir(parents=True, exist_ok=True)
+        self.archive = ZipFile(str(self.temp_location), 'w', compression=ZIP_DEFLATED)
+        self._names = set()
+
+    def write_bytes(self, name: str, data: bytes):
+        if name in self._names:
+            raise ValueError(f"Duplicate entry {name} in {self.tree.location}")
+        self._names.add(name)
+        self.archive.writestr(name, data)
+
+    def commit(self):
+        if self.directory.exists():
+            self.copy_directory(self.directory)
+            shutil.rmtree(self.directory)
+        self.archive.close()
+        os.replace(self.temp_location, self.tree.location)
+
+    def abort(self):
+        self.archive.close()
+        if self.temp_location.exists():
+            os.remove(self.temp_location)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def stage_storage() -> str:
+    result = os.getenv("FOUNTAIN_STAGE_STORAGE") or configuration().get("stageStorage", "directory")
+    if result not in STORAGE_FORMATS:
+        raise CommandError(f"Unknown stage storage {result}, expected one of {', '.join(STORAGE_FORMATS)}")
+    return result
+
+
+def _create_tree(base: Path, storage: str) -> SourceTree:
+    if storage == "archive":
+        return ArchiveTree(Path(base.parent, base.name + ".zip"))
+    else:
+        return DirectoryTree(base)
+
+
+def _base_location(tree: SourceTree) -> Path:
+    if isinstance(tree, ArchiveTree):
+        return Path(tree.location.parent, tree.location.stem)
+    return tree.location
+
+
+STAGES = ("decompiled", "unfixed", "unmapped", "unpatched")
+
+
+def stage_location(name: str, version=None) -> Path:
+    """The base location of the specified stage, without any archive extension"""
+    if name not in STAGES:
+        raise ValueError(f"Unknown stage: {name}")
+    return Path(version_work_dir(version), name)
+
+
+def stage_tree(name: str, version=None) -> SourceTree:
+    """The tree of the specified stage, stored in the configured format"""
+    return _create_tree(stage_location(name, version=version), stage_storage())
+
+
+def patched_lock(version=None, shared=False):
+    """Lock the patched sources of the version, which are written by 'patch' and read by 'diff'"""
+    return locking.hold(Path(version_work_dir(version), ".locks", "patched.lock"), shared=shared)
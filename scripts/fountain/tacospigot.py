@@ -0,0 +1,158 @@
+"""
+Building the TacoSpigot jar, only rebuilding what changed since the last build.
+
+A full build cleans everything and rebuilds Paper and TacoSpigot from scratch, which takes several minutes.
+Most updates only touch TacoSpigot's own patches (or nothing the jar is built from at all),
+so we diff the commit we last built against HEAD and only reapply the patches
+and rebuild the affected maven modules, offline and without cleaning their previous output.
+Anything we don't understand (like Paper or the build scripts changing) still triggers a full build.
+"""
+import os
+import shutil
+from collections import namedtuple
+from pathlib import Path
+from subprocess import PIPE, CalledProcessError
+from typing import List, Optional
+
+from . import ROOT_DIR, metrics
+from .jvm import jvm_job
+from .metrics import run
+
+TACOSPIGOT_REPO = Path(ROOT_DIR, "TacoSpigot")
+TACOSPIGOT_JAR = Path(TACOSPIGOT_REPO, "build", "TacoSpigot-illegal.jar")
+SERVER_MODULE = "TacoSpigot-Server"
+# The maven modules, which are generated by applying the patches in the directories they map to
+MODULE_PATCHES = {
+    "TacoSpigot-API": "TacoSpigot-API-Patches",
+    SERVER_MODULE: "TacoSpigot-Server-Patches",
+}
+APPLY_PATCHES_SCRIPT = "applyPatches.sh"
+# Files which never affect the jar
+IRRELEVANT_NAMES = {".gitignore", ".gitattributes", ".travis.yml", ".github", "LICENSE", "LICENSE.md", "README.md"}
+IRRELEVANT_SUFFIXES = (".md", ".txt")
+
+
+class IncrementalBuildError(Exception):
+    pass
+
+
+class BuildPlan(namedtuple("BuildPlan", ["kind", "modules", "reapply_patches", "reason"])):
+    """How to bring the TacoSpigot jar up to date"""
+    kind: str  # One of 'reuse', 'incremental' or 'full'
+    modules: List[str]  # The maven modules to rebuild, if incremental
+    reapply_patches: bool
+    reason: str
+
+
+def _full(reason: str) -> BuildPlan:
+    return BuildPlan("full", [], False, reason)
+
+
+def changed_files(old_commit: str, new_commit: str) -> Optional[List[str]]:
+    """The files which differ between the commits, or None if the old commit doesn't exist anymore"""
+    try:
+        output = run(
+            ["git", "diff", "--name-only", "--no-renames", old_commit, new_commit],
+            cwd=TACOSPIGOT_REPO, check=True, stdout=PIPE, stderr=PIPE, encoding='utf-8'
+        ).stdout
+    except CalledProcessError:
+        return None
+    return output.splitlines()
+
+
+def _is_irrelevant(name: str) -> bool:
+    return name.split('/', 1)[0] in IRRELEVANT_NAMES or name.endswith(IRRELEVANT_SUFFIXES)
+
+
+def plan_build(last_commit: Optional[str], current_commit: str) -> BuildPlan:
+    """Decide how much of TacoSpigot needs to be rebuilt, since it was last built at last_commit"""
+    if last_commit is None or not TACOSPIGOT_JAR.exists():
+        return _full("TacoSpigot hasn't been built yet")
+    if last_commit == current_commit:
+        return BuildPlan("reuse", [], False, "TacoSpigot hasn't changed")
+    changed = changed_files(last_commit, current_commit)
+    if changed is None:
+        return _full(f"The last built commit {last_commit} no longer exists")
+    patch_modules = {patches: module for module, patches in MODULE_PATCHES.items()}
+    modules = set()
+    reapply_patches = False
+    for name in changed:
+        if _is_irrelevant(name):
+            continue
+        top_level = name.split('/', 1)[0]
+        if top_level in patch_modules:
+            modules.add(patch_modules[top_level])
+            reapply_patches = True
+        elif top_level in MODULE_PATCHES:
+            modules.add(top_level)
+        else:
+            return _full(f"{name} changed")
+    if not modules:
+        return BuildPlan("reuse", [], False, f"Only {len(changed)} unrelated files changed")
+    for module in modules:
+        if not Path(TACOSPIGOT_REPO, module, "target").exists():
+            return _full(f"{module} hasn't been built yet")
+    if reapply_patches and not Path(TACOSPIGOT_REPO, APPLY_PATCHES_SCRIPT).exists():
+        return _full(f"Can't reapply the patches without {APPLY_PATCHES_SCRIPT}")
+    return BuildPlan("incremental", sorted(modules), reapply_patches, f"Only {', '.join(sorted(modules))} changed")
+
+
+def _server_jar() -> Path:
+    """The shaded server jar maven built, which is what build-illegal.sh copies"""
+    target = Path(TACOSPIGOT_REPO, SERVER_MODULE, "target")
+    jars = [
+        jar for jar in target.glob("*.jar")
+        if not jar.name.startswith("original-") and not jar.stem.endswith(("-sources", "-javadoc", "-tests"))
+    ]
+    if len(jars) != 1:
+        raise IncrementalBuildError(f"Expected a single jar in {target}, but found {len(jars)}")
+    return jars[0]
+
+
+def full_build():
+    print("---- Cleaning TacoSpigot")
+    run(["bash", "clean.sh"], cwd=TACOSPIGOT_REPO, check=True)
+    print("---- Compiling TacoSpigot")
+    with jvm_job("maven") as job:
+        job.run(["bash", "build-illegal.sh"], cwd=TACOSPIGOT_REPO, check=True, env=job.environment())
+
+
+def incremental_build(plan: BuildPlan):
+    if plan.reapply_patches:
+        print("---- Reapplying TacoSpigot patches")
+        run(["bash", APPLY_PATCHES_SCRIPT], cwd=TACOSPIGOT_REPO, check=True)
+    print(f"---- Compiling {', '.join(plan.modules)}")
+    with jvm_job("maven") as job:
+        # NOTE: Modules depending on the changed ones (like the server on the API) are rebuilt too
+        job.run([
+            "mvn", "--offline", "-B", "install",
+            "--projects", ",".join(plan.modules), "--also-make-dependents"
+        ], cwd=TACOSPIGOT_REPO, check=True, env=job.environment())
+    temp_jar = TACOSPIGOT_JAR.with_name(f".{TACOSPIGOT_JAR.name}.{os.getpid()}.tmp")
+    shutil.copyfile(str(_server_jar()), str(temp_jar))
+    os.replace(str(temp_jar), str(TACOSPIGOT_JAR))
+
+
+def build_tacospigot(last_commit: Optional[str], current_commit: str):
+    """
+    Bring the TacoSpigot jar up to date with the current commit.
+
+    Incremental builds which fail fall back to a full build, in case they were broken by leftovers of the last one.
+    """
+    plan = plan_build(last_commit, current_commit)
+    metrics.cache_lookup("tacospigot.lastBuild", plan.kind == "reuse")
+    if plan.kind == "reuse":
+        print(f"Reusing cached TacoSpigot jar ({plan.reason})")
+        return
+    if plan.kind == "incremental":
+        print(f"---- Incrementally rebuilding TacoSpigot ({plan.reason})")
+        try:
+            with metrics.stage("buildTacoSpigotIncremental"):
+                incremental_build(plan)
+            return
+        except (CalledProcessError, IncrementalBuildError) as e:
+            print(f"Incremental build failed ({e}), falling back to a full build")
+    else:
+        print(f"---- Fully rebuilding TacoSpigot ({plan.reason})")
+    with metrics.stage("buildTacoSpigot"):
+        full_build()
@@ -0,0 +1,314 @@
+"""
+Provisioning the external tools the build runs, like ForgeFlower, SpecialSource and SuperSrg.
+
+buildData/tools.json pins the version of each tool, where to download it (or how to build it), and its sha256.
+Each tool is provisioned once into a versioned tool cache shared by every checkout on the machine,
+and verified whenever it's resolved. Tools which are built (like ForgeFlower) are also shared through the artifact cache.
+A mirror directory with the same layout as the cache is checked first, so the build can be provisioned offline.
+Downloaded tools must have a pinned sha256, which 'fountain.sh pin-tools' fills in.
+Trusting unpinned tools on first use (recording the hash they were first provisioned with) is opt-in,
+except for tools we build from their pinned source revision ourselves, and the copies an existing checkout already used.
+"""
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from subprocess import CalledProcessError
+from threading import Lock
+from typing import Dict, Iterable, Optional
+
+from argh import CommandError
+
+from . import ROOT_DIR, WORK_DIR, configuration, download_file
+from . import metrics
+from .artifacts import cached_artifact
+from .fileio import write_bytes
+from .jvm import jvm_job
+from .locking import FileLock
+from .metrics import run
+
+__all__ = (
+    "Tool",
+    "manifest",
+    "resolve",
+    "resolve_all",
+    "pin",
+)
+
+
+class Tool(namedtuple("Tool", ["name", "version", "file_name", "sha256", "url", "build", "executable", "options"])):
+    """A pinned version of an external tool"""
+    name: str
+    version: str
+    file_name: str
+    sha256: Optional[str]  # None if it isn't pinned
+    url: Optional[str]
+    build: Optional[str]  # The name of the builder, if it's built from source
+    executable: bool
+    options: dict  # Extra options for the builder
+
+
+MANIFEST_LOCATION = Path(ROOT_DIR, "buildData", "tools.json")
+# Existing checkouts already have some tools here, so they don't need to be provisioned again
+LEGACY_LOCATIONS = {
+    "forgeFlower": lambda tool: Path(WORK_DIR, "jars", f"forge-fernflower-{tool.version}.jar"),
+    "specialSource": lambda tool: Path(WORK_DIR, "jars", f"SpecialSource-{tool.version}.jar"),
+}
+
+# Locally built versions of our own tools, which are used instead when the environment variable is set
+DEV_OVERRIDES = {
+    "superSrg": ("SUPERSRG_DEV", Path(WORK_DIR, "jars", "SuperSrg-dev.jar")),
+    "superSrgBinary": ("SUPERSRG_DEV", Path(WORK_DIR, "bin", "supersrg-dev")),
+}
+# The tools setup needs, which it provisions up front
+SETUP_TOOLS = ("forgeFlower", "specialSource", "superSrg", "superSrgBinary")
+
+_manifest = None
+_resolved = {}  # type: Dict[str, Path]
+_resolve_locks = {}  # type: Dict[str, Lock]
+_resolve_locks_lock = Lock()
+
+
+def manifest() -> Dict[str, Tool]:
+    global _manifest
+    result = _manifest
+    if result is not None:
+        return result
+    try:
+        with open(MANIFEST_LOCATION) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        raise CommandError(f"Missing tool manifest: {MANIFEST_LOCATION}")
+    result = {}
+    for name, entry in data.items():
+        options = {key: value for key, value in entry.items() if key not in ("version", "file", "sha256", "url", "build", "executable")}
+        result[name] = Tool(
+            name, str(entry['version']), entry['file'], entry.get('sha256'),
+            entry.get('url'), entry.get('build'), entry.get('executable', False), options
+        )
+    _manifest = result
+    return result
+
+
+def cache_dir() -> Path:
+    """The tool cache, which defaults to one shared by every checkout of the user"""
+    location = os.getenv("FOUNTAIN_TOOL_CACHE") or configuration().get("toolCache")
+    if location:
+        return Path(location)
+    return Path(os.getenv("XDG_CACHE_HOME") or Path(Path.home(), ".cache"), "tacofountain", "tools")
+
+
+def trust_unpinned() -> bool:
+    """If tools without a pinned sha256 are trusted on first use, instead of refusing to use them"""
+    value = os.getenv("FOUNTAIN_TRUST_UNPINNED_TOOLS")
+    if value is not None:
+        return value not in ("", "0")
+    return bool(configuration().get("trustUnpinnedTools", False))
+
+
+def mirror_dir() -> Optional[Path]:
+    location = os.getenv("FOUNTAIN_TOOL_MIRROR") or configuration().get("toolMirror")
+    return Path(location) if location else None
+
+
+def tool_location(tool: Tool, base: Path) -> Path:
+    return Path(base, tool.name, tool.version, tool.file_name)
+
+
+def _sha256(location: Path) -> str:
+    h = hashlib.sha256()
+    with open(location, 'rb') as f:
+        while True:
+            data = f.read(1024 * 64)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def _verify(tool: Tool, location: Path, pin_file: Path, origin=None, trust=None) -> Optional[str]:
+    """
+    Check the file against the tool's hash, returning the error if it doesn't match.
+
+    Unpinned tools are only trusted on first use if we built them ourselves, the checkout already used them,
+    or that's been opted into.
+    """
+    actual = _sha256(location)
+    if trust is None:
+        trust = trust_unpinned()
+    if tool.sha256 is not None:
+        expected = tool.sha256
+    elif pin_file.exists():
+        expected = pin_file.read_text().strip()
+    elif origin == "build":
+        pin_file.write_text(actual + "\n")
+        return None
+    elif origin == "legacy":
+        # NOTE: The build has been running this copy all along, so provisioning it doesn't trust anything new
+        print(f"WARNING: {tool.name} {tool.version} isn't pinned, trusting the copy this checkout already had "
+              f"(sha256 {actual})", file=sys.stderr)
+        pin_file.write_text(actual + "\n")
+        return None
+    elif trust:
+        print(f"WARNING: {tool.name} {tool.version} isn't pinned, trusting sha256 {actual} on first use", file=sys.stderr)
+        pin_file.write_text(actual + "\n")
+        return None
+    else:
+        return (
+            f"{tool.name} {tool.version} isn't pinned in {MANIFEST_LOCATION.name} (its sha256 is {actual}). "
+            "Pin it with 'fountain.sh pin-tools', or set trustUnpinnedTools to trust it on first use"
+        )
+    if actual != expected:
+        return f"Expected sha256 {expected} for {tool.name} {tool.version}, but got {actual}"
+    return None
+
+
+def _build_forgeflower(tool: Tool, target: Path):
+    repository = Path(WORK_DIR, "ForgeFlower")
+    remote = tool.options['remote']
+    if not repository.exists():
+        run(["git", "clone", remote, str(repository)], check=True)
+    else:
+        try:
+            # See if we already have the commit
+            run(["git", "rev-parse", tool.version], cwd=repository, check=True)
+        except CalledProcessError:
+            run(["git", "fetch", remote, "master"], cwd=repository, check=True)
+    run(["git", "reset", "--hard", tool.version], cwd=repository, check=True)
+    run(["git", "submodule", "update", "--recursive", "--init"], cwd=repository)
+    with jvm_job("gradle") as job:
+        job.run(
+            ["bash", "gradlew", "clean", "build", "--no-daemon", "-x", "test"],
+            cwd=repository, check=True, env=job.environment(variable='GRADLE_OPTS')
+        )
+    compiled_jars = list(Path(repository, "ForgeFlower", "build", "libs").glob("forgeflower-*.jar"))
+    if len(compiled_jars) != 1:
+        raise CommandError(f"Unexpected compiled ForgeFlower jars: {compiled_jars}")
+    shutil.copy2(str(compiled_jars[0]), str(target))
+
+
+BUILDERS = {
+    "forgeFlower": _build_forgeflower,
+}
+
+
+def _provision(tool: Tool, target: Path, trust: bool) -> str:
+    """
+    Fetch or build the tool into the target, which is only moved into the cache once it's verified.
+
+    Returns where it came from: the 'mirror', the 'legacy' location of an existing checkout, its 'download' or our 'build'.
+    Unpinned tools we can build are never copied from the mirror, unless they're trusted.
+    """
+    legacy_location = LEGACY_LOCATIONS[tool.name](tool) if tool.name in LEGACY_LOCATIONS else None
+    mirror = mirror_dir()
+    mirrored = tool_location(tool, mirror) if mirror is not None else None
+    if tool.build is not None and tool.sha256 is None and not trust:
+        mirrored = None
+    if mirrored is not None and mirrored.exists():
+        print(f"---- Copying {tool.name} {tool.version} from the tool mirror")
+        shutil.copyfile(str(mirrored), str(target))
+        return "mirror"
+    elif legacy_location is not None and legacy_location.exists():
+        shutil.copyfile(str(legacy_location), str(target))
+        return "legacy"
+    elif tool.url is not None:
+        print(f"---- Downloading {tool.name} {tool.version}")
+        download_file(target, tool.url, sha256=tool.sha256)
+        return "download"
+    elif tool.build is not None:
+        print(f"---- Building {tool.name} {tool.version}")
+        with metrics.stage(f"build{tool.name[0].upper()}{tool.name[1:]}"):
+            cached_artifact(f"tool-{tool.name}", (tool.version, tool.file_name), target, lambda: BUILDERS[tool.build](tool, target))
+        return "build"
+    else:
+        location = tool_location(tool, mirror) if mirror is not None else Path("<toolMirror>", tool.name, tool.version, tool.file_name)
+        raise CommandError(f"Unable to provision {tool.name} {tool.version}, since it has no download. Place it at {location}")
+
+
+def resolve(name: str, trust=None) -> Path:
+    """
+    Provision the tool if it isn't in the tool cache yet, and return its location.
+
+    If trust is specified, it overrides whether an unpinned tool is trusted on first use.
+    """
+    with _resolve_locks_lock:
+        resolve_lock = _resolve_locks.setdefault(name, Lock())
+    with resolve_lock:
+        result = _resolved.get(name)
+        if result is not None:
+            return result
+        if name in DEV_OVERRIDES:
+            variable, dev_location = DEV_OVERRIDES[name]
+            if dev_location.exists() and os.getenv(variable) not in (None, "0"):
+                _resolved[name] = dev_location
+                return dev_location
+        try:
+            tool = manifest()[name]
+        except KeyError:
+            raise CommandError(f"Unknown tool: {name}")
+        if trust is None:
+            trust = trust_unpinned()
+        location = tool_location(tool, cache_dir())
+        pin_file = location.with_name(location.name + ".sha256")
+        location.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(location.with_name(location.name + ".lock")):
+            if location.exists():
+                error = _verify(tool, location, pin_file, trust=trust)
+                metrics.cache_lookup(f"tools.{name}", error is None)
+                if error is not None:
+                    print(f"WARNING: Provisioning {name} again, since the cached copy is corrupt: {error}", file=sys.stderr)
+                    os.remove(location)
+            else:
+                metrics.cache_lookup(f"tools.{name}", False)
+            if not location.exists():
+                # NOTE: We hold the lock, so this doesn't need to be unique (which lets interrupted downloads resume)
+                incoming = location.with_name(f".{location.name}.incoming")
+                if incoming.exists():
+                    os.remove(incoming)
+                origin = _provision(tool, incoming, trust)
+                error = _verify(tool, incoming, pin_file, origin=origin, trust=trust)
+                if error is not None:
+                    os.remove(incoming)
+                    raise CommandError(error)
+                if tool.executable:
+                    incoming.chmod(incoming.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+                os.replace(str(incoming), str(location))
+        _resolved[name] = location
+        return location
+
+
+def resolve_all(names: Iterable[str]) -> Dict[str, Path]:
+    """Concurrently resolve the tools, so downloading one doesn't wait on building another"""
+    names = list(names)
+    with ThreadPoolExecutor(max_workers=max(1, len(names))) as executor:
+        return dict(zip(names, executor.map(resolve, names)))
+
+
+def pin(names: Iterable[str]) -> Dict[str, str]:
+    """
+    Pin the sha256 of the (downloaded) tools in the manifest, trusting whatever they're provisioned with now.
+
+    Built tools aren't pinned, since their jars aren't reproducible and every builder would get a different hash.
+    """
+    global _manifest
+    names = [name for name in names if manifest()[name].build is None]
+    result = {}
+    for name in names:
+        tool = manifest()[name]
+        location = resolve(name, trust=True)
+        actual = _sha256(location)
+        if tool.sha256 is not None and tool.sha256 != actual:
+            raise CommandError(f"{name} {tool.version} is already pinned to sha256 {tool.sha256}, but got {actual}")
+        result[name] = actual
+    with open(MANIFEST_LOCATION) as f:
+        data = json.load(f)
+    for name, digest in result.items():
+        data[name]['sha256'] = digest
+    write_bytes(MANIFEST_LOCATION, (json.dumps(data, indent=4) + "\n").encode('utf-8'), skip_unchanged=True)
+    _manifest = None
+    return result
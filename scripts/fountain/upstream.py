@@ -0,0 +1,219 @@
+"""
+Bisecting the TacoSpigot history, to find the first upstream commit which breaks our patches.
+
+Each probe prepares a separate temporary workspace with its own TacoSpigot worktree,
+then runs 'setup' and 'patch --check' there in a subprocess, so several probes can run at once.
+The expensive stage outputs are shared through the artifact cache, and probe results are cached per commit.
+"""
+import json
+import os
+import shutil
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from subprocess import PIPE, STDOUT, CalledProcessError
+from typing import Dict, List
+
+from argh import CommandError
+
+from . import ROOT_DIR, WORK_DIR
+from .artifacts import artifact_store
+from .fingerprint import fingerprint
+from .metrics import run
+from . import jvm, metrics
+
+BISECT_DIR = Path(WORK_DIR, "bisect")
+TACOSPIGOT_REPO = Path(ROOT_DIR, "TacoSpigot")
+
+
+class ProbeResult(namedtuple("ProbeResult", ["commit", "status", "failed_patches", "log"])):
+    """The result of checking the patches against a single upstream commit"""
+    commit: str
+    status: str  # One of 'good', 'bad' or 'skip' (if the commit couldn't be built)
+    failed_patches: List[str]
+    log: str
+
+
+def _git(*args, cwd=TACOSPIGOT_REPO) -> str:
+    return run(["git", *args], cwd=cwd, check=True, stdout=PIPE, encoding='utf-8').stdout.strip()
+
+
+def resolve_commit(revision: str) -> str:
+    try:
+        return _git("rev-parse", "--verify", f"{revision}^{{commit}}")
+    except CalledProcessError:
+        raise CommandError(f"Unknown TacoSpigot revision: {revision}")
+
+
+def commits_between(good: str, bad: str) -> List[str]:
+    """List the commits from good to bad (inclusive) along the ancestry path"""
+    try:
+        run(["git", "merge-base", "--is-ancestor", good, bad], cwd=TACOSPIGOT_REPO, check=True)
+    except CalledProcessError:
+        raise CommandError(f"Good commit {good[:10]} isn't an ancestor of bad commit {bad[:10]}")
+    output = _git("rev-list", "--reverse", "--ancestry-path", f"{good}..{bad}")
+    return [good, *output.splitlines()]
+
+
+def _link_tree(source: Path, target: Path):
+    """Copy the tree with hardlinks where possible, since the tools in it are never modified"""
+    def link(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    shutil.copytree(source, target, copy_function=link)
+
+
+class Prober:
+    def __init__(self, patches_hash: str, artifact_cache: Path):
+        self.patches_hash = patches_hash
+        self.artifact_cache = artifact_cache
+        self.results_dir = Path(BISECT_DIR, "results")
+        self.logs_dir = Path(BISECT_DIR, "logs")
+
+    def _result_file(self, commit: str) -> Path:
+        return Path(self.results_dir, f"{commit}-{self.patches_hash[:16]}.json")
+
+    def cached_result(self, commit: str):
+        try:
+            with open(self._result_file(commit)) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        if data['status'] == "skip":
+            return None  # Cached by older versions, but skipping may have been transient
+        return ProbeResult(commit, data['status'], data['failedPatches'], data['log'])
+
+    def _prepare_workspace(self, commit: str, workspace: Path):
+        if workspace.exists():
+            self._remove_workspace(workspace)
+        workspace.mkdir(parents=True)
+        # NOTE: A bare git repo is enough for the build system to find its root directory
+        run(["git", "init", "-q"], cwd=workspace, check=True)
+        os.symlink(Path(ROOT_DIR, "scripts"), Path(workspace, "scripts"))
+        # Use the current patches and configuration, even if they aren't committed yet
+        shutil.copytree(Path(ROOT_DIR, "patches"), Path(workspace, "patches"))
+        shutil.copytree(Path(ROOT_DIR, "buildData"), Path(workspace, "buildData"))
+        if Path(WORK_DIR, "jars").exists():
+            _link_tree(Path(WORK_DIR, "jars"), Path(workspace, "work", "jars"))
+        run(["git", "worktree", "add", "--detach", str(Path(workspace, "TacoSpigot")), commit],
+            cwd=TACOSPIGOT_REPO, check=True, stdout=PIPE, stderr=STDOUT)
+        run(["git", "submodule", "update", "--init", "--recursive"],
+            cwd=Path(workspace, "TacoSpigot"), check=True, stdout=PIPE, stderr=STDOUT)
+
+    def _remove_workspace(self, workspace: Path):
+        tacospigot = Path(workspace, "TacoSpigot")
+        if tacospigot.exists():
+            run(["git", "worktree", "remove", "--force", str(tacospigot)], cwd=TACOSPIGOT_REPO, stdout=PIPE, stderr=STDOUT)
+        shutil.rmtree(workspace, ignore_errors=True)
+        run(["git", "worktree", "prune"], cwd=TACOSPIGOT_REPO, stdout=PIPE, stderr=STDOUT)
+
+    def probe(self, commit: str, keep_workspace=False) -> ProbeResult:
+        """Check if the patches apply to the specified commit, reusing the cached result if possible"""
+        cached = self.cached_result(commit)
+        if cached is not None:
+            return cached
+        workspace = Path(BISECT_DIR, "workspaces", commit[:12])
+        self.logs_dir.mkdir(parents=True, exist_ok=True)
+        log_file = Path(self.logs_dir, f"{commit}.log")
+        env = dict(os.environ)
+        env['FOUNTAIN_ARTIFACT_CACHE'] = str(self.artifact_cache)
+        # NOTE: Share our JVM ledger, so the concurrent probes don't oversubscribe the machine
+        env['FOUNTAIN_JVM_STATE'] = str(jvm.state_dir())
+        # NOTE: The inherited entries (like the bootstrapped work/python_packages) are relative to our directory, not the workspace
+        inherited_path = [os.path.abspath(entry) for entry in env.get('PYTHONPATH', "").split(os.pathsep) if entry]
+        env['PYTHONPATH'] = os.pathsep.join([str(Path(ROOT_DIR, "scripts")), *inherited_path])
+        try:
+            with metrics.stage("bisectProbe"), open(log_file, 'wt') as log:
+                self._prepare_workspace(commit, workspace)
+                setup_proc = run(
+                    [sys.executable, "-m", "fountain", "setup"],
+                    cwd=workspace, env=env, stdout=log, stderr=STDOUT
+                )
+                if setup_proc.returncode != 0:
+                    status, failed_patches = "skip", []
+                else:
+                    check_proc = run(
+                        [sys.executable, "-m", "fountain", "patch", "--check", "--json"],
+                        cwd=workspace, env=env, stdout=PIPE, stderr=log, encoding='utf-8'
+                    )
+                    log.write(check_proc.stdout)
+                    try:
+                        summary = json.loads(check_proc.stdout)
+                    except ValueError:
+                        status, failed_patches = "skip", []
+                    else:
+                        failed_patches = [entry['patch'] for entry in summary['patches'] if not entry['applies']]
+                        status = "bad" if failed_patches else "good"
+        except CalledProcessError as e:
+            raise CommandError(f"Unable to prepare workspace for {commit[:10]}: {e}")
+        finally:
+            if not keep_workspace:
+                self._remove_workspace(workspace)
+        result = ProbeResult(commit, status, failed_patches, str(log_file))
+        if status != "skip":
+            # NOTE: Commits are only skipped if something went wrong, which may well be transient
+            self.results_dir.mkdir(parents=True, exist_ok=True)
+            with open(self._result_file(commit), 'wt') as f:
+                json.dump({"status": status, "failedPatches": failed_patches, "log": str(log_file)}, f, indent=4)
+        return result
+
+
+BisectResult = namedtuple("BisectResult", ["first_bad", "candidates", "results"])
+
+
+def _pick_probes(candidates: List[int], count: int) -> List[int]:
+    """Evenly split the candidates into count + 1 segments, so each round shrinks the range the most"""
+    count = min(count, len(candidates))
+    picks = {candidates[(index + 1) * len(candidates) // (count + 1)] for index in range(count)}
+    return sorted(picks)
+
+
+def bisect_commits(commits: List[str], prober: Prober, jobs: int, keep_workspaces=False) -> BisectResult:
+    """
+    Find the first bad commit, assuming the first commit is good and the last is bad.
+
+    Each round probes up to 'jobs' commits concurrently, splitting the remaining range into jobs + 1 parts.
+    Commits which can't be built are skipped, like 'git bisect skip'.
+    """
+    results = {}  # type: Dict[int, ProbeResult]
+    skipped = set()
+    good, bad = 0, len(commits) - 1
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while bad - good > 1:
+            candidates = [index for index in range(good + 1, bad) if index not in skipped]
+            if not candidates:
+                break
+            picks = _pick_probes(candidates, jobs)
+            print(f"---- Probing {len(picks)} of {len(candidates)} remaining commits")
+            for index, result in zip(picks, executor.map(
+                lambda index: prober.probe(commits[index], keep_workspace=keep_workspaces), picks
+            )):
+                results[index] = result
+                print(f"{commits[index][:10]}: {result.status}")
+            first_bad = min((index for index in picks if results[index].status == "bad"), default=bad)
+            good = max((index for index in picks if results[index].status == "good" and index < first_bad), default=good)
+            bad = first_bad
+            skipped.update(index for index in picks if results[index].status == "skip")
+        if bad not in results:
+            # Make sure the bad commit is actually bad, and find out which patches it breaks
+            results[bad] = prober.probe(commits[bad], keep_workspace=keep_workspaces)
+    candidates = [commits[index] for index in range(good + 1, bad + 1)]
+    return BisectResult(commits[bad], candidates, {commits[index]: result for index, result in results.items()})
+
+
+def bisect_upstream(good: str, bad: str, jobs=None, keep_workspaces=False) -> BisectResult:
+    if not TACOSPIGOT_REPO.exists():
+        raise CommandError("TacoSpigot repository not found!")
+    good, bad = resolve_commit(good), resolve_commit(bad)
+    commits = commits_between(good, bad)
+    if jobs is None:
+        # Each probe runs a full build, so don't oversubscribe the machine
+        jobs = max(1, min(4, (os.cpu_count() or 1) // 4))
+    store = artifact_store()
+    artifact_cache = store.location if store is not None else Path(BISECT_DIR, "artifacts")
+    prober = Prober(fingerprint(Path(ROOT_DIR, "patches")).hex(), artifact_cache)
+    print(f"---- Bisecting {len(commits) - 1} TacoSpigot commits with {jobs} concurrent probes")
+    return bisect_commits(commits, prober, int(jobs), keep_workspaces=keep_workspaces)
@@ -1,26 +1,96 @@
-from argh import ArghParser, arg
-from subprocess import run, PIPE
+from argh import ArghParser, arg, CommandError
+from subprocess import PIPE, DEVNULL
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from sys import stderr
+import hashlib
 import re
 from pathlib import Path
 import shutil
 import tempfile
 import json
 import os
+from . import metrics
+from .metrics import run, dispatch_with_metrics
 from .classpath import tacospigot_classpath
+from .fingerprint import fingerprint, fingerprint_tree
 from . import minecraft_version, grouper, ROOT_DIR, WORK_DIR,\
-    regenerate_unmapped_sources, download_file, read_file, write_file
+    regenerate_unmapped_sources, download_file, select_minecraft_version, version_work_dir, require_detected_version
+from .jvm import jvm_job
+from .decompile import blacklist_candidates
+from .fileio import read_lines, write_bytes, write_lines
+from .stages import SourceTree, stage_tree
+from .diffing import LineInterner, diff_lines
 from diffutils import generate_unified_diff
 from diffutils.engine import DiffEngine
 
+# Don't bother starting another JVM for less than this many files
+MIN_SHARD_SIZE = 250
+
+
+def classpath_fingerprint(classpath) -> str:
+    """Fingerprint the contents of the classpath, so cached results are invalidated when it changes"""
+    h = hashlib.sha256()
+    for entry in classpath:
+        h.update(str(entry).encode('utf-8'))
+        h.update(b'\0')
+        h.update(fingerprint(entry))
+    return h.hexdigest()
+
+
+def decompile_errors_cache(version=None) -> Path:
+    """The per-file results of find-decompile-errors for the version"""
+    return Path(version_work_dir(version), "decompile-errors")
+
+
+def decompile_errors_location(version=None) -> Path:
+    """The merged results of find-decompile-errors for the version"""
+    return Path(version_work_dir(version), "errors.json")
+
+
+def cached_decompile_errors(file_name):
+    """Load the cached errors for the specified file, or None if it hasn't been checked"""
+    try:
+        with open(Path(decompile_errors_cache(), Path(file_name).stem + ".json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _check_decompile_errors_shard(jar_file: Path, classpath: str, source_root: Path, sources, quiet):
+    """Check a single shard of source files in its own JVM, returning the errors found for each file"""
+    with tempfile.TemporaryDirectory(prefix="findDecompileErrors") as shard_dir:
+        source_list = Path(shard_dir, "sources.txt")
+        output_file = Path(shard_dir, "errors.json")
+        write_lines(source_list, (str(Path(source_root, source).absolute()) for source in sources))
+        # NOTE: Run each shard in its own directory, since the checker emits classes to './bin'
+        with jvm_job("findDecompileErrors") as job:
+            proc = job.run(job.java(
+                    "-XX:+UseG1GC", "-XX:+HeapDumpOnOutOfMemoryError",
+                    "-cp", str(jar_file.absolute()), "FindDecompileErrors",
+                    classpath,
+                    str(source_root.absolute()),
+                    "@" + str(source_list),
+                    str(output_file)
+                ), cwd=shard_dir, stdout=DEVNULL if quiet else None
+            )
+        if proc.returncode != 0:
+            raise CommandError(f"Error checking {len(sources)} files for decompile errors")
+        with open(output_file) as f:
+            return json.load(f)['errors']
+
+
 @arg('--recompile', help="Forcibly recompile the jar")
 @arg('--dont-restore', help="Don't restore blacklisted files before ")
-def find_decompile_errors(recompile=False, dont_restore=False):
+@arg('--force', help="Recheck all files, ignoring cached results")
+@arg('--jobs', '-j', help="The maximum number of JVMs to check files with")
+@arg('--mc-version', help="The minecraft version to use, instead of the one TacoSpigot is built for")
+def find_decompile_errors(recompile=False, dont_restore=False, force=False, jobs=None, mc_version=None):
     """Compile the decompiled sources with javac, to find which files have errors"""
+    select_minecraft_version(mc_version)
     if not dont_restore:
         restore_blacklisted(quiet=True)
-    version = minecraft_version()
-    nms_dir = Path("work/unmapped/net/minecraft/server")
-    assert nms_dir.exists()
+    source_tree = stage_tree("unmapped")
+    assert source_tree.exists()
     scripts_dir = Path(ROOT_DIR, "scripts")
     jar_file = Path(WORK_DIR, "jars", "findDecompileErrors.jar")
     if not jar_file.exists() or recompile:
@@ -28,21 +98,97 @@ def find_decompile_errors(recompile=False, dont_restore=False):
             run(["javac", "-d", class_files, "FindDecompileErrors.java"], cwd=scripts_dir, check=True)
             run(["jar", "-cf", str(jar_file), "-C", class_files, "."], check=True)
         assert jar_file.exists()
-    proc = run([
-            "java", "-Xmx512M", "-XX:+UseG1GC", "-XX:+HeapDumpOnOutOfMemoryError",
-            "-cp", str(jar_file), "FindDecompileErrors",
-            ':'.join(str(p) for p in tacospigot_classpath()),
-            "work/unmapped",
-            nms_dir,
-            "buildData/errors.json"
-        ]
-    )
-    # Propagate failure
-    exit(proc.returncode)
+    classpath = tacospigot_classpath()
+    classpath_hash = classpath_fingerprint(classpath)
+    errors_cache = decompile_errors_cache()
+    errors_cache.mkdir(parents=True, exist_ok=True)
+    with source_tree.lock(shared=True):
+        source_hashes = {}
+        source_sizes = {}
+        stale_files = []
+        for name in sorted(source_tree.iter_files("net/minecraft/server")):
+            source = Path(name)
+            data = source_tree.read_bytes(name)
+            source_hash = hashlib.sha256(data).hexdigest()
+            source_hashes[source.name] = source_hash
+            source_sizes[source] = len(data)
+            cached = None if force else cached_decompile_errors(source.name)
+            if cached is None or cached['sourceHash'] != source_hash or cached['classpath'] != classpath_hash:
+                stale_files.append(source)
+        print(f"---- Checking {len(stale_files)} changed files out of {len(source_hashes)}")
+        if stale_files:
+            if jobs is None:
+                jobs = os.cpu_count() or 1
+            num_shards = max(1, min(int(jobs), len(stale_files) // MIN_SHARD_SIZE))
+            # Largest files first, so the shards end up with roughly equal amounts of work
+            stale_files.sort(key=lambda source: source_sizes[source], reverse=True)
+            shards = [stale_files[index::num_shards] for index in range(num_shards)]
+            raw_classpath = ':'.join(str(p) for p in classpath)
+            failed = False
+            # NOTE: Javac may report errors against files of another shard, so merge them before writing anything
+            reported_errors = {}
+            checked_files = []
+            with metrics.stage("findDecompileErrors"), source_tree.materialize() as source_root,\
+                    ThreadPoolExecutor(max_workers=num_shards) as executor:
+                futures = {
+                    executor.submit(
+                        _check_decompile_errors_shard, jar_file, raw_classpath,
+                        source_root, shard, num_shards > 1
+                    ): shard
+                    for shard in shards
+                }
+                for future in as_completed(futures):
+                    shard = futures[future]
+                    try:
+                        errors = future.result()
+                    except CommandError as e:
+                        print("ERROR: " + '\n'.join(e.args), file=stderr)
+                        failed = True
+                        continue
+                    for file_name, file_errors in errors.items():
+                        reported_errors.setdefault(file_name, set()).update(file_errors)
+                    checked_files.extend(shard)
+                    if num_shards > 1:
+                        print(f"Checked shard of {len(shard)} files")
+            for source in checked_files:
+                write_bytes(Path(errors_cache, source.stem + ".json"), json.dumps({
+                    "sourceHash": source_hashes[source.name],
+                    "classpath": classpath_hash,
+                    "errors": sorted(reported_errors.get(source.name, ()))
+                }).encode('utf-8'))
+            # Errors against files which weren't rechecked are added to their cached results
+            checked_names = {source.name for source in checked_files}
+            for file_name, file_errors in reported_errors.items():
+                if file_name in checked_names or file_name not in source_hashes:
+                    continue
+                cached = cached_decompile_errors(file_name)
+                if cached is None or set(file_errors) <= set(cached['errors']):
+                    continue
+                cached['errors'] = sorted(set(cached['errors']) | file_errors)
+                write_bytes(Path(errors_cache, Path(file_name).stem + ".json"), json.dumps(cached).encode('utf-8'))
+            if failed:
+                # Propagate failure, keeping the results of the shards that succeeded
+                exit(1)
+        # Merge the per-file results, pruning files that no longer exist
+        merged_errors = {}
+        for cache_file in errors_cache.iterdir():
+            if cache_file.name.startswith('.'):
+                continue  # Being written by another process
+            file_name = cache_file.stem + ".java"
+            if file_name not in source_hashes:
+                os.remove(cache_file)
+                continue
+            with open(cache_file) as f:
+                errors = json.load(f)['errors']
+            if errors:
+                merged_errors[file_name] = errors
+        write_bytes(decompile_errors_location(), json.dumps({"errors": merged_errors}, sort_keys=True).encode('utf-8'))
+        num_errors = sum(len(errors) for errors in merged_errors.values())
+        print(f"Found {num_errors} errors in {len(merged_errors)} files")
 
 def load_decompile_errors():
-    try:        
-        with open('buildData/errors.json') as f:
+    try:
+        with open(decompile_errors_location()) as f:
             data = json.load(f)
         return data['errors']
     except FileNotFoundError:
@@ -50,59 +196,107 @@ def load_decompile_errors():
 
 # Files that fail with the JDT compiler, but not with javac
 ADDITIONAL_BLACKLISTED_FILES = {}
-def regenerate_blacklist():
-    """Regenerate the decompile blacklist from the output of find-decompile-errors"""
+@arg('--mc-version', help="The minecraft version to use, instead of the one TacoSpigot is built for")
+def regenerate_blacklist(mc_version=None):
+    """
+    Regenerate the decompile blacklist from the output of find-decompile-errors.
+
+    Classes which timed out the last time they were decompiled are blacklisted too.
+    """
+    select_minecraft_version(mc_version)
+    # NOTE: There's only the one blacklist, for the version TacoSpigot is built for
+    require_detected_version("regenerate the decompile blacklist")
     errors = load_decompile_errors()
     blacklistedFiles = set(ADDITIONAL_BLACKLISTED_FILES)
     tacospigot_sources = Path("TacoSpigot", "TacoSpigot-Server", "src/main/java", "net/minecraft/server")
     for file_name in errors.keys():
         blacklistedFiles.add(Path(file_name).stem)
+    slow_classes = blacklist_candidates()
+    if slow_classes:
+        print(f"Blacklisting {len(slow_classes)} classes which timed out decompiling")
+        blacklistedFiles.update(slow_classes)
     for blacklisted in blacklistedFiles:
-        tacospigot_file = Path(tacospigot_sources, file_name + ".java")
+        tacospigot_file = Path(tacospigot_sources, blacklisted + ".java")
         if tacospigot_file.exists():
-            print(f"WARNING: Found errors for TacoSpigot file {file_name}")
+            print(f"WARNING: Found errors for TacoSpigot file {blacklisted}")
     print(f"Found {len(blacklistedFiles)} blacklisted files")
-    with open('buildData/decompile_blacklist.json', 'wt') as f:
-        json.dump(sorted(blacklistedFiles), f)
+    write_bytes(Path("buildData", "decompile_blacklist.json"), json.dumps(sorted(blacklistedFiles)).encode('utf-8'))
 
 
-def generate_fixes():
+_fix_engine = None
+_fix_interner = None
+def _diff_fix(unfixed_sources: SourceTree, unmapped_sources: SourceTree, name: str):
+    """Compute the unified diff fixing the specified file, run inside the worker processes"""
+    global _fix_engine, _fix_interner
+    engine = _fix_engine
+    if engine is None:
+        engine = _fix_engine = DiffEngine.create()
+        _fix_interner = LineInterner()
+    original_lines = unfixed_sources.read_lines(name)
+    fixed_lines = unmapped_sources.read_lines(name)
+    patch = diff_lines(engine, original_lines, fixed_lines, _fix_interner)
+    return list(generate_unified_diff(
+        # NOTE: Use the same names for every version, so the fixes don't churn
+        str(Path("work", "unfixed", name)),
+        str(Path("work", "unmapped", name)),
+        original_lines,
+        patch
+    ))
+
+
+@arg('--jobs', '-j', help="The number of processes to compute diffs with")
+def generate_fixes(jobs=None):
     """Generate compilation fixing patches"""
-    unfixed_sources = Path(WORK_DIR, "unfixed/net/minecraft/server")
-    unmapped_sources = Path(WORK_DIR, "unmapped/net/minecraft/server")
+    unfixed_sources = stage_tree("unfixed")
+    unmapped_sources = stage_tree("unmapped")
     fixes = Path(ROOT_DIR, "buildData/fixes")
     fixes.mkdir(exist_ok=True)
-    existing_fixes = list(fixes.iterdir())
-    if existing_fixes:
-        print("Removing existing fixes")
-        for p in existing_fixes:
-            os.remove(p)
-    engine = DiffEngine.create()
-    for unfixed_file in unfixed_sources.iterdir():
-        unmapped_file = Path(unmapped_sources, unfixed_file.name)
-        original_lines = read_file(unfixed_file)
-        fixed_lines = read_file(unmapped_file)
-        patch = engine.diff(original_lines, fixed_lines)
-        patch_lines = list(generate_unified_diff(
-            str(unfixed_file.relative_to(ROOT_DIR)),
-            str(unmapped_file.relative_to(ROOT_DIR)),
-            original_lines,
-            patch
-        ))
-        if patch_lines:
-            print(f"Found diff for {unfixed_file.name}")
-            fix_file = Path(fixes, unfixed_file.name + ".patch")
-            write_file(fix_file, patch_lines)
+    with unfixed_sources.lock(shared=True), unmapped_sources.lock(shared=True):
+        changed_files = []
+        for name in unfixed_sources.iter_files("net/minecraft/server"):
+            if not unmapped_sources.contains(name):
+                continue  # Blacklisted
+            # NOTE: Almost every file is untouched, so avoid diffing identical files
+            if not unfixed_sources.identical(name, unmapped_sources):
+                changed_files.append(name)
+        print(f"---- Diffing {len(changed_files)} changed files")
+        expected_fixes = set()
+        with ProcessPoolExecutor(max_workers=int(jobs) if jobs is not None else None) as executor:
+            futures = {
+                executor.submit(_diff_fix, unfixed_sources, unmapped_sources, name): name
+                for name in changed_files
+            }
+            for future in as_completed(futures):
+                file_name = Path(futures[future]).name
+                patch_lines = future.result()
+                metrics.record_files("diffed")
+                if not patch_lines:
+                    continue
+                fix_file = Path(fixes, file_name + ".patch")
+                expected_fixes.add(fix_file.name)
+                if write_lines(fix_file, patch_lines, skip_unchanged=True):
+                    print(f"Found diff for {file_name}")
+        for existing_fix in fixes.iterdir():
+            if existing_fix.name not in expected_fixes:
+                print(f"Removing outdated fix {existing_fix.name}")
+                os.remove(existing_fix)
 
 @arg('file_name', help="The name of the file to output errors for")
-def print_errors(file_name):
+@arg('--mc-version', help="The minecraft version to use, instead of the one TacoSpigot is built for")
+def print_errors(file_name, mc_version=None):
     """Print compilation errors for a specified class, based on the output of find-decompile-errors"""
+    select_minecraft_version(mc_version)
     if not file_name.endswith('.java'):
         file_name += ".java"
-    try:
-        errors = load_decompile_errors()[file_name]
-    except KeyError:
-        errors = []
+    # NOTE: Prefer the per-file cache, so we don't have to load everything
+    cached = cached_decompile_errors(file_name)
+    if cached is not None:
+        errors = cached['errors']
+    else:
+        try:
+            errors = load_decompile_errors()[file_name]
+        except KeyError:
+            errors = []
     print(f"Found {len(errors)} errors for {file_name}")
     for value in errors:
         print("ERROR: " + value)
@@ -110,14 +304,22 @@ def print_errors(file_name):
 @arg('--quiet', help="Only print a message if files were restored")
 def restore_blacklisted(quiet=False):
     """Restore all blacklisted decompiled files"""
-    decompiled_dir = Path(WORK_DIR, minecraft_version(), "decompiled", "net/minecraft/server")
-    unmapped_dir = Path(WORK_DIR, "unmapped", "net/minecraft/server")
-    num_restored = 0
-    if any(not Path(unmapped_dir, source.name).exists()
-            for source in decompiled_dir.iterdir()):
+    decompiled_sources = stage_tree("decompiled")
+    unmapped_sources = stage_tree("unmapped")
+    if not unmapped_sources.exists() or any(
+        not unmapped_sources.contains(name)
+        for name in decompiled_sources.iter_files("net/minecraft/server")
+    ):
         regenerate_unmapped_sources(respect_blacklist=False)
 
+@arg('paths', nargs='+', help="The trees or files to fingerprint")
+def print_fingerprints(*paths):
+    """Print the fingerprint of each of the specified trees or files"""
+    for path in paths:
+        result = fingerprint_tree(Path(path))
+        print(f"{result.root.hex()} {path} ({len(result.files)} files)")
+
 if __name__ == "__main__":
     parser = ArghParser(prog="fountain.sh", description="TacoFountain utilities")
-    parser.add_commands([find_decompile_errors, restore_blacklisted, regenerate_blacklist, print_errors, generate_fixes])
-    parser.dispatch()
\ No newline at end of file
+    parser.add_commands([find_decompile_errors, restore_blacklisted, regenerate_blacklist, print_errors, generate_fixes, print_fingerprints])
+    dispatch_with_metrics(parser, profile_dir=Path(WORK_DIR, "profiles"))
\ No newline at end of file